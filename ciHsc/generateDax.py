@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 import argparse
 import os
+import sys
+from collections import defaultdict
 import Pegasus.DAX3 as peg
 
 import lsst.log
 import lsst.utils
 from lsst.obs.hsc.hscMapper import HscMapper
 
+# Share the workflow helpers kept with the rcHsc generators
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "rcHsc"))
+from clustering import chainLabel, fuse
+from daxWriter import makeADAG
+from getDataFile import getResolver
+from inputIndex import Data, loadInputIndex
+from pathTemplates import PathTemplateResolver
+from registryIndex import RawRegistryIndex
+from calibIndex import loadCalibAssignment
+
 logger = lsst.log.Log.getLogger("workflow")
 logger.setLevel(lsst.log.DEBUG)
 
@@ -31,6 +43,7 @@ def getDataFile(mapper, datasetType, dataId, create=False, repoRoot=None):
     Retrieve the file name/path through a CameraMapper instance
         and prepend outPath to it
     Optionally create new Pegasus File entries
+    Lookups are memoized by the shared resolver in rcHsc/getDataFile.py
 
     Parameters
     ----------
@@ -55,19 +68,43 @@ def getDataFile(mapper, datasetType, dataId, create=False, repoRoot=None):
     fileEntry:
         A Pegasus File entry or a LFN corresponding to an entry
     """
-    mapFunc = getattr(mapper, "map_" + datasetType)
-    butlerPath = mapFunc(dataId).getLocations()[0]
-    fileEntry = lfn = os.path.join(outPath, butlerPath)
+    resolver = getResolver(mapper, outPath, sites=("local", "lsstvc"))
+    return resolver.getDataFile(datasetType, dataId, create=create, repoRoot=repoRoot)
 
-    if create:
-        fileEntry = peg.File(lfn)
-        if repoRoot is not None:
-            filePath = os.path.join(repoRoot, butlerPath)
-            fileEntry.addPFN(peg.PFN(filePath, site="local"))
-            fileEntry.addPFN(peg.PFN(filePath, site="lsstvc"))
-            logger.info("%s %s: %s -> %s", datasetType, dataId, filePath, lfn)
 
-    return fileEntry
+def readInputData(path, tractDataId=0):
+    """Read the input data of the ci_hsc patch
+
+    Parameters
+    ----------
+    path: `str`
+        A pipe-delimited 'filter|patch|visit-ccd,...' file of one patch,
+        or an input index saved from one by inputIndex.py
+    tractDataId: `int`, optional
+        Tract of the patch
+
+    Returns
+    -------
+    allData: `dict`
+        The Data of each filter
+    allExposures: `dict`
+        allExposures[filterName][visit] is a list of the Data of the visit
+    patchDataId: `dict`
+        The tract and patch
+    """
+    inputs = loadInputIndex(path)
+    if len(inputs.allPatches) != 1:
+        raise RuntimeError("ci_hsc coadds one patch; %s has %s" % (path, inputs.allPatches))
+    patch = inputs.allPatches[0]
+    allData = {filterName: [Data(*visitCcd) for visitCcd in inputs.ccds(filterName, patch)]
+               for filterName in inputs.filters}
+
+    # Create "exposures" as in ci_hsc/SConstruct processCoadds
+    allExposures = {filterName: defaultdict(list) for filterName in allData}
+    for filterName in allData:
+        for data in allData[filterName]:
+            allExposures[filterName][data.visit].append(data)
+    return allData, allExposures, dict(tract=tractDataId, patch=patch)
 
 
 def preruns(dax):
@@ -170,17 +207,25 @@ def preruns(dax):
     dax.addJob(preForcedPhotCcd)
 
 
-def generateDax(name="dax"):
-    """Generate a Pegasus DAX abstract workflow"""
-    try:
-        from AutoADAG import AutoADAG
-    except ImportError:
-        dax = peg.ADAG(name)
-    else:
-        dax = AutoADAG(name)
+def generateDax(name="dax", fuseChains=False):
+    """Generate a Pegasus DAX abstract workflow
+
+    With fuseChains, assembleCoadd and detectCoaddSources of each coadd
+    are labelled to run as one job when planned with --cluster label.
+    """
+    dax = makeADAG(name)
 
     # Construct these mappers only for creating dax, not for actual runs.
     mapper = HscMapper(root=inputRepo, calibRoot=calibRepo)
+    # Assign bias/dark/flat to all visits at once instead of one
+    # calibRegistry lookup per processCcd input
+    registryIndex = RawRegistryIndex(os.path.join(inputRepo, "registry.sqlite3"))
+    calibAssignment = loadCalibAssignment(os.path.join(calibRepo, "calibRegistry.sqlite3"),
+                                          registryIndex, os.path.join(inputRepo, "registry.sqlite3"),
+                                          mapper=mapper)
+    getResolver(mapper, outPath, sites=("local", "lsstvc"),
+                pathResolver=PathTemplateResolver(mapper, verifySample=3, registryIndex=registryIndex,
+                                                  calibAssignment=calibAssignment))
 
     # Get the following butler or config files directly from ci_hsc package
     filePathMapper = os.path.join(inputRepo, "_mapper")
@@ -364,6 +409,8 @@ def generateDax(name="dax"):
         coadd = getDataFile(mapper, "deepCoadd", coaddId, create=True)
         dax.addFile(coadd)
         assembleCoadd.uses(coadd, link=peg.Link.OUTPUT)
+        if fuseChains:
+            fuse(assembleCoadd, chainLabel("coadd", coaddId))
         dax.addJob(assembleCoadd)
 
         # Pipeline: detectCoaddSources each coadd (per filter)
@@ -385,6 +432,8 @@ def generateDax(name="dax"):
             dax.addFile(outFile)
             detectCoaddSources.uses(outFile, link=peg.Link.OUTPUT)
 
+        if fuseChains:
+            fuse(detectCoaddSources, chainLabel("coadd", coaddId))
         dax.addJob(detectCoaddSources)
 
     # Pipeline: mergeCoaddDetections
@@ -552,20 +601,25 @@ def generateDax(name="dax"):
 
         dax.addJob(forcedPhotCcd)
 
+    getResolver(mapper, outPath, sites=("local", "lsstvc")).logStats(logger)
     return dax
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a DAX")
-    parser.add_argument("-i", "--inputData", default="ciHsc/inputData.py",
-                        help="a file including input data information")
+    parser.add_argument("-i", "--inputData", default="ciHsc/inputData",
+                        help="a file including input data information, or its .npz from inputIndex.py")
+    parser.add_argument("-t", "--tractId", type=int, default=0,
+                        help="the tract ID of the input file")
     parser.add_argument("-o", "--outputFile", type=str, default="ciHsc.dax",
                         help="file name for the output dax xml")
+    parser.add_argument("--fuse", action="store_true", default=False,
+                        help="run assembleCoadd and detectCoaddSources of each coadd as one job; "
+                        "plan with --cluster label")
     args = parser.parse_args()
-    with open(args.inputData) as f:
-        data = compile(f.read(), args.inputData, 'exec')
-        exec(data)
+    allData, allExposures, patchDataId = readInputData(args.inputData, args.tractId)
+    patchId = " ".join(("%s=%s" % (k, v) for k, v in patchDataId.iteritems()))
 
-    dax = generateDax("CiHscDax")
+    dax = generateDax("CiHscDax", fuseChains=args.fuse)
     with open(args.outputFile, "w") as f:
         dax.writeXML(f)
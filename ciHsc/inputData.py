@@ -1,74 +0,0 @@
-# Information of the raw data in ci_hsc
-# Excerpted from ci_hsc/SConstruct
-from collections import defaultdict
-from lsst.pipe.base import Struct
-
-
-class Data(Struct):
-    """Data we can process"""
-
-    def __init__(self, visit, ccd):
-        Struct.__init__(self, visit=visit, ccd=ccd)
-
-    @property
-    def name(self):
-        """Returns a suitable name for this data"""
-        return "%d-%d" % (self.visit, self.ccd)
-
-    @property
-    def dataId(self):
-        """Returns the dataId for this data"""
-        return dict(visit=self.visit, ccd=self.ccd)
-
-    def id(self, prefix="--id", tract=None):
-        """Returns a suitable --id command-line string"""
-        r = "%s visit=%d ccd=%d" % (prefix, self.visit, self.ccd)
-        if tract is not None:
-            r += " tract=%d" % tract
-        return r
-
-allData = {"HSC-R": [Data(903334, 16),
-                     Data(903334, 22),
-                     Data(903334, 23),
-                     Data(903334, 100),
-                     Data(903336, 17),
-                     Data(903336, 24),
-                     Data(903338, 18),
-                     Data(903338, 25),
-                     Data(903342, 4),
-                     Data(903342, 10),
-                     Data(903342, 100),
-                     Data(903344, 0),
-                     Data(903344, 5),
-                     Data(903344, 11),
-                     Data(903346, 1),
-                     Data(903346, 6),
-                     Data(903346, 12),
-                     ],
-           "HSC-I": [Data(903986, 16),
-                     Data(903986, 22),
-                     Data(903986, 23),
-                     Data(903986, 100),
-                     Data(904014, 1),
-                     Data(904014, 6),
-                     Data(904014, 12),
-                     Data(903990, 18),
-                     Data(903990, 25),
-                     Data(904010, 4),
-                     Data(904010, 10),
-                     Data(904010, 100),
-                     Data(903988, 16),
-                     Data(903988, 17),
-                     Data(903988, 23),
-                     Data(903988, 24),
-                     ],
-           }
-
-patchDataId = dict(tract=0, patch="5,4")
-patchId = " ".join(("%s=%s" % (k, v) for k, v in patchDataId.iteritems()))
-
-# Create "exposures" as in ci_hsc/SConstruct processCoadds
-allExposures = {filterName: defaultdict(list) for filterName in allData}
-for filterName in allData:
-    for data in allData[filterName]:
-        allExposures[filterName][data.visit].append(data)
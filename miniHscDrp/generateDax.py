@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 import argparse
 import os
+import sys
+from collections import defaultdict
 import Pegasus.DAX3 as peg
 
 import lsst.log
 import lsst.utils
 from lsst.obs.hsc.hscMapper import HscMapper
 
+# Share the workflow helpers kept with the rcHsc generators
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "rcHsc"))
+from clustering import chainLabel, fuse
+from daxWriter import makeADAG
+from getDataFile import getResolver
+from inputIndex import Data, loadInputIndex
+from pathTemplates import PathTemplateResolver
+from registryIndex import RawRegistryIndex
+from calibIndex import loadCalibAssignment
+
 logger = lsst.log.Log.getLogger("workflow")
 logger.setLevel(lsst.log.DEBUG)
 
@@ -31,6 +43,7 @@ def getDataFile(mapper, datasetType, dataId, create=False, repoRoot=None):
     Retrieve the file name/path through a CameraMapper instance
         and prepend outPath to it
     Optionally create new Pegasus File entries
+    Lookups are memoized by the shared resolver in rcHsc/getDataFile.py
 
     Parameters
     ----------
@@ -55,19 +68,45 @@ def getDataFile(mapper, datasetType, dataId, create=False, repoRoot=None):
     fileEntry:
         A Pegasus File entry or a LFN corresponding to an entry
     """
-    mapFunc = getattr(mapper, "map_" + datasetType)
-    butlerPath = mapFunc(dataId).getLocations()[0]
-    fileEntry = lfn = os.path.join(outPath, butlerPath)
+    resolver = getResolver(mapper, outPath, sites=("local", "lsstvc"))
+    return resolver.getDataFile(datasetType, dataId, create=create, repoRoot=repoRoot)
 
-    if create:
-        fileEntry = peg.File(lfn)
-        if repoRoot is not None:
-            filePath = os.path.join(repoRoot, butlerPath)
-            fileEntry.addPFN(peg.PFN(filePath, site="local"))
-            fileEntry.addPFN(peg.PFN(filePath, site="lsstvc"))
-            logger.info("%s %s: %s -> %s", datasetType, dataId, filePath, lfn)
 
-    return fileEntry
+def readInputData(path):
+    """Read the input data of the tract
+
+    Parameters
+    ----------
+    path: `str`
+        A pipe-delimited 'filter|patch|visit-ccd,...' file or an input
+        index saved from one by inputIndex.py
+
+    Returns
+    -------
+    inputs: `inputIndex.InputIndex`
+        The input CCDs of each patch and filter
+    allCcds: `dict`
+        The Data of each filter, needed by processCcd and forcedPhotCcd
+    skyMapping: `dict`
+        skyMapping[filterName][patch] is a list of Data, needed by
+        assembleCoadd and measureCoaddSources
+    allExposures: `dict`
+        allExposures[filterName][patch][visit] is a list of the Data of
+        the visit, needed by makeCoaddTempExp
+    """
+    inputs = loadInputIndex(path)
+    allCcds = {filterName: [Data(*visitCcd) for visitCcd in inputs.ccdsOfFilter(filterName)]
+               for filterName in inputs.filters}
+    skyMapping = {filterName: {patch: [Data(*visitCcd) for visitCcd in inputs.ccds(filterName, patch)]
+                               for patch in inputs.patchesOfFilter(filterName)}
+                  for filterName in inputs.filters}
+    allExposures = {filterName: {patch: defaultdict(list) for patch in skyMapping[filterName]}
+                    for filterName in skyMapping}
+    for filterName in skyMapping:
+        for patchDataId in skyMapping[filterName]:
+            for data in skyMapping[filterName][patchDataId]:
+                allExposures[filterName][patchDataId][data.visit].append(data)
+    return inputs, allCcds, skyMapping, allExposures
 
 
 def preruns(dax):
@@ -170,17 +209,25 @@ def preruns(dax):
     dax.addJob(preForcedPhotCcd)
 
 
-def generateDax(name="dax"):
-    """Generate a Pegasus DAX abstract workflow"""
-    try:
-        from AutoADAG import AutoADAG
-    except ImportError:
-        dax = peg.ADAG(name)
-    else:
-        dax = AutoADAG(name)
+def generateDax(name="dax", fuseChains=False):
+    """Generate a Pegasus DAX abstract workflow
+
+    With fuseChains, assembleCoadd and detectCoaddSources of each coadd
+    are labelled to run as one job when planned with --cluster label.
+    """
+    dax = makeADAG(name)
 
     # Construct these mappers only for creating dax, not for actual runs.
     mapper = HscMapper(root=inputRepo, calibRoot=calibRepo)
+    # Assign bias/dark/flat to all visits at once instead of one
+    # calibRegistry lookup per processCcd input
+    registryIndex = RawRegistryIndex(os.path.join(inputRepo, "registry.sqlite3"))
+    calibAssignment = loadCalibAssignment(os.path.join(calibRepo, "calibRegistry.sqlite3"),
+                                          registryIndex, os.path.join(inputRepo, "registry.sqlite3"),
+                                          mapper=mapper)
+    getResolver(mapper, outPath, sites=("local", "lsstvc"),
+                pathResolver=PathTemplateResolver(mapper, verifySample=3, registryIndex=registryIndex,
+                                                  calibAssignment=calibAssignment))
 
     # Get the following butler files directly from ci_hsc package
     filePathMapper = os.path.join(inputRepo, "_mapper")
@@ -365,6 +412,8 @@ def generateDax(name="dax"):
             coadd = getDataFile(mapper, "deepCoadd", coaddId, create=True)
             dax.addFile(coadd)
             assembleCoadd.uses(coadd, link=peg.Link.OUTPUT)
+            if fuseChains:
+                fuse(assembleCoadd, chainLabel("coadd", coaddId))
             dax.addJob(assembleCoadd)
 
             # Pipeline: detectCoaddSources each coadd (per patch per filter)
@@ -386,6 +435,8 @@ def generateDax(name="dax"):
                 dax.addFile(outFile)
                 detectCoaddSources.uses(outFile, link=peg.Link.OUTPUT)
 
+            if fuseChains:
+                fuse(detectCoaddSources, chainLabel("coadd", coaddId))
             dax.addJob(detectCoaddSources)
 
     # Pipeline: mergeCoaddDetections per patch
@@ -533,8 +584,10 @@ def generateDax(name="dax"):
 
             dax.addJob(forcedPhotCoadd)
 
-    # Pipeline: forcedPhotCcd for each ccd
+    # Pipeline: forcedPhotCcd for each ccd, with the patches it overlaps
+    # as its references, looked up in the inverted index of the inputs
     for data in sum(allCcds.itervalues(), []):
+        references = inputs.patchesOfCcd(data.visit, data.ccd)
         forcedPhotCcd = peg.Job(name="forcedPhotCcd")
         forcedPhotCcd.uses(mapperFile, link=peg.Link.INPUT)
         forcedPhotCcd.uses(registry, link=peg.Link.INPUT)
@@ -545,14 +598,14 @@ def generateDax(name="dax"):
             inFile = getDataFile(mapper, inputType, {}, create=False)
             forcedPhotCcd.uses(inFile, link=peg.Link.INPUT)
 
-        for patchDataId in references[data]:
+        for patchDataId in references:
             inFile = getDataFile(mapper, "deepCoadd_ref" , {'tract': tractDataId, 'patch':patchDataId}, create=False)
             forcedPhotCcd.uses(inFile, link=peg.Link.INPUT)
 
         forcedPhotCcd.uses(forcedPhotCcdConfig, link=peg.Link.INPUT)
         forcedPhotCcd.addArguments(outPath, "--output", outPath, " --doraise",
                                    "-C", forcedPhotCcdConfig, data.id(tract=tractDataId))
-        logger.debug("forcedPhotCcd %s with reference patches %s", data.id(tract=0), references[data])
+        logger.debug("forcedPhotCcd %s with reference patches %s", data.id(tract=0), references)
 
         logForcedPhotCcd = peg.File("logForcedPhotCcd.%s" % data.name)
         dax.addFile(logForcedPhotCcd)
@@ -566,20 +619,26 @@ def generateDax(name="dax"):
 
         dax.addJob(forcedPhotCcd)
 
+    getResolver(mapper, outPath, sites=("local", "lsstvc")).logStats(logger)
     return dax
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a DAX")
-    parser.add_argument("-i", "--inputData", default="miniHscDrp/inputData.py",
-                        help="a file including input data information")
+    parser.add_argument("-i", "--inputData", default="miniHscDrp/inputData",
+                        help="a file including input data information, or its .npz from inputIndex.py")
+    parser.add_argument("-t", "--tractId", type=int, default=0,
+                        help="the tract ID of the input file")
     parser.add_argument("-o", "--outputFile", type=str, default="miniHscDrp.dax",
                         help="file name for the output dax xml")
+    parser.add_argument("--fuse", action="store_true", default=False,
+                        help="run assembleCoadd and detectCoaddSources of each coadd as one job; "
+                        "plan with --cluster label")
     args = parser.parse_args()
-    with open(args.inputData) as f:
-        data = compile(f.read(), args.inputData, 'exec')
-        exec(data)
+    inputs, allCcds, skyMapping, allExposures = readInputData(args.inputData)
+    tractDataId = args.tractId
+    allPatches = inputs.allPatches
 
-    dax = generateDax("MiniHscDax")
+    dax = generateDax("MiniHscDax", fuseChains=args.fuse)
     with open(args.outputFile, "w") as f:
         dax.writeXML(f)
@@ -3,13 +3,15 @@
 DIR=$(cd $(dirname $0) && pwd)
 
 if [ $# -lt 1 ]; then
-    echo "Usage: $0 DAXFILE [SITE] [TCFILE]"
+    echo "Usage: $0 DAXFILE [SITE] [TCFILE] [CLUSTER]"
     exit 1
 fi
 
 DAXFILE=$1
 SITE=${2:-"lsstvc"}
 TCFILE=${3:-"tc.txt"}
+# e.g. "horizontal" for DAXes made with --clusterRuntime
+CLUSTER=$4
 echo "Planning Pegasus with $DAXFILE and $TCFILE on $SITE"
 
 # This command tells Pegasus to plan the workflow contained in 
@@ -24,4 +26,5 @@ pegasus-plan \
     --output-dir $DIR/output \
     --dir $DIR/submit \
     --dax $DAXFILE \
+    ${CLUSTER:+--cluster $CLUSTER} \
     --submit 
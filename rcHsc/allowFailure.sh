@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# DAGMan POST script letting a node succeed once its retries are used up,
+# so that its children run with whatever the other nodes produced
+#   allowFailure.sh $RETURN $RETRY $MAX_RETRIES
+
+RETURN=$1
+RETRY=${2:-0}
+MAX_RETRIES=${3:-0}
+
+if [ "$RETURN" -ne 0 ] && [ "$RETRY" -lt "$MAX_RETRIES" ]; then
+    exit $RETURN
+fi
+if [ "$RETURN" -ne 0 ]; then
+    echo "Ignoring exit code $RETURN after $RETRY retries"
+fi
+exit 0
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Compare memory and time of the DAX3-object and compact job graph modes
+
+Each mode generates and writes the rcHsc SFM and coadd DAXes in its own
+process, so that the peak resident memory is that of the mode alone.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from generateDaxSfm import generateSfmDax
+from generateDaxCoadd import generateCoaddDax, readBlacklist, readInputData
+from daxWriter import writeDax
+
+MODES = ("adag", "compact")
+
+
+def _run(queue, workflow, mode, outputFile, args):
+    start = time.time()
+    if workflow == "sfm":
+        with open(args.visits) as f:
+            visits = [line.rstrip() for line in f]
+        ccdList = list(range(9)) + list(range(10, 104))
+        dax = generateSfmDax("HscSfmDax", visits, ccdList, compact=(mode == "compact"))
+    else:
+        blacklist = readBlacklist(args.blacklist)
+        dataDict = readInputData(args.coaddData, blacklist)
+        dax = generateCoaddDax("HscCoaddDax", args.tractId, dataDict, blacklist=blacklist, doMosaic=True,
+                               compact=(mode == "compact"))
+    generated = time.time()
+    writeDax(dax, outputFile)
+    written = time.time()
+    queue.put(dict(generate=generated - start, write=written - generated,
+                   maxRss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def runMode(workflow, mode, outputFile, args):
+    """Generate one workflow in one mode in a new process and return its timings"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(queue, workflow, mode, outputFile, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def daxContent(path):
+    """Return the sorted lines of a DAX without its comments
+
+    The order of <file> elements is not defined, so the lines are
+    compared as a multiset.
+    """
+    with open(path) as f:
+        return sorted(line for line in f if not line.startswith("<!--"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the compact job graph")
+    parser.add_argument("--visits", default="rcHsc/visitsRcTest.txt",
+                        help="visits of the SFM workflow")
+    parser.add_argument("-t", "--tractId", type=int, default=8766,
+                        help="the tract ID of the coadd input file")
+    parser.add_argument("--coaddData", default="rcHsc/smallFPVC_t8766",
+                        help="input data of the coadd workflow")
+    parser.add_argument("-b", "--blacklist", default="rcHsc/rcBlacklist.txt",
+                        help="a file including visit-ccd to ignore")
+    parser.add_argument("--workflows", nargs="+", default=["sfm", "coadd"], choices=["sfm", "coadd"])
+    args = parser.parse_args()
+
+    tmpDir = tempfile.mkdtemp()
+    differ = []
+    print("%-6s %-8s %10s %10s %12s" % ("dax", "mode", "generate", "write", "maxRss[MB]"))
+    for workflow in args.workflows:
+        outputs = {}
+        for mode in MODES:
+            outputs[mode] = os.path.join(tmpDir, "%s_%s.dax" % (workflow, mode))
+            result = runMode(workflow, mode, outputs[mode], args)
+            print("%-6s %-8s %9.1fs %9.1fs %12.1f" % (workflow, mode, result["generate"], result["write"],
+                                                      result["maxRss"]/1024.0))
+        same = all(daxContent(outputs[mode]) == daxContent(outputs[MODES[0]]) for mode in MODES[1:])
+        print("%-6s outputs %s" % (workflow, "match" if same else "DIFFER"))
+        if not same:
+            differ.append(workflow)
+    if differ:
+        sys.exit("The modes write different DAXes for %s" % ", ".join(differ))
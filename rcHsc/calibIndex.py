@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+import os
+import sqlite3
+import sys
+from collections import defaultdict
+import numpy as np
+import lsst.log
+
+logger = lsst.log.Log.getLogger("calibIndex")
+logger.setLevel(lsst.log.INFO)
+
+# Calibration types with a table in calibRegistry.sqlite3, and the raw
+# registry columns a calib must match besides its validity range, used
+# when the mapper does not say.
+# bfKernel has no registry table; its path does not depend on the visit.
+CALIB_MATCH_COLUMNS = {
+    "bias": ["ccd"],
+    "dark": ["ccd"],
+    "flat": ["ccd", "filter"],
+    "fringe": ["ccd", "filter"],
+}
+
+
+def calibMatchRules(mapper=None, calibTypes=CALIB_MATCH_COLUMNS):
+    """Return how the raws of each calib type are matched to calibs
+
+    The rules are read from the CalibrationMapping of each type in
+    mapper.calibrations, so that the assignment is the one map_* makes:
+    the raw registry column compared with the validity range, the calib
+    table columns of that range and the columns that must be equal.
+
+    Parameters
+    ----------
+    mapper: `lsst.obs.base.CameraMapper`, optional
+        Mapper of the calibs; without it, calibTypes is used with dateObs
+    calibTypes: `dict`, optional
+        Calib types mapped to the raw columns they must match, used for
+        the types the mapper does not describe
+
+    Returns
+    -------
+    rules: `dict`
+        For each calib type, (matchColumns, obsTimeName, validStartName,
+        validEndName)
+    """
+    mappings = getattr(mapper, "calibrations", {}) if mapper is not None else {}
+    rules = {}
+    for calibType, matchColumns in calibTypes.items():
+        mapping = mappings.get(calibType)
+        obsTimeName = getattr(mapping, "obsTimeName", None) or "dateObs"
+        validRange = getattr(mapping, "range", None)
+        validStartName, validEndName = validRange[1:] if validRange else ("validStart", "validEnd")
+        columns = getattr(mapping, "columns", None)
+        if columns:
+            matchColumns = [col for col in columns if col not in (obsTimeName, validStartName, validEndName)]
+        rules[calibType] = (list(matchColumns), obsTimeName, validStartName, validEndName)
+    return rules
+
+
+def registryFingerprint(*paths):
+    """Identify the state of registry files by their size and mtime"""
+    return ";".join("%s:%d:%d" % (path, os.path.getsize(path), int(os.path.getmtime(path)))
+                    for path in paths)
+
+
+def _assignIntervals(rawKeys, obsTime, calibKeys, validStart, validEnd):
+    """Assign to each raw row the calib row whose validity covers its date
+
+    Calib rows are grouped into one interval index per match key, sorted
+    by validStart; each group of raw rows with the same key is then
+    resolved with one searchsorted.  Dates are compared as strings, the
+    same way SQLite compares them in the registry lookup.
+
+    Returns
+    -------
+    index: `numpy.ndarray`
+        Calib row index for each raw row, or -1 if none is valid
+    """
+    result = np.full(len(obsTime), -1, dtype=np.int64)
+    calibGroups = defaultdict(list)
+    for i, key in enumerate(calibKeys):
+        calibGroups[key].append(i)
+    rawGroups = defaultdict(list)
+    for i, key in enumerate(rawKeys):
+        rawGroups[key].append(i)
+
+    for key, rawRows in rawGroups.items():
+        calibRows = calibGroups.get(key)
+        if calibRows is None:
+            continue
+        calibRows = np.array(calibRows)
+        calibRows = calibRows[np.argsort(validStart[calibRows], kind="mergesort")]
+        rawRows = np.array(rawRows)
+        obs = obsTime[rawRows]
+        pos = np.searchsorted(validStart[calibRows], obs, side="right") - 1
+        found = pos >= 0
+        found[found] &= validEnd[calibRows[pos[found]]] >= obs[found]
+        result[rawRows[found]] = calibRows[pos[found]]
+    return result
+
+
+class CalibAssignment(object):
+    """Table of the calibration files of every visit and ccd
+
+    Built in one pass from calibRegistry.sqlite3 and a RawRegistryIndex,
+    replacing the validity-range lookup that CalibrationMapping does for
+    every bias/dark/flat/fringe of every processCcd job.  The table can
+    be saved and reloaded as long as both registries are unchanged.
+
+    Parameters
+    ----------
+    visit, ccd: `numpy.ndarray`
+        The visit and ccd of each row
+    assigned: `dict`
+        For each calib type, the calib row index of each visit/ccd row
+    calibColumns: `dict`
+        For each calib type, a dict of the calib table columns
+    fingerprint: `str`, optional
+        State of the registries the table was made from
+    """
+
+    def __init__(self, visit, ccd, assigned, calibColumns, fingerprint=""):
+        self.visit = visit
+        self.ccd = ccd
+        self.assigned = assigned
+        self.calibColumns = calibColumns
+        self.fingerprint = fingerprint
+        self._rows = {key: i for i, key in enumerate(zip(visit.tolist(), ccd.tolist()))}
+
+    @property
+    def calibTypes(self):
+        return list(self.assigned.keys())
+
+    @classmethod
+    def fromRegistry(cls, calibRegistryPath, registryIndex, visits=None, rules=None, fingerprint=""):
+        """Load the calib registry and assign calibs to all raw rows
+
+        Parameters
+        ----------
+        calibRegistryPath: `str`
+            Path of calibRegistry.sqlite3
+        registryIndex: `registryIndex.RawRegistryIndex`
+            The preloaded raw registry
+        visits: `list`, optional
+            Only assign calibs for these visits
+        rules: `dict`, optional
+            The matching of each calib type from `calibMatchRules`;
+            CALIB_MATCH_COLUMNS and dateObs by default
+        """
+        if rules is None:
+            rules = calibMatchRules()
+        raw = registryIndex.columns
+        select = np.ones(len(raw["visit"]), dtype=bool)
+        if visits is not None:
+            select = np.in1d(raw["visit"], np.array([int(v) for v in visits]))
+        visit = raw["visit"][select]
+        ccd = raw["ccd"][select]
+
+        conn = sqlite3.connect(calibRegistryPath)
+        if sys.version_info[0] < 3:
+            conn.text_factory = str
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+        assigned = {}
+        calibColumns = {}
+        for calibType, (matchColumns, obsTimeName, validStartName, validEndName) in rules.items():
+            if calibType not in tables:
+                logger.info("No %s table in %s", calibType, calibRegistryPath)
+                continue
+            names = [row[1] for row in conn.execute("PRAGMA table_info(%s)" % calibType)]
+            rows = conn.execute("SELECT %s FROM %s" % (", ".join(names), calibType)).fetchall()
+            table = {name: np.array(column) for name, column in zip(names, zip(*rows))} if rows else {}
+            if not table:
+                continue
+            if obsTimeName not in raw:
+                raise RuntimeError("The raw registry index has no %s column to match %s with" %
+                                   (obsTimeName, calibType))
+            obsTime = raw[obsTimeName][select].astype(str)
+            unknown = [col for col in matchColumns if col not in raw or col not in table]
+            if unknown:
+                raise RuntimeError("Cannot match %s on %s: not in both registries" % (calibType, unknown))
+            rawKeys = list(zip(*[raw[col][select].tolist() for col in matchColumns]))
+            calibKeys = list(zip(*[table[col].tolist() for col in matchColumns]))
+            assigned[calibType] = _assignIntervals(rawKeys, obsTime, calibKeys,
+                                                   table[validStartName].astype(str),
+                                                   table[validEndName].astype(str))
+            # The range columns are not copied into the dataId
+            calibColumns[calibType] = {name: table[name] for name in names
+                                       if name not in ("id", validStartName, validEndName)}
+            missing = (assigned[calibType] < 0).sum()
+            if missing:
+                logger.warn("No valid %s for %d of %d visit/ccd", calibType, missing, len(visit))
+        conn.close()
+        logger.info("Assigned %s calibs to %d visit/ccd", sorted(assigned), len(visit))
+        return cls(visit, ccd, assigned, calibColumns, fingerprint=fingerprint)
+
+    @classmethod
+    def load(cls, path, fingerprint=None):
+        """Load a table saved by `save`; return None if missing or stale"""
+        if not os.path.exists(path):
+            return None
+        data = np.load(path, allow_pickle=True)
+        if fingerprint is not None and str(data["fingerprint"]) != fingerprint:
+            logger.info("Calib table %s is stale; rebuilding it", path)
+            return None
+        assigned = {}
+        calibColumns = defaultdict(dict)
+        for key in data.files:
+            if key.count(".") != 1:
+                continue
+            calibType, name = key.split(".")
+            if name == "index":
+                assigned[calibType] = data[key]
+            else:
+                calibColumns[calibType][name] = data[key]
+        return cls(data["visit"], data["ccd"], assigned, dict(calibColumns),
+                   fingerprint=str(data["fingerprint"]))
+
+    def save(self, path):
+        """Save the table so that later runs can reuse it"""
+        arrays = dict(visit=self.visit, ccd=self.ccd, fingerprint=np.array(self.fingerprint))
+        for calibType in self.assigned:
+            arrays["%s.index" % calibType] = self.assigned[calibType]
+            for name, column in self.calibColumns[calibType].items():
+                arrays["%s.%s" % (calibType, name)] = column
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    def fillDataId(self, calibType, dataId, names):
+        """Return a copy of dataId completed with the values of its calib
+
+        Returns None if the table cannot provide them.
+        """
+        if calibType not in self.assigned or "visit" not in dataId or "ccd" not in dataId:
+            return None
+        row = self._rows.get((int(dataId["visit"]), int(dataId["ccd"])))
+        if row is None:
+            return None
+        index = self.assigned[calibType][row]
+        columns = self.calibColumns[calibType]
+        if index < 0 or any(name not in columns for name in names):
+            return None
+        newId = dict(dataId)
+        for name in names:
+            newId[name] = columns[name][index].item()
+        return newId
+
+
+def loadCalibAssignment(calibRegistryPath, registryIndex, registryPath, cachePath=None, visits=None,
+                        mapper=None):
+    """Return a CalibAssignment, reusing the one saved at cachePath if current
+
+    The calibs are matched to the raws as the CalibrationMappings of
+    mapper do, see `calibMatchRules`.
+    """
+    rules = calibMatchRules(mapper)
+    fingerprint = "%s;%s" % (registryFingerprint(calibRegistryPath, registryPath), sorted(rules.items()))
+    if cachePath is not None:
+        table = CalibAssignment.load(cachePath, fingerprint=fingerprint)
+        if table is not None and (visits is None or
+                                  np.in1d(np.array([int(v) for v in visits]), table.visit).all()):
+            logger.info("Reusing calib table %s", cachePath)
+            return table
+    table = CalibAssignment.fromRegistry(calibRegistryPath, registryIndex, visits=visits, rules=rules,
+                                         fingerprint=fingerprint)
+    if cachePath is not None:
+        table.save(cachePath)
+    return table
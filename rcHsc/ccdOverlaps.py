@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""Compute the CCDs overlapping each patch of a tract
+
+This makes the input data of generateDaxCoadd.py, e.g. rcFPVC_8766,
+from the skymap and the bbox and WCS in the CCD headers.  Only the
+headers are read, over a pool of processes; the corners of all CCDs
+are then projected into the pixel frame of the tract in one pass and
+tested against the patch grid all at once.
+"""
+import argparse
+import multiprocessing
+import os
+
+import numpy as np
+import lsst.afw.geom as afwGeom
+import lsst.daf.persistence as dafPersist
+import lsst.log
+from findShardId import coordsToVectors, getExposureBBoxWcs, getSkyMap
+from inputIndex import InputIndex
+from registryIndex import RawRegistryIndex
+
+logger = lsst.log.Log.getLogger("ccdOverlaps")
+logger.setLevel(lsst.log.INFO)
+
+# Corners this close to 90 degrees from the tract center are not
+# projected; such CCDs cannot overlap the tract
+_MIN_DEPTH = 0.1
+
+
+def _gnomonic(vectors, center):
+    """Project unit vectors on the plane tangent at center
+
+    Returns the plane coordinates, shape (..., 2), and the cosine of the
+    distance to center of each vector.
+    """
+    pole = np.array([0.0, 0.0, 1.0]) if abs(center[2]) < 0.9 else np.array([1.0, 0.0, 0.0])
+    east = np.cross(pole, center)
+    east /= np.linalg.norm(east)
+    north = np.cross(center, east)
+    depth = np.dot(vectors, center)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        plane = np.stack([np.dot(vectors, east) / depth, np.dot(vectors, north) / depth], axis=-1)
+    return plane, depth
+
+
+class TractProjection(object):
+    """Vectorized projection of unit vectors into the pixel frame of a tract
+
+    The tract WCS is a gnomonic projection about the tract center, so
+    its pixel coordinates are an affine function of the tangent plane
+    coordinates at that center.  The affine map is fitted to the WCS at
+    a grid of points of the tract, once, and applied to any number of
+    vectors with one matrix product.
+
+    Parameters
+    ----------
+    tractInfo: lsst.skymap.TractInfo
+        The tract
+    nGrid: `int`, optional
+        Number of fit points along each side of the tract
+    """
+
+    def __init__(self, tractInfo, nGrid=5):
+        self.center = coordsToVectors([tractInfo.getCtrCoord()])[0]
+        bbox = afwGeom.Box2D(tractInfo.getBBox())
+        wcs = tractInfo.getWcs()
+        pixels = np.array([(x, y) for x in np.linspace(bbox.getMinX(), bbox.getMaxX(), nGrid)
+                           for y in np.linspace(bbox.getMinY(), bbox.getMaxY(), nGrid)])
+        vectors = coordsToVectors([wcs.pixelToSky(afwGeom.Point2D(x, y)) for x, y in pixels])
+        plane, _ = _gnomonic(vectors, self.center)
+        design = np.hstack([plane, np.ones((len(plane), 1))])
+        self.affine = np.linalg.lstsq(design, pixels, rcond=-1)[0]
+        residual = np.abs(design.dot(self.affine) - pixels).max()
+        if residual > 0.01:
+            logger.warn("Tract %s WCS is not gnomonic: %.3g pixel fit residual", tractInfo.getId(), residual)
+
+    def toPixels(self, vectors):
+        """Return the tract pixel coordinates of unit vectors, shape (..., 2)
+
+        Vectors too far from the tract to be projected get NaN.
+        """
+        plane, depth = _gnomonic(vectors, self.center)
+        pixels = plane.dot(self.affine[:2]) + self.affine[2]
+        pixels[depth < _MIN_DEPTH] = np.nan
+        return pixels
+
+
+def _boxArray(box):
+    box = afwGeom.Box2D(box)
+    return box.getMinX(), box.getMinY(), box.getMaxX(), box.getMaxY()
+
+
+def patchGrid(tractInfo):
+    """Return the patches of a tract with their bboxes as arrays
+
+    Returns
+    -------
+    names: `list` of `str`
+        Patch IDs like "4,5", x index first
+    indices: `numpy.ndarray`
+        The (x, y) index of each patch, shape (nPatch, 2)
+    inner, outer: `numpy.ndarray`
+        (minX, minY, maxX, maxY) of the inner and outer bbox of each
+        patch, in tract pixels, shape (nPatch, 4)
+    """
+    numPatches = tractInfo.getNumPatches()
+    indices = np.array([(x, y) for x in range(numPatches[0]) for y in range(numPatches[1])])
+    inner = np.empty((len(indices), 4))
+    outer = np.empty((len(indices), 4))
+    for i, index in enumerate(indices):
+        patchInfo = tractInfo.getPatchInfo(tuple(index))
+        inner[i] = _boxArray(patchInfo.getInnerBBox())
+        outer[i] = _boxArray(patchInfo.getOuterBBox())
+    return ["%d,%d" % tuple(index) for index in indices], indices, inner, outer
+
+
+def quadsOverlapBoxes(quads, boxes):
+    """Return whether each quadrilateral overlaps its box
+
+    This is the separating axis theorem with the box axes and the edge
+    normals of the quadrilateral, vectorized over all pairs.
+
+    Parameters
+    ----------
+    quads: `numpy.ndarray`
+        Corners in order around each quadrilateral, shape (n, 4, 2)
+    boxes: `numpy.ndarray`
+        (minX, minY, maxX, maxY) of each box, shape (n, 4)
+    """
+    overlap = ((quads.min(axis=1) <= boxes[:, 2:]) & (quads.max(axis=1) >= boxes[:, :2])).all(axis=1)
+    edges = np.roll(quads, -1, axis=1) - quads
+    normals = np.stack([-edges[..., 1], edges[..., 0]], axis=-1)
+    boxCorners = np.stack([boxes[:, [0, 1]], boxes[:, [2, 1]], boxes[:, [2, 3]], boxes[:, [0, 3]]], axis=1)
+    quadProj = np.einsum("pkd,pjd->pkj", normals, quads)
+    boxProj = np.einsum("pkd,pjd->pkj", normals, boxCorners)
+    separated = ((boxProj.max(axis=2) < quadProj.min(axis=2)) |
+                 (quadProj.max(axis=2) < boxProj.min(axis=2))).any(axis=1)
+    return overlap & ~separated
+
+
+def findOverlaps(corners, indices, inner, outer):
+    """Find the overlapping pairs of CCD outlines and patches
+
+    Candidate pairs come from the bbox of each CCD and the regular
+    patch grid; each one is then tested exactly with the separating
+    axis theorem on the CCD quadrilateral and the patch outer bbox.
+
+    Parameters
+    ----------
+    corners: `numpy.ndarray`
+        The corners of each CCD in order around it, in tract pixels,
+        shape (nCcd, 4, 2); CCDs with a NaN corner overlap nothing
+    indices, inner, outer: `numpy.ndarray`
+        The patch grid from `patchGrid`
+
+    Returns
+    -------
+    ccdRows, patchRows: `numpy.ndarray`
+        The CCD and patch of each overlapping pair
+    """
+    valid = np.isfinite(corners).all(axis=(1, 2))
+    ccdRows = np.nonzero(valid)[0]
+    lo = corners[ccdRows].min(axis=1)
+    hi = corners[ccdRows].max(axis=1)
+
+    # The inner bboxes of the patches tile the tract with a step of the
+    # first one; the outer bboxes reach at most border beyond them
+    numPatches = indices.max(axis=0) + 1
+    origin = inner[:, :2].min(axis=0)
+    step = inner[0, 2:] - inner[0, :2]
+    border = np.maximum(inner[:, :2] - outer[:, :2], outer[:, 2:] - inner[:, 2:]).max(axis=0)
+    first = np.clip(np.ceil((lo - border - origin) / step) - 1, 0, numPatches).astype(np.int64)
+    last = np.clip(np.floor((hi + border - origin) / step), -1, numPatches - 1).astype(np.int64)
+    span = np.maximum(last - first + 1, 0)
+    counts = span[:, 0]*span[:, 1]
+
+    # Expand each CCD to its candidate patches
+    pairCcd = np.repeat(np.arange(len(ccdRows)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pairX = first[pairCcd, 0] + offset // span[pairCcd, 1]
+    pairY = first[pairCcd, 1] + offset % span[pairCcd, 1]
+    pairPatch = pairX*numPatches[1] + pairY
+
+    overlap = quadsOverlapBoxes(corners[ccdRows][pairCcd], outer[pairPatch])
+    return ccdRows[pairCcd[overlap]], pairPatch[overlap]
+
+
+# Per-process state of the header reading workers
+_worker = {}
+
+
+def _initWorker(root, calibRoot, expType):
+    _worker["butler"] = dafPersist.Butler(root=root, calibRoot=calibRoot)
+    _worker["expType"] = expType
+
+
+def _ccdCorners(butler, expId, expType):
+    bbox, wcs = getExposureBBoxWcs(butler, expId, expType)
+    return coordsToVectors([wcs.pixelToSky(corner) for corner in afwGeom.Box2D(bbox).getCorners()])
+
+
+def _workerCorners(expId):
+    return _ccdCorners(_worker["butler"], expId, _worker["expType"])
+
+
+def readCcdCorners(root, expIds, calibRoot=None, expType="raw", processes=1, butler=None):
+    """Read the sky corners of CCDs from their headers
+
+    Returns
+    -------
+    corners: `numpy.ndarray`
+        Unit vectors of the bbox corners of each CCD, in order around
+        it, shape (nCcd, 4, 3)
+    """
+    logger.info("Reading the WCS of %d CCDs with %d processes", len(expIds), processes)
+    if processes > 1 and len(expIds) > 1:
+        pool = multiprocessing.Pool(processes, initializer=_initWorker, initargs=(root, calibRoot, expType))
+        try:
+            corners = pool.map(_workerCorners, expIds, chunksize=max(1, len(expIds) // (4*processes)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        if butler is None:
+            butler = dafPersist.Butler(root=root, calibRoot=calibRoot)
+        corners = [_ccdCorners(butler, expId, expType) for expId in expIds]
+    return np.array(corners).reshape(len(expIds), 4, 3)
+
+
+def computeOverlaps(root, tract, visits, ccdList, skyMapRoot=None, calibRoot=None, expType="raw",
+                    processes=1):
+    """Compute the input data of a tract from the CCD headers
+
+    Parameters
+    ----------
+    root: `str`
+        Butler repo with the raw registry and the exposures
+    tract: `int`
+        Tract ID
+    visits: `list`
+        Visits to consider
+    ccdList: `list` of `int`
+        CCDs to consider in each visit, if in the registry
+    skyMapRoot: `str`, optional
+        Repo of the deepCoadd_skyMap, by default root
+    calibRoot: `str`, optional
+        Butler calib root
+    expType: `str`, optional
+        "raw" for the telescope WCS, or "calexp" for the fitted one
+    processes: `int`, optional
+        Number of processes reading headers
+
+    Returns
+    -------
+    inputs: `inputIndex.InputIndex`
+        The CCDs overlapping each patch in each filter, ordered by
+        filter, patch, visit and ccd
+    """
+    registryIndex = RawRegistryIndex(os.path.join(root, "registry.sqlite3"))
+    expIds = [dict(visit=int(visit), ccd=ccd) for visit in visits
+              for ccd in ccdList if (int(visit), ccd) in registryIndex]
+    butler = dafPersist.Butler(root=root, calibRoot=calibRoot)
+    skyMapButler = butler if skyMapRoot is None else dafPersist.Butler(skyMapRoot)
+    tractInfo = getSkyMap(skyMapButler)[tract]
+
+    corners = readCcdCorners(root, expIds, calibRoot=calibRoot, expType=expType, processes=processes,
+                             butler=butler)
+    names, indices, inner, outer = patchGrid(tractInfo)
+    ccdRows, patchRows = findOverlaps(TractProjection(tractInfo).toPixels(corners), indices, inner, outer)
+
+    visitArray = np.array([expId["visit"] for expId in expIds], dtype=np.int64)[ccdRows]
+    ccdArray = np.array([expId["ccd"] for expId in expIds], dtype=np.int32)[ccdRows]
+    visitFilters = {visit: registryIndex.getFilter(visit) for visit in set(visitArray.tolist())}
+    filters = sorted(set(visitFilters.values()))
+    filterIndex = {filterName: i for i, filterName in enumerate(filters)}
+    filterIds = np.array([filterIndex[visitFilters[visit]] for visit in visitArray.tolist()], dtype=np.int32)
+    order = np.lexsort((ccdArray, visitArray, patchRows, filterIds))
+    logger.info("Tract %d: %d of %d CCDs overlap %d patches", tract, len(np.unique(ccdRows)), len(expIds),
+                len(np.unique(patchRows)))
+    return InputIndex(filters, names, filterIds[order], patchRows[order], visitArray[order], ccdArray[order])
+
+
+def findTractCcds(root, tract, visits, ccdList, margin=0, skyMapRoot=None, calibRoot=None, expType="raw",
+                  processes=1):
+    """Return the CCDs of visits overlapping a tract
+
+    Parameters
+    ----------
+    margin: `float`, optional
+        Grow the tract bbox by this many tract pixels
+    others:
+        As in `computeOverlaps`
+
+    Returns
+    -------
+    ccds: `set` of `tuple`
+        (visit, ccd) of the CCDs within margin of the tract bbox
+    """
+    registryIndex = RawRegistryIndex(os.path.join(root, "registry.sqlite3"))
+    expIds = [dict(visit=int(visit), ccd=ccd) for visit in visits
+              for ccd in ccdList if (int(visit), ccd) in registryIndex]
+    butler = dafPersist.Butler(root=root, calibRoot=calibRoot)
+    skyMapButler = butler if skyMapRoot is None else dafPersist.Butler(skyMapRoot)
+    tractInfo = getSkyMap(skyMapButler)[tract]
+
+    corners = readCcdCorners(root, expIds, calibRoot=calibRoot, expType=expType, processes=processes,
+                             butler=butler)
+    pixels = TractProjection(tractInfo).toPixels(corners)
+    valid = np.isfinite(pixels).all(axis=(1, 2))
+    box = np.array(_boxArray(tractInfo.getBBox())) + np.array([-margin, -margin, margin, margin])
+    overlap = np.zeros(len(expIds), dtype=bool)
+    overlap[valid] = quadsOverlapBoxes(pixels[valid], np.tile(box, (valid.sum(), 1)))
+    logger.info("Tract %d: %d of %d CCDs within %s pixels", tract, overlap.sum(), len(expIds), margin)
+    return {(expId["visit"], expId["ccd"]) for expId, inTract in zip(expIds, overlap) if inTract}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute the input data of a tract from the CCD headers")
+    parser.add_argument("-t", "--tractId", type=int, default=8766, help="the tract ID")
+    parser.add_argument("-v", "--visits", default="rcHsc/visitsRcWide.txt",
+                        help="a file of the visits to consider")
+    parser.add_argument("-o", "--outputFile", default="rcFPVC_8766",
+                        help="input data file to write, pipe-delimited or .npz")
+    parser.add_argument("--root", default="/datasets/hsc/repo",
+                        help="repo with the raw registry and the exposures")
+    parser.add_argument("--skyMapRepo", default="/project/hsc_rc/w_2017_28/DM-11184/",
+                        help="repo with the deepCoadd_skyMap")
+    parser.add_argument("--expType", choices=("raw", "calexp"), default="raw",
+                        help="read the WCS of the raw or the calexp headers")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of processes reading headers")
+    args = parser.parse_args()
+    with open(args.visits) as f:
+        visits = [line.strip() for line in f if line.strip()]
+
+    ccdList = range(9) + range(10, 104)
+    inputs = computeOverlaps(args.root, args.tractId, visits, ccdList, skyMapRoot=args.skyMapRepo,
+                             expType=args.expType, processes=args.processes)
+    if args.outputFile.endswith(".npz"):
+        inputs.save(args.outputFile)
+    else:
+        inputs.writePipeFile(args.outputFile)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+from collections import defaultdict
+
+import numpy as np
+import Pegasus.DAX3 as peg
+import lsst.log
+
+logger = lsst.log.Log.getLogger("clustering")
+logger.setLevel(lsst.log.INFO)
+
+# Rough runtime in seconds of a job as base + perInput * number of inputs,
+# e.g. the CCDs makeCoaddTempExp warps or the filters a merge job reads
+DEFAULT_RUNTIMES = {
+    "makeCoaddTempExp": (20.0, 10.0),
+    "mergeCoaddDetections": (30.0, 5.0),
+    "mergeCoaddMeasurements": (30.0, 10.0),
+}
+
+
+def loadRuntimeStats(path):
+    """Fit the runtime model of each transformation to past runs
+
+    Parameters
+    ----------
+    path: `str`
+        Text file of 'transformation nInputs seconds' lines, one per job
+        of a past run, e.g. from the pegasus-statistics job breakdown
+
+    Returns
+    -------
+    runtimes: `dict`
+        (base, perInput) of each transformation in the file; perInput is
+        0 if all its jobs had the same number of inputs
+    """
+    samples = defaultdict(list)
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            name, nInputs, seconds = line.split()
+            samples[name].append((int(nInputs), float(seconds)))
+
+    runtimes = {}
+    for name, values in samples.items():
+        nInputs, seconds = np.array(values).T
+        if len(set(nInputs)) > 1:
+            perInput, base = np.polyfit(nInputs, seconds, 1)
+            runtimes[name] = (max(base, 0.0), max(perInput, 0.0))
+        else:
+            runtimes[name] = (seconds.mean(), 0.0)
+        logger.info("%s: %.1fs + %.1fs per input from %d jobs", name, runtimes[name][0],
+                    runtimes[name][1], len(values))
+    return runtimes
+
+
+class RuntimeClusterer(object):
+    """Mark short jobs for runtime-balanced horizontal clustering
+
+    Each job of a clustered transformation gets its estimated runtime as
+    the pegasus "runtime" profile and maxRuntime as "clusters.maxruntime".
+    Planned with --cluster horizontal, Pegasus then bundles jobs of the
+    same transformation and level into clustered jobs of at most
+    maxRuntime seconds each.
+
+    Parameters
+    ----------
+    maxRuntime: `int`
+        Target runtime in seconds of a clustered job
+    runtimes: `dict`, optional
+        (base, perInput) of the transformations to cluster, overriding
+        DEFAULT_RUNTIMES, e.g. from loadRuntimeStats
+    """
+
+    def __init__(self, maxRuntime, runtimes=None):
+        self.maxRuntime = int(maxRuntime)
+        self.runtimes = dict(DEFAULT_RUNTIMES)
+        if runtimes:
+            self.runtimes.update(runtimes)
+
+    def estimate(self, name, nInputs):
+        """Return the estimated runtime in seconds of a job"""
+        base, perInput = self.runtimes[name]
+        return base + perInput*nInputs
+
+    def annotate(self, job, nInputs):
+        """Add the clustering profiles to a job of a clustered transformation"""
+        if job.name not in self.runtimes:
+            return
+        runtime = max(1, int(round(self.estimate(job.name, nInputs))))
+        job.addProfile(peg.Profile("pegasus", "runtime", str(runtime)))
+        job.addProfile(peg.Profile("pegasus", "clusters.maxruntime", str(self.maxRuntime)))
+
+
+def chainLabel(chain, dataId):
+    """Return the label of a chain of jobs on a data ID, e.g. a patch and filter"""
+    return "-".join([chain] + [str(dataId[key]).replace(",", "_") for key in sorted(dataId)])
+
+
+def fuse(job, label):
+    """Label a job to run in one clustered job with the rest of its chain
+
+    Planned with --cluster label, Pegasus runs the jobs of each label one
+    after the other as a single job on one node, so no job of the chain
+    waits for Condor to schedule it; the dependencies into and out of the
+    chain stay as they are.  Only chains no path leaves and re-enters may
+    be labelled, or the clustered job would depend on itself.
+    """
+    job.addProfile(peg.Profile("pegasus", "label", label))
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import gzip
+import shutil
+import sys
+import tempfile
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import Pegasus.DAX3 as peg
+import lsst.log
+from dependencyIndex import IndexedADAG
+
+logger = lsst.log.Log.getLogger("daxWriter")
+logger.setLevel(lsst.log.INFO)
+
+
+def _write(element, out):
+    # Each top-level element is written the way ADAG.writeXML does
+    out.write('\t')
+    element.toXML().write(stream=out, level=1)
+    out.write('\n')
+
+
+def writeDependencies(children, out):
+    """Write <child> elements as ADAG.writeXML does
+
+    Parameters
+    ----------
+    children: `dict`
+        The list of (parent, edge_label) of each child job ID
+    out: file-like
+        Where to write
+    """
+    for child in sorted(children):
+        c = peg.Element("child", [("ref", child)])
+        for parent, edge_label in sorted(children[child]):
+            c.element(peg.Element("parent", [("ref", parent), ("edge-label", edge_label)]))
+        out.write('\t')
+        c.write(stream=out, level=1)
+        out.write('\n')
+
+
+def adagHeader(adag):
+    """Return the XML ADAG.writeXML writes before the files of adag"""
+    content = (adag.files, adag.executables, adag.transformations, adag.jobs, adag.dependencies)
+    adag.files, adag.executables, adag.transformations, adag.jobs, adag.dependencies = \
+        set(), set(), set(), {}, set()
+    try:
+        buf = StringIO()
+        peg.ADAG.writeXML(adag, buf)
+    finally:
+        adag.files, adag.executables, adag.transformations, adag.jobs, adag.dependencies = content
+    header = buf.getvalue()
+    return header[:header.rindex('</adag>')]
+
+
+class StreamingADAG(IndexedADAG):
+    """An ADAG that writes its XML out stage by stage
+
+    The generators add files, jobs and dependencies as usual and call
+    `flush` after each stage; the elements added so far are then written
+    and dropped, so that only the live stage is held in memory.  As the
+    DAX schema wants all files before all jobs before all dependencies,
+    each section is spooled to its own temporary file and `close`
+    concatenates them with the ADAG header and footer into the output.
+
+    Jobs are written in ID order and dependencies sorted by child and
+    parent, as writeXML does.  Only the names of flushed files and jobs
+    are kept, to answer hasFile/hasJob, besides the dependency index.
+
+    Parameters
+    ----------
+    name: `str`
+        Name of the ADAG
+    outputFile: `str`
+        Path of the DAX to write
+    compress: `bool`, optional
+        Write the DAX gzip-compressed; the default is to compress if
+        outputFile ends with ".gz"
+    autoDepends: `bool`, optional
+        Add a dependency from the job producing each input file
+    """
+
+    def __init__(self, name, outputFile, compress=None, autoDepends=True, count=None, index=None,
+                 completed=None):
+        IndexedADAG.__init__(self, name, count=count, index=index, autoDepends=autoDepends,
+                             completed=completed)
+        self.outputFile = outputFile
+        self.compress = outputFile.endswith(".gz") if compress is None else compress
+        self._fileSpool = tempfile.TemporaryFile(mode="w+")
+        self._jobSpool = tempfile.TemporaryFile(mode="w+")
+        self._dependencySpool = tempfile.TemporaryFile(mode="w+")
+        self._flushedFiles = set()
+        self._flushedJobs = set()
+        self._lastChild = None
+        self.closed = False
+
+    def hasFile(self, file):
+        return file.name in self._flushedFiles or peg.ADAG.hasFile(self, file)
+
+    def addFile(self, file):
+        if file.name in self._flushedFiles:
+            raise peg.DuplicateError("Duplicate file %s" % file.name)
+        IndexedADAG.addFile(self, file)
+
+    def hasJob(self, job):
+        jobId = job.id if isinstance(job, peg.AbstractJob) else job
+        return jobId in self._flushedJobs or peg.ADAG.hasJob(self, job)
+
+    def _declareOutput(self, lfn, path):
+        if lfn in self._flushedFiles:
+            raise RuntimeError("File %s is already written; reuse it before flush" % lfn)
+        IndexedADAG._declareOutput(self, lfn, path)
+
+    def addDependency(self, dep):
+        if dep.child in self._flushedJobs:
+            raise RuntimeError("Job %s is already written; add its dependencies before flush" % dep.child)
+        if dep.parent not in self._flushedJobs:
+            peg.ADAG.addDependency(self, dep)
+            return
+        # ADAG.addDependency looks for the parent in self.jobs, which no
+        # longer holds a flushed job; the edge is written with the child
+        if dep.child not in self.jobs:
+            raise peg.NotFoundError("Child not found", dep.child)
+        if self.hasDependency(dep):
+            raise peg.DuplicateError("Duplicate dependency %s -> %s" % (dep.parent, dep.child))
+        self.dependencies.add(dep)
+
+    def flush(self):
+        """Write the files, jobs and dependencies added since the last flush"""
+        jobIds = sorted(self.jobs.keys())
+
+        for f in self.files:
+            _write(f, self._fileSpool)
+            self._flushedFiles.add(f.name)
+        for jobId in jobIds:
+            _write(self.jobs[jobId], self._jobSpool)
+            self._flushedJobs.add(jobId)
+
+        children = {}
+        for dep in self.dependencies:
+            children.setdefault(dep.child, []).append((dep.parent, dep.edge_label))
+        if children:
+            if self._lastChild is not None and min(children) < self._lastChild:
+                raise RuntimeError("Dependencies of job %s are out of order" % min(children))
+            self._lastChild = max(children)
+        writeDependencies(children, self._dependencySpool)
+
+        logger.debug("Flushed %d files, %d jobs and %d dependencies",
+                     len(self.files), len(jobIds), len(self.dependencies))
+        self.files = set()
+        self.jobs = {}
+        self.dependencies = set()
+
+    def close(self):
+        """Flush the last stage and write the DAX to outputFile"""
+        if self.closed:
+            return
+        self.flush()
+        if self.compress:
+            out = gzip.open(self.outputFile, "wt" if sys.version_info[0] >= 3 else "wb")
+        else:
+            out = open(self.outputFile, "w")
+        with out:
+            out.write(adagHeader(self))
+            self._copy(self._fileSpool, out)
+            for e in self.executables:
+                _write(e, out)
+            for t in self.transformations:
+                _write(t, out)
+            self._copy(self._jobSpool, out)
+            self._copy(self._dependencySpool, out)
+            out.write('</adag>\n')
+        self.closed = True
+        logger.info("Wrote %d files and %d jobs to %s",
+                    len(self._flushedFiles), len(self._flushedJobs), self.outputFile)
+
+    @staticmethod
+    def _copy(spool, out):
+        spool.seek(0)
+        shutil.copyfileobj(spool, out)
+        spool.close()
+
+    def writeXML(self, out):
+        raise RuntimeError("A StreamingADAG writes itself to %s on close()" % self.outputFile)
+
+
+def makeADAG(name, outputFile=None, compress=None, compact=False, completed=None):
+    """Return the ADAG for a generator
+
+    With outputFile, a StreamingADAG writing to it; with compact, a
+    jobGraph.JobGraph; otherwise an IndexedADAG.  All add the
+    dependencies of each job from its inputs as the job is added, and
+    all but the StreamingADAG are written with writeXML.  With completed,
+    a resume.CompletedOutputs, the jobs whose outputs exist are left out.
+    """
+    if outputFile is not None:
+        if compact:
+            raise ValueError("A streamed DAX cannot use the compact job graph")
+        return StreamingADAG(name, outputFile, compress=compress, completed=completed)
+    if compact:
+        from jobGraph import JobGraph
+        return JobGraph(name, completed=completed)
+    return IndexedADAG(name, completed=completed)
+
+
+def flushStage(dax):
+    """Write out the finished stage if dax is a StreamingADAG"""
+    if isinstance(dax, StreamingADAG):
+        dax.flush()
+
+
+def writeDax(dax, outputFile):
+    """Write a DAX built by makeADAG to outputFile"""
+    if isinstance(dax, StreamingADAG):
+        dax.close()
+    else:
+        with open(outputFile, "w") as f:
+            dax.writeXML(f)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+from collections import defaultdict
+
+import Pegasus.DAX3 as peg
+
+
+class DependencyIndex(object):
+    """Index of the job producing each file, giving the edges of new jobs
+
+    AutoADAG matches the inputs of every job against the outputs of every
+    other job when the DAX is written.  Here each job is indexed as it is
+    added: its outputs are recorded as produced by it and its inputs are
+    looked up, so building all edges is linear in the number of uses.
+    Inputs without a producer yet wait for one, except static files such
+    as _mapper or registry.sqlite3 that come from the replica catalog and
+    are read by nearly every job.
+
+    Files and jobs may be identified by anything hashable, e.g. LFNs and
+    job IDs or their interned integers.
+    """
+
+    def __init__(self):
+        self.producers = {}
+        self.static = set()
+        self.pending = defaultdict(list)
+
+    def addStatic(self, name):
+        """Mark a file as an input of the workflow, never produced by a job"""
+        self.static.add(name)
+
+    def addJob(self, jobId, inputs, outputs):
+        """Index a job and return the (parent, child) edges it brings
+
+        Parameters
+        ----------
+        jobId:
+            ID of the new job
+        inputs, outputs: iterables
+            Files the job reads and writes; a file in both is read first
+
+        Returns
+        -------
+        edges: `list` of `tuple`
+            New edges from the producers of the inputs to this job and
+            from this job to the earlier jobs waiting for its outputs
+        """
+        edges = []
+        for name in inputs:
+            parent = self.producers.get(name)
+            if parent is not None:
+                if parent != jobId:
+                    edges.append((parent, jobId))
+            elif name not in self.static:
+                self.pending[name].append(jobId)
+        for name in outputs:
+            self.producers[name] = jobId
+            for child in self.pending.pop(name, ()):
+                if child != jobId:
+                    edges.append((jobId, child))
+        return edges
+
+
+def jobInputsOutputs(job):
+    """Return the LFNs a peg.Job reads and writes"""
+    inputs = [use.name for use in job.used if use.link in (peg.Link.INPUT, peg.Link.INOUT)]
+    outputs = [use.name for use in job.used if use.link in (peg.Link.OUTPUT, peg.Link.INOUT)]
+    return inputs, outputs
+
+
+class IndexedADAG(peg.ADAG):
+    """An ADAG adding the dependencies of each job as the job is added
+
+    Parameters
+    ----------
+    name: `str`
+        Name of the ADAG
+    autoDepends: `bool`, optional
+        Add the dependencies from the producers of the inputs; without
+        it, only explicit depends calls make edges
+    completed: `resume.CompletedOutputs`, optional
+        Outputs of earlier runs; a job whose outputs are all there and
+        whose inputs no job of this workflow produces is left out, and
+        its outputs are declared with their PFNs
+    """
+
+    def __init__(self, name, count=None, index=None, autoDepends=True, completed=None):
+        peg.ADAG.__init__(self, name, count=count, index=index)
+        self.dependencyIndex = DependencyIndex() if autoDepends else None
+        self.completed = completed
+
+    def addFile(self, file):
+        peg.ADAG.addFile(self, file)
+        if self.dependencyIndex is not None and file.pfns:
+            self.dependencyIndex.addStatic(file.name)
+
+    def addJob(self, job):
+        if self.completed is not None and self._reuseOutputs(job):
+            return
+        peg.ADAG.addJob(self, job)
+        if self.dependencyIndex is not None:
+            inputs, outputs = jobInputsOutputs(job)
+            for parent, child in self.dependencyIndex.addJob(job.id, inputs, outputs):
+                dep = peg.Dependency(parent=parent, child=child)
+                if not self.hasDependency(dep):
+                    self.addDependency(dep)
+
+    def _reuseOutputs(self, job):
+        """Declare the earlier outputs of job instead of adding it, if all exist"""
+        # The job still takes its ID, so the IDs match those of the run
+        # resumed from
+        if job.id is None:
+            job.id = "ID%07d" % self.sequence
+            self.sequence += 1
+        inputs, outputs = jobInputsOutputs(job)
+        if self.dependencyIndex is not None and \
+                any(name in self.dependencyIndex.producers for name in inputs):
+            return False
+        paths = self.completed.reusable("%s_%s" % (job.name, job.id), outputs)
+        if paths is None:
+            return False
+        for lfn, path in paths.items():
+            self._declareOutput(lfn, path)
+        return True
+
+    def _declareOutput(self, lfn, path):
+        f = peg.File(lfn)
+        self.files.discard(f)
+        for url, site in self.completed.pfns(path):
+            f.addPFN(peg.PFN(url, site=site))
+        self.addFile(f)
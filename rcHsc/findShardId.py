@@ -1,17 +1,119 @@
 #!/usr/bin/env python
 
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
 import lsst.afw.geom as afwGeom
 import lsst.afw.coord as afwCoord
+import lsst.afw.image as afwImage
 import lsst.daf.persistence as dafPersist
 import lsst.log
 from lsst.meas.astrom.ref_match import RefMatchTask
-from lsst.meas.astrom.directMatch import DirectMatchTask
+from lsst.meas.astrom.directMatch import DirectMatchConfig
 from lsst.meas.algorithms import LoadIndexedReferenceObjectsTask, LoadIndexedReferenceObjectsConfig
+from htmPolygon import polygonTrixels
 
 logger = lsst.log.Log.getLogger("findShardId")
 logger.setLevel(lsst.log.DEBUG)
 
-def findShardIdFromExpId(butler, expId, expType="raw", ref_dataset_name="ps1_pv3_3pi_20170110"):
+# Loaders and skymaps are reused across calls; constructing a loader
+# reads the ref_cat config and getting the skymap unpickles it
+_loaders = {}
+_skyMaps = {}
+
+# How shards are selected: "circle" takes every trixel touching an inflated
+# circle around the patch or exposure; "polygon" keeps only the trixels
+# within the match margin of the actual patch or exposure outline
+SHARD_SELECTIONS = ("circle", "polygon")
+
+
+def getLoader(butler, ref_dataset_name):
+    """Return a LoadIndexedReferenceObjectsTask for the butler, creating it once"""
+    key = (id(butler), ref_dataset_name)
+    if key not in _loaders:
+        config = LoadIndexedReferenceObjectsConfig()
+        config.ref_dataset_name = ref_dataset_name
+        _loaders[key] = (butler, LoadIndexedReferenceObjectsTask(butler=butler, config=config))
+    return _loaders[key][1]
+
+
+def getSkyMap(butler):
+    """Return the deepCoadd_skyMap of the butler, reading it once"""
+    key = id(butler)
+    if key not in _skyMaps:
+        _skyMaps[key] = (butler, butler.get("deepCoadd_skyMap", {}))
+    return _skyMaps[key][1]
+
+
+def coordsToVectors(coordList):
+    """Convert a list of afwCoord to an array of unit vectors"""
+    lonLat = np.array([(coord.getLongitude().asRadians(), coord.getLatitude().asRadians())
+                       for coord in coordList])
+    lon, lat = lonLat[:, 0], lonLat[:, 1]
+    return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def _shardsInCircle(loader, center, radius, polygon=None, margin=0.0):
+    """Return the shard pixel_ids of the HTM trixels touching a circle
+
+    If polygon, an array of unit vectors inside the circle, is given,
+    only the trixels within margin radians of it are kept.
+    """
+    # Copied from LoadIndexedReferenceObjectsTask.loadSkyCircle and get_shards
+    id_list, boundary_mask = loader.indexer.get_pixel_ids(center, radius)
+    if polygon is not None:
+        id_list = polygonTrixels(polygon, id_list, margin=margin)
+    # loader.get_shards(id_list)
+    shardPixels = []
+    for pixel_id in id_list:
+        shard_id = loader.indexer.make_data_id(pixel_id, loader.config.ref_dataset_name)
+        #butler.get('ref_cat', dataId=shard_id)
+        shardPixels.append(shard_id['pixel_id'])
+    return shardPixels
+
+
+def _matchMargin():
+    # meas/astrom/directMatch.py DirectMatchConfig.matchRadius : assume no override
+    return DirectMatchConfig().matchRadius * afwGeom.arcseconds
+
+
+def _patchShards(loader, center, radius, polygon, selection):
+    """Return the shards of a patch given its bounding circle and corners"""
+    if selection == "polygon":
+        margin = _matchMargin()
+        return _shardsInCircle(loader, center, radius + margin, polygon=polygon,
+                               margin=margin.asRadians())
+    return _shardsInCircle(loader, center, _patchSearchRadius(radius))
+
+
+def _patchSearchRadius(radius):
+    """Return the ref_cat search radius given the bounding radius of a patch"""
+    maxRadius = radius + _matchMargin()
+    # TODO: figure out what ref cat shards are really needed
+    # Use a large radius just to get by for now
+    # More warnings "schema=None is not a schema" are seen from meas/algorithms/loadReferenceObjects.py (getRefFluxField)
+    # joinMatchListWithCatalog
+    # https://github.com/lsst/meas_mosaic/blob/f1d35002dc2c9b7478e670afee8cafd40ab0a80b/python/lsst/meas/mosaic/mosaicTask.py#L346
+    # https://github.com/lsst/meas_mosaic/blob/f1d35002dc2c9b7478e670afee8cafd40ab0a80b/python/lsst/meas/mosaic/mosaicTask.py#L364
+    return maxRadius * 2.1
+
+
+def getExposureBBoxWcs(butler, expId, expType="raw"):
+    """Read the bbox and WCS of an exposure from its FITS header only
+
+    Uses the "<expType>_md" dataset, so no pixel data are read.
+    """
+    md = butler.get(expType + "_md", expId)
+    prefix = "ZNAXIS" if md.exists("ZNAXIS1") else "NAXIS"
+    xy0 = afwGeom.Point2I(-md.get("LTV1") if md.exists("LTV1") else 0,
+                          -md.get("LTV2") if md.exists("LTV2") else 0)
+    bbox = afwGeom.Box2I(xy0, afwGeom.Extent2I(md.get(prefix + "1"), md.get(prefix + "2")))
+    wcs = afwImage.makeWcs(md)
+    return bbox, wcs
+
+
+def findShardIdFromExpId(butler, expId, expType="raw", ref_dataset_name="ps1_pv3_3pi_20170110", cache=None,
+                         headerOnly=True, selection="circle"):
     """Obtain the shard IDs given (an exposure and the loader)
 
     Parameters
@@ -24,39 +126,141 @@ def findShardIdFromExpId(butler, expId, expType="raw", ref_dataset_name="ps1_pv3
     expId: a dataId dict for the exposure
     expType: a butler type to retrieve the exposure
     ref_dataset_name: a HTM cat name accessible from the given butler repo
+    cache: shardCache.ShardCache, optional
+        Persistent cache consulted before and updated after the computation
+    headerOnly: bool, optional
+        Read only the bbox and WCS from the FITS header instead of the full exposure
+    selection: `str`, optional
+        One of SHARD_SELECTIONS; with "polygon" only the trixels touching
+        the grown bbox outline are kept
 
     Returns
     -------
     shardId: a butler dataId for the shard pixel_id,
         to retrieve the shards of Butler dataset type "ref_cat"
     """
-    config = LoadIndexedReferenceObjectsConfig()
-    config.ref_dataset_name = ref_dataset_name
-    loader = LoadIndexedReferenceObjectsTask(butler=butler, config=config)
+    if cache is not None:
+        shardPixels = cache.getExposure(ref_dataset_name, expId['visit'], expId['ccd'])
+        if shardPixels is not None:
+            return shardPixels
+
+    loader = getLoader(butler, ref_dataset_name)
+    config = loader.config
 
-    refMatchTask = RefMatchTask(refObjLoader=loader)
-    exp = butler.get(expType, expId)
-    expMd = refMatchTask._getExposureMetadata(exp)
+    if headerOnly:
+        expBBox, expWcs = getExposureBBoxWcs(butler, expId, expType)
+    else:
+        refMatchTask = RefMatchTask(refObjLoader=loader)
+        exp = butler.get(expType, expId)
+        expMd = refMatchTask._getExposureMetadata(exp)
+        expBBox, expWcs = expMd.bbox, expMd.wcs
 
     # Copied from LoadReferenceObjectsTask.loadPixelBox
     # compute on-sky center and radius of search region
-    bbox = afwGeom.Box2D(expMd.bbox) # make sure bbox is double and that we have a copy
+    bbox = afwGeom.Box2D(expBBox) # make sure bbox is double and that we have a copy
     bbox.grow(config.pixelMargin)
-    ctrCoord = expMd.wcs.pixelToSky(bbox.getCenter())
-    maxRadius = max(ctrCoord.angularSeparation(expMd.wcs.pixelToSky(pp)) for pp in bbox.getCorners())
-    # Copied from LoadIndexedReferenceObjectsTask.loadSkyCircle and get_shards
-    id_list, boundary_mask = loader.indexer.get_pixel_ids(ctrCoord, maxRadius)
-    # loader.get_shards(id_list)
-    shardPixels = []
-    for pixel_id in id_list:
-        shard_id = loader.indexer.make_data_id(pixel_id, config.ref_dataset_name)
-        #butler.get('ref_cat', dataId=shard_id)
-        shardPixels.append(shard_id['pixel_id'])
+    ctrCoord = expWcs.pixelToSky(bbox.getCenter())
+    if selection == "polygon":
+        # Sample the edges since distortion bends them away from great circles
+        corners = bbox.getCorners()
+        edgePoints = [corners[i] + (corners[(i + 1) % 4] - corners[i])*(k/8.0)
+                      for i in range(4) for k in range(8)]
+        coordList = [expWcs.pixelToSky(pp) for pp in edgePoints]
+        maxRadius = max(ctrCoord.angularSeparation(coord) for coord in coordList)
+        shardPixels = _shardsInCircle(loader, ctrCoord, maxRadius, polygon=coordsToVectors(coordList))
+    else:
+        maxRadius = max(ctrCoord.angularSeparation(expWcs.pixelToSky(pp)) for pp in bbox.getCorners())
+        shardPixels = _shardsInCircle(loader, ctrCoord, maxRadius)
 
     logger.debug("For expId %s the shard_id pixel_id is %s" % (expId, shardPixels))
+    if cache is not None:
+        cache.putExposure(ref_dataset_name, expId['visit'], expId['ccd'], shardPixels)
     return shardPixels
 
-def findShardIdFromPatch(butler, dataId, ref_dataset_name="ps1_pv3_3pi_20170110"):
+# Per-process state of the findShardIdsFromExpIds workers
+_worker = {}
+
+
+def _initWorker(root, calibRoot, expType, ref_dataset_name, selection):
+    _worker["butler"] = dafPersist.Butler(root=root, calibRoot=calibRoot)
+    _worker["expType"] = expType
+    _worker["ref_dataset_name"] = ref_dataset_name
+    _worker["selection"] = selection
+
+
+def _workerShards(expId):
+    shards = findShardIdFromExpId(_worker["butler"], expId, expType=_worker["expType"],
+                                  ref_dataset_name=_worker["ref_dataset_name"],
+                                  selection=_worker["selection"])
+    return (expId['visit'], expId['ccd']), shards
+
+
+def findShardIdsFromExpIds(root, expIds, calibRoot=None, expType="raw",
+                           ref_dataset_name="ps1_pv3_3pi_20170110", cache=None, processes=1, butler=None,
+                           selection="circle"):
+    """Obtain the shard IDs of many exposures, reading headers over a process pool
+
+    Parameters
+    ----------
+    root: `str`
+        Butler repo root of the exposures
+    expIds: `list` of `dict`
+        Data IDs with visit and ccd of the exposures
+    calibRoot: `str`, optional
+        Butler calib root, passed to the worker butlers
+    expType: `str`, optional
+        A butler type of the exposures
+    ref_dataset_name: `str`, optional
+        A HTM cat name accessible from the given butler repo
+    cache: shardCache.ShardCache, optional
+        Cached exposures are not recomputed; new results are added to it
+    processes: `int`, optional
+        Number of worker processes; with 1 everything runs in this process
+    butler: lsst.daf.persistence.Butler, optional
+        Butler to use when running in this process
+    selection: `str`, optional
+        One of SHARD_SELECTIONS
+
+    Returns
+    -------
+    shardDict: `dict`
+        The shard pixel_ids of each (visit, ccd)
+    """
+    shardDict = {}
+    todo = []
+    for expId in expIds:
+        shards = cache.getExposure(ref_dataset_name, expId['visit'], expId['ccd']) if cache else None
+        if shards is None:
+            todo.append(expId)
+        else:
+            shardDict[(expId['visit'], expId['ccd'])] = shards
+    logger.info("Finding shards of %d exposures (%d cached) with %d processes",
+                len(todo), len(shardDict), processes)
+
+    if processes > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(processes, initializer=_initWorker,
+                                    initargs=(root, calibRoot, expType, ref_dataset_name, selection))
+        try:
+            results = pool.imap(_workerShards, todo, chunksize=max(1, len(todo) // (4*processes)))
+            for key, shards in results:
+                shardDict[key] = shards
+                if cache is not None:
+                    cache.putExposure(ref_dataset_name, key[0], key[1], shards)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        if butler is None:
+            butler = dafPersist.Butler(root=root, calibRoot=calibRoot)
+        for expId in todo:
+            shardDict[(expId['visit'], expId['ccd'])] = findShardIdFromExpId(
+                butler, expId, expType=expType, ref_dataset_name=ref_dataset_name, cache=cache,
+                selection=selection)
+    return shardDict
+
+
+def findShardIdFromPatch(butler, dataId, ref_dataset_name="ps1_pv3_3pi_20170110", cache=None,
+                         selection="circle"):
     """Obtain the shard IDs given (an source catalog and the loader)
 
     Somewhat following DirectMatch, the default of measureCoaddSources config.match
@@ -73,44 +277,127 @@ def findShardIdFromPatch(butler, dataId, ref_dataset_name="ps1_pv3_3pi_20170110"
     loader: meas.algorithms.LoadIndexedReferenceObjectsTask
         A loader task instantiated with a butler
     ref_dataset_name: a HTM cat name accessible from the given butler repo
+    cache: shardCache.ShardCache, optional
+        Persistent cache consulted before and updated after the computation
+    selection: `str`, optional
+        One of SHARD_SELECTIONS; with "polygon" only the trixels within
+        matchRadius of the patch outer bbox are kept
 
     Returns
     -------
     shardId: a butler dataId for the shard pixel_id,
         to retrieve the shards of Butler dataset type "ref_cat"
     """
-    config = LoadIndexedReferenceObjectsConfig()
-    config.ref_dataset_name = ref_dataset_name
-    loader = LoadIndexedReferenceObjectsTask(butler=butler, config=config)
+    if cache is not None:
+        shardPixels = cache.getPatch(ref_dataset_name, dataId['tract'], dataId['patch'])
+        if shardPixels is not None:
+            return shardPixels
+
+    loader = getLoader(butler, ref_dataset_name)
 
-    skymap = butler.get("deepCoadd_skyMap", {})
-    tractInfo = skymap[dataId['tract']]
+    tractInfo = getSkyMap(butler)[dataId['tract']]
     wcs = tractInfo.getWcs()
-    patchIndex = map(int, dataId['patch'].split(','))
+    patchIndex = list(map(int, dataId['patch'].split(',')))
     pBox = afwGeom.Box2D(tractInfo.getPatchInfo(patchIndex).getOuterBBox())
     coordList = [wcs.pixelToSky(corner) for corner in pBox.getCorners()]
     # Copied from DirectMatchTask.calculateCircle which instead takes a catalog
     center = afwCoord.averageCoord(coordList)
     radius = max(center.angularSeparation(coord) for coord in coordList)
-    # meas/astrom/directMatch.py DirectMatchConfig.matchRadius : assume no override
-    directMatchTask = DirectMatchTask(refObjLoader=loader)
-    maxRadius = radius + directMatchTask.config.matchRadius * afwGeom.arcseconds
-    # TODO: figure out what ref cat shards are really needed
-    # Use a large radius just to get by for now
-    # More warnings "schema=None is not a schema" are seen from meas/algorithms/loadReferenceObjects.py (getRefFluxField)
-    # joinMatchListWithCatalog
-    # https://github.com/lsst/meas_mosaic/blob/f1d35002dc2c9b7478e670afee8cafd40ab0a80b/python/lsst/meas/mosaic/mosaicTask.py#L346
-    # https://github.com/lsst/meas_mosaic/blob/f1d35002dc2c9b7478e670afee8cafd40ab0a80b/python/lsst/meas/mosaic/mosaicTask.py#L364
-    maxRadius = maxRadius * 2.1
-
-    # Copied from LoadIndexedReferenceObjectsTask.loadSkyCircle and get_shards
-    id_list, boundary_mask = loader.indexer.get_pixel_ids(center, maxRadius)
-    # loader.get_shards(id_list)
-    shardPixels = []
-    for pixel_id in id_list:
-        shard_id = loader.indexer.make_data_id(pixel_id, config.ref_dataset_name)
-        #butler.get('ref_cat', dataId=shard_id)
-        shardPixels.append(shard_id['pixel_id'])
+    shardPixels = _patchShards(loader, center, radius, coordsToVectors(coordList), selection)
 
     logger.debug("For dataId %s the shard_id pixel_id is %s" % (dataId, shardPixels))
+    if cache is not None:
+        cache.putPatch(ref_dataset_name, dataId['tract'], dataId['patch'], shardPixels)
     return shardPixels
+
+
+def patchBoundingCircles(tractInfo, patchIds):
+    """Compute the corners and bounding circles of many patches as arrays
+
+    Parameters
+    ----------
+    tractInfo: lsst.skymap.TractInfo
+        The tract of the patches
+    patchIds: `list` of `str`
+        Patch IDs like "4,5"
+
+    Returns
+    -------
+    corners: `numpy.ndarray`
+        Unit vectors of the outer bbox corners, shape (nPatch, 4, 3)
+    centers: `numpy.ndarray`
+        Unit vectors of the circle centers, shape (nPatch, 3); the
+        normalized mean of the corners as in afwCoord.averageCoord
+    radii: `numpy.ndarray`
+        Circle radii in radians, shape (nPatch,)
+    """
+    wcs = tractInfo.getWcs()
+    corners = np.empty((len(patchIds), 4, 3))
+    for i, patchId in enumerate(patchIds):
+        patchIndex = list(map(int, patchId.split(',')))
+        pBox = afwGeom.Box2D(tractInfo.getPatchInfo(patchIndex).getOuterBBox())
+        corners[i] = coordsToVectors([wcs.pixelToSky(corner) for corner in pBox.getCorners()])
+    centers = corners.sum(axis=1)
+    centers /= np.linalg.norm(centers, axis=1)[:, np.newaxis]
+    cosSep = np.clip(np.einsum("pkj,pj->pk", corners, centers), -1.0, 1.0)
+    radii = np.arccos(cosSep).max(axis=1)
+    return corners, centers, radii
+
+
+def vectorToCoord(vector):
+    """Convert a unit vector to an IcrsCoord"""
+    ra = np.arctan2(vector[1], vector[0]) % (2*np.pi)
+    dec = np.arcsin(np.clip(vector[2], -1.0, 1.0))
+    return afwCoord.IcrsCoord(float(ra)*afwGeom.radians, float(dec)*afwGeom.radians)
+
+
+def findShardIdsFromTract(butler, tract, patchIds, ref_dataset_name="ps1_pv3_3pi_20170110", cache=None,
+                          selection="circle"):
+    """Obtain the shard IDs of all given patches of a tract in one pass
+
+    The skymap is read once and the bounding circles of all patches are
+    computed together; each circle is then searched as in
+    findShardIdFromPatch, so the shards of a patch are the same.
+
+    Parameters
+    ----------
+    butler: A daf.persistence.Butler object;
+        to be used to instantiate LoadIndexedReferenceObjectsTask
+    tract: `int`
+        The tract ID
+    patchIds: `list` of `str`
+        Patch IDs like "4,5"
+    ref_dataset_name: a HTM cat name accessible from the given butler repo
+    cache: shardCache.ShardCache, optional
+        Persistent cache consulted before and updated after the computation
+    selection: `str`, optional
+        One of SHARD_SELECTIONS
+
+    Returns
+    -------
+    patchShards: `OrderedDict`
+        The shard pixel_ids of each patch, in the order of patchIds
+    tractShards: `list`
+        The sorted union of the shards of all patches
+    """
+    patchShards = OrderedDict((patchId, None) for patchId in patchIds)
+    if cache is not None:
+        for patchId in patchIds:
+            patchShards[patchId] = cache.getPatch(ref_dataset_name, tract, patchId)
+    todo = [patchId for patchId in patchIds if patchShards[patchId] is None]
+
+    if todo:
+        loader = getLoader(butler, ref_dataset_name)
+        tractInfo = getSkyMap(butler)[tract]
+        corners, centers, radii = patchBoundingCircles(tractInfo, todo)
+        for patchId, polygon, center, radius in zip(todo, corners, centers, radii):
+            shardPixels = _patchShards(loader, vectorToCoord(center), float(radius)*afwGeom.radians,
+                                       polygon, selection)
+            patchShards[patchId] = shardPixels
+            if cache is not None:
+                cache.putPatch(ref_dataset_name, tract, patchId, shardPixels)
+    logger.debug("Tract %s: %d patches (%d computed) use %d shards", tract, len(patchIds), len(todo),
+                 len({shard for shards in patchShards.values() for shard in shards}))
+
+    tractShards = sorted({shard for shards in patchShards.values() for shard in shards})
+    return patchShards, tractShards
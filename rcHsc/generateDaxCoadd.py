@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import argparse
+import multiprocessing
 import os
+from collections import defaultdict
 import Pegasus.DAX3 as peg
 
 import lsst.log
@@ -8,8 +10,18 @@ import lsst.utils
 from lsst.utils import getPackageDir
 from lsst.daf.persistence import Butler
 from lsst.obs.hsc.hscMapper import HscMapper
-from findShardId import findShardIdFromPatch
-from getDataFile import getDataFile
+from ccdOverlaps import computeOverlaps, findTractCcds
+from clustering import RuntimeClusterer, chainLabel, fuse, loadRuntimeStats
+from daxWriter import flushStage, makeADAG, writeDax
+from findShardId import SHARD_SELECTIONS, findShardIdsFromTract
+from getDataFile import getDataFile, getResolver
+from graphCache import GraphCache, fileStamps, sourceHash
+from inputIndex import Blacklist, InputIndex, loadInputIndex, readBlacklist
+from jobGraph import JobGraph
+from pathTemplates import PathTemplateResolver
+from registryIndex import RawRegistryIndex
+from resume import CompletedOutputs
+from shardCache import configHash, openShardCache
 
 logger = lsst.log.Log.getLogger("workflow")
 logger.setLevel(lsst.log.WARN)
@@ -28,18 +40,208 @@ rootRepo = "/datasets/hsc/repo"
 # This is a config of LoadIndexedReferenceObjectsTask ref_dataset_name
 refcatName = "ps1_pv3_3pi_20170110"
 
+# The parts of the coadd workflow generateCoaddDax can be restricted to:
+# the schema pre-runs, the mosaic of the tract, and the per-patch pipeline
+COADD_STAGES = ("prerun", "mosaic", "patch")
+
+
+def readInputData(path, blacklist=()):
+    """Read the input data of a tract
+
+    Parameters
+    ----------
+    path: `str`
+        A pipe-delimited 'filter|patch|visit-ccd,...' file or an input
+        index saved from one by inputIndex.py
+    blacklist: optional
+        'visit-ccd' to leave out
+
+    Returns
+    -------
+    dataDict: `dict`
+        dataDict[filterName][patch] is a list of 'visit-ccd'
+    """
+    return loadInputIndex(path).dataDict(blacklist)
+
+
+def dropUnprocessedCcds(dataDict, blacklist, repo):
+    """Drop the CCDs that have no calexp in repo
+
+    All CCDs of the visits in dataDict are checked, as mosaic reads whole
+    visits.
+
+    Returns
+    -------
+    dataDict: `dict`
+        dataDict without the missing CCDs
+    blacklist: `inputIndex.Blacklist`
+        blacklist with the missing CCDs added
+    """
+    butler = Butler(repo)
+    inputs = InputIndex.fromDataDict(dataDict)
+    blacklist = Blacklist(blacklist)
+    missing = Blacklist((visitId, ccdId) for visitId in sorted(set(inputs.visits.tolist()))
+                        for ccdId in range(9) + range(10, 104)
+                        if (visitId, ccdId) not in blacklist and
+                        not butler.datasetExists("calexp", visit=visitId, ccd=ccdId))
+    if missing:
+        logger.warn("%d CCDs have no calexp in %s: %s", len(missing), repo, missing.names())
+    return inputs.dataDict(missing), blacklist.union(missing)
+
+
+def selectPatches(dataDict, patches):
+    """Return the part of dataDict on the given patches"""
+    selected = {}
+    for filterName in dataDict:
+        patchDict = {patch: ccds for patch, ccds in dataDict[filterName].items() if patch in patches}
+        if patchDict:
+            selected[filterName] = patchDict
+    return selected
+
+
+def addMakeCoaddTempExp(dax, mapper, commonInputs, tractDataId, filterName, visitId, patchCcds, doMosaic,
+                        repoRoot, clusterer=None):
+    """Add a makeCoaddTempExp job warping CCDs of a visit to one or more patches
+
+    Parameters
+    ----------
+    dax: peg.ADAG
+        The workflow
+    mapper: lsst.obs.base.CameraMapper
+        Mapper to name the files
+    commonInputs: `list`
+        Files every makeCoaddTempExp job reads
+    tractDataId: `int`
+        Tract ID
+    filterName: `str`
+        Filter of the visit
+    visitId: `int`
+        Visit to warp
+    patchCcds: `dict`
+        The CCDs of the visit overlapping each patch; with several
+        patches, the job stages the union of their CCDs once and writes
+        the warps of all patches.  makeCoaddTempExp still runs one target
+        per patch, each reading the calexps of its own CCDs, so only the
+        job startup and scheduling are shared, not the calexp reads
+    doMosaic: `bool`
+        Apply the mosaic wcs and fcr
+    repoRoot: `str`
+        Repo of the calexps
+    clusterer: `clustering.RuntimeClusterer`, optional
+        Marks the job for horizontal clustering
+
+    Returns
+    -------
+    warps: `list` of `tuple`
+        (patch, deepCoadd_directWarp file) of each patch
+    """
+    patches = list(patchCcds)
+    ccdIds = patchCcds[patches[0]] if len(patches) == 1 else \
+        sorted({ccdId for patch in patches for ccdId in patchCcds[patch]})
+    ident = "--id tract=%s patch=%s filter=%s" % (tractDataId, "^".join(patches), filterName)
+
+    makeCoaddTempExp = peg.Job(name="makeCoaddTempExp")
+    for inFile in commonInputs:
+        makeCoaddTempExp.uses(inFile, link=peg.Link.INPUT)
+    for ccdId in ccdIds:
+        calexp = getDataFile(mapper, "calexp", {'visit': visitId, 'ccd': ccdId},
+                             create=True, repoRoot=repoRoot)
+        if not dax.hasFile(calexp):
+            dax.addFile(calexp)
+        makeCoaddTempExp.uses(calexp, link=peg.Link.INPUT)
+
+    if doMosaic:
+        applyMosaic = " "
+        for ccdId in ccdIds:
+            for inputType in ["wcs", "fcr"]:
+                inFile = getDataFile(mapper, inputType,
+                                     {'visit': visitId, 'ccd': ccdId, 'tract': tractDataId},
+                                     create=False)
+                makeCoaddTempExp.uses(inFile, link=peg.Link.INPUT)
+    else:
+        applyMosaic = " -c doApplyUberCal=False "
 
-def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, doMosaic=False):
-    """Generate a Pegasus DAX abstract workflow"""
-    try:
-        from AutoADAG import AutoADAG
-    except ImportError:
-        dax = peg.ADAG(name)
+    selectId = "--selectId visit=%s ccd=%s" % (visitId, '^'.join(str(ccdId) for ccdId in ccdIds))
+    makeCoaddTempExp.addArguments(outPath, "--output", outPath, " --doraise", ident, applyMosaic, selectId)
+    logger.debug("Adding makeCoaddTempExp %s %s %s %s %s %s %s",
+                 outPath, "--output", outPath, " --doraise", ident, applyMosaic, selectId)
+
+    logId = dict(filter=filterName, visit=visitId, tract=tractDataId, patch=patches[0])
+    if len(patches) == 1:
+        logMakeCoaddTempExp = peg.File("logMakeCoaddTempExp.%(tract)d-%(patch)s-%(filter)s-%(visit)d" % logId)
     else:
-        dax = AutoADAG(name)
+        logMakeCoaddTempExp = peg.File("logMakeCoaddTempExp.%(tract)d-%(filter)s-%(visit)d" % logId)
+    dax.addFile(logMakeCoaddTempExp)
+    makeCoaddTempExp.setStdout(logMakeCoaddTempExp)
+    makeCoaddTempExp.uses(logMakeCoaddTempExp, link=peg.Link.OUTPUT)
+
+    warps = []
+    for patch in patches:
+        coaddTempExpId = dict(filter=filterName, visit=visitId, tract=tractDataId, patch=patch)
+        deepCoadd_directWarp = getDataFile(mapper, "deepCoadd_directWarp", coaddTempExpId, create=True)
+        dax.addFile(deepCoadd_directWarp)
+        makeCoaddTempExp.uses(deepCoadd_directWarp, link=peg.Link.OUTPUT)
+        warps.append((patch, deepCoadd_directWarp))
+
+    if clusterer is not None:
+        clusterer.annotate(makeCoaddTempExp, sum(len(patchCcds[patch]) for patch in patches))
+    dax.addJob(makeCoaddTempExp)
+    return warps
+
+
+def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, doMosaic=False,
+                     useTemplates=True, verifyTemplates=3, shardCachePath="shardCache.sqlite3",
+                     shardSelection="circle", outputFile=None, compact=False, stages=COADD_STAGES,
+                     inputRepo=inputRepo, clusterer=None, fuseChains=False, visitMajor=False,
+                     resumeFrom=None, mosaicMargin=None, processes=1, patches=None):
+    """Generate a Pegasus DAX abstract workflow
+
+    With useTemplates, dataset paths are filled from the mapper policy
+    templates instead of CameraMapper.map_*; the first verifyTemplates
+    paths of each dataset type are checked against map_*.  Ref_cat
+    shards of all patches are computed in one pass over the tract and
+    kept in the persistent cache at shardCachePath; shardSelection picks
+    the trixels touching an inflated circle or the patch outline.  With
+    outputFile, the DAX is streamed there stage by stage; with compact,
+    it is held as a jobGraph.JobGraph.  stages selects the parts of
+    COADD_STAGES to generate, e.g. to split the workflow into
+    sub-workflows; outputs of the other stages are used as plain inputs.
+    inputRepo is the repo with the processCcd outputs and the sky map.
+    A clustering.RuntimeClusterer given as clusterer marks the short
+    makeCoaddTempExp and merge jobs for horizontal clustering.  With
+    fuseChains, assembleCoadd and detectCoaddSources of each patch and
+    filter are labelled to run as one job.  With visitMajor, one
+    makeCoaddTempExp job per visit and filter warps to all the patches
+    the visit overlaps, instead of one job per patch and visit; this
+    saves job startup and scheduling, the calexps are still read once
+    per patch.  The jobs whose outputs are found in the output repos or
+    Pegasus submit directories resumeFrom are left out, see
+    resume.CompletedOutputs.
+    With mosaicMargin, the mosaic only reads and writes the CCDs of its
+    visits within mosaicMargin tract pixels of the tract, found from
+    the raw headers with processes processes, and the CCDs of dataDict,
+    instead of all CCDs.
+    With patches, the patch stage is generated for those patches only;
+    the mosaic still fits all the visits of dataDict.
+    """
+    if mosaicMargin is not None and mosaicMargin < 0:
+        raise ValueError("mosaicMargin must not be negative: %s" % mosaicMargin)
+    completed = CompletedOutputs(resumeFrom, outPath) if resumeFrom else None
+    dax = makeADAG(name, outputFile=outputFile, compact=compact, completed=completed)
+    # The integer visit and ccd of every input, parsed once
+    inputs = InputIndex.fromDataDict(dataDict)
+    blacklist = Blacklist(blacklist or ())
 
     # Construct these mappers only for creating dax, not for actual runs.
     mapper = HscMapper(root=rootRepo)
+    if useTemplates:
+        # calexp/src paths need pointing and filter from the raw registry
+        registryIndex = RawRegistryIndex(os.path.join(rootRepo, "registry.sqlite3"))
+        pathResolver = PathTemplateResolver(mapper, verifySample=verifyTemplates,
+                                            registryIndex=registryIndex)
+        resolver = getResolver(mapper, outPath, pathResolver=pathResolver)
+    else:
+        resolver = getResolver(mapper, outPath)
 
     # Construct a butler only for finding ref cat shards
     butler = Butler(inputRepo)
@@ -60,6 +262,22 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
     # Add all files in ref_cats
     refCatConfigFile = getDataFile(mapper, "ref_cat_config", {"name": refcatName}, create=True, repoRoot=rootRepo)
     dax.addFile(refCatConfigFile)
+    refCatConfigPath = os.path.join(rootRepo, resolver.getButlerPath("ref_cat_config", {"name": refcatName}))
+    skyMapPath = os.path.join(inputRepo, resolver.getButlerPath("deepCoadd_skyMap", {}))
+    shardCache = openShardCache(shardCachePath, refCatConfigPath, skyMapPath, extra=[shardSelection])
+
+    # Find the ref_cat shards of every patch of the tract at once and
+    # declare each shard file only once
+    allPatches = inputs.allPatches
+    patchShards, tractShards = findShardIdsFromTract(butler, tractDataId, allPatches,
+                                                     ref_dataset_name=refcatName, cache=shardCache,
+                                                     selection=shardSelection)
+    refCatFiles = {}
+    for shard in tractShards:
+        refCatFile = getDataFile(mapper, "ref_cat", {"name": refcatName, "pixel_id": shard}, create=True, repoRoot=rootRepo)
+        dax.addFile(refCatFile)
+        logger.debug("Add ref_cat file %s" % refCatFile)
+        refCatFiles[shard] = refCatFile
 
     refCatSchema = "ref_cats/ps1_pv3_3pi_20170110/master_schema.fits"
     filePath = os.path.join(rootRepo, refCatSchema)
@@ -72,59 +290,60 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
     srcSchema = getDataFile(mapper, "src_schema", {}, create=True, repoRoot=inputRepo)
     dax.addFile(srcSchema)
 
-    # pre-run detectCoaddSources for schema
-    preDetectCoaddSources = peg.Job(name="detectCoaddSources")
-    preDetectCoaddSources.uses(mapperFile, link=peg.Link.INPUT)
-    preDetectCoaddSources.addArguments(outPath, "--output", outPath, " --doraise")
-    deepCoadd_det_schema = getDataFile(mapper, "deepCoadd_det_schema", {}, create=True)
-    dax.addFile(deepCoadd_det_schema)
-    preDetectCoaddSources.uses(deepCoadd_det_schema, link=peg.Link.OUTPUT)
-    dax.addJob(preDetectCoaddSources)
-
-    # pre-run mergeCoaddDetections
-    preMergeCoaddDetections = peg.Job(name="mergeCoaddDetections")
-    preMergeCoaddDetections.uses(mapperFile, link=peg.Link.INPUT)
-    preMergeCoaddDetections.uses(deepCoadd_det_schema, link=peg.Link.INPUT)
-    preMergeCoaddDetections.addArguments(outPath, "--output", outPath, " --doraise")
-    for schema in ["deepCoadd_mergeDet_schema", "deepCoadd_peak_schema"]:
-        outFile = getDataFile(mapper, schema, {}, create=True)
-        dax.addFile(outFile)
-        preMergeCoaddDetections.uses(outFile, link=peg.Link.OUTPUT)
-    dax.addJob(preMergeCoaddDetections)
-
-    # pre-run measureCoaddSources
-    preMeasureCoaddSources = peg.Job(name="measureCoaddSources")
-    preMeasureCoaddSources.uses(mapperFile, link=peg.Link.INPUT)
-    preMeasureCoaddSources.uses(refCatConfigFile, link=peg.Link.INPUT)
-    preMeasureCoaddSources.addArguments(outPath, "--output", outPath, " --doraise")
-    for inputType in ["deepCoadd_mergeDet_schema", "deepCoadd_peak_schema", "src_schema"]:
-        inFile = getDataFile(mapper, inputType, {}, create=False)
-        preMeasureCoaddSources.uses(inFile, link=peg.Link.INPUT)
-
-    deepCoadd_meas_schema = getDataFile(mapper, "deepCoadd_meas_schema", {}, create=True)
-    dax.addFile(deepCoadd_meas_schema)
-    preMeasureCoaddSources.uses(deepCoadd_meas_schema, link=peg.Link.OUTPUT)
-    dax.addJob(preMeasureCoaddSources)
-
-    # pre-run mergeCoaddMeasurements
-    preMergeCoaddMeasurements = peg.Job(name="mergeCoaddMeasurements")
-    preMergeCoaddMeasurements.uses(mapperFile, link=peg.Link.INPUT)
-    preMergeCoaddMeasurements.uses(deepCoadd_meas_schema, link=peg.Link.INPUT)
-    preMergeCoaddMeasurements.addArguments(outPath, "--output", outPath, " --doraise")
-    deepCoadd_ref_schema = getDataFile(mapper, "deepCoadd_ref_schema", {}, create=True)
-    dax.addFile(deepCoadd_ref_schema)
-    preMergeCoaddMeasurements.uses(deepCoadd_ref_schema, link=peg.Link.OUTPUT)
-    dax.addJob(preMergeCoaddMeasurements)
-
-    # pre-run forcedPhotCoadd
-    preForcedPhotCoadd = peg.Job(name="forcedPhotCoadd")
-    preForcedPhotCoadd.uses(mapperFile, link=peg.Link.INPUT)
-    preForcedPhotCoadd.uses(deepCoadd_ref_schema, link=peg.Link.INPUT)
-    preForcedPhotCoadd.addArguments(outPath, "--output", outPath, " --doraise")
-    deepCoadd_forced_src_schema = getDataFile(mapper, "deepCoadd_forced_src_schema", {}, create=True)
-    dax.addFile(deepCoadd_forced_src_schema)
-    preForcedPhotCoadd.uses(deepCoadd_forced_src_schema, link=peg.Link.OUTPUT)
-    dax.addJob(preForcedPhotCoadd)
+    if "prerun" in stages:
+        # pre-run detectCoaddSources for schema
+        preDetectCoaddSources = peg.Job(name="detectCoaddSources")
+        preDetectCoaddSources.uses(mapperFile, link=peg.Link.INPUT)
+        preDetectCoaddSources.addArguments(outPath, "--output", outPath, " --doraise")
+        deepCoadd_det_schema = getDataFile(mapper, "deepCoadd_det_schema", {}, create=True)
+        dax.addFile(deepCoadd_det_schema)
+        preDetectCoaddSources.uses(deepCoadd_det_schema, link=peg.Link.OUTPUT)
+        dax.addJob(preDetectCoaddSources)
+
+        # pre-run mergeCoaddDetections
+        preMergeCoaddDetections = peg.Job(name="mergeCoaddDetections")
+        preMergeCoaddDetections.uses(mapperFile, link=peg.Link.INPUT)
+        preMergeCoaddDetections.uses(deepCoadd_det_schema, link=peg.Link.INPUT)
+        preMergeCoaddDetections.addArguments(outPath, "--output", outPath, " --doraise")
+        for schema in ["deepCoadd_mergeDet_schema", "deepCoadd_peak_schema"]:
+            outFile = getDataFile(mapper, schema, {}, create=True)
+            dax.addFile(outFile)
+            preMergeCoaddDetections.uses(outFile, link=peg.Link.OUTPUT)
+        dax.addJob(preMergeCoaddDetections)
+
+        # pre-run measureCoaddSources
+        preMeasureCoaddSources = peg.Job(name="measureCoaddSources")
+        preMeasureCoaddSources.uses(mapperFile, link=peg.Link.INPUT)
+        preMeasureCoaddSources.uses(refCatConfigFile, link=peg.Link.INPUT)
+        preMeasureCoaddSources.addArguments(outPath, "--output", outPath, " --doraise")
+        for inputType in ["deepCoadd_mergeDet_schema", "deepCoadd_peak_schema", "src_schema"]:
+            inFile = getDataFile(mapper, inputType, {}, create=False)
+            preMeasureCoaddSources.uses(inFile, link=peg.Link.INPUT)
+
+        deepCoadd_meas_schema = getDataFile(mapper, "deepCoadd_meas_schema", {}, create=True)
+        dax.addFile(deepCoadd_meas_schema)
+        preMeasureCoaddSources.uses(deepCoadd_meas_schema, link=peg.Link.OUTPUT)
+        dax.addJob(preMeasureCoaddSources)
+
+        # pre-run mergeCoaddMeasurements
+        preMergeCoaddMeasurements = peg.Job(name="mergeCoaddMeasurements")
+        preMergeCoaddMeasurements.uses(mapperFile, link=peg.Link.INPUT)
+        preMergeCoaddMeasurements.uses(deepCoadd_meas_schema, link=peg.Link.INPUT)
+        preMergeCoaddMeasurements.addArguments(outPath, "--output", outPath, " --doraise")
+        deepCoadd_ref_schema = getDataFile(mapper, "deepCoadd_ref_schema", {}, create=True)
+        dax.addFile(deepCoadd_ref_schema)
+        preMergeCoaddMeasurements.uses(deepCoadd_ref_schema, link=peg.Link.OUTPUT)
+        dax.addJob(preMergeCoaddMeasurements)
+
+        # pre-run forcedPhotCoadd
+        preForcedPhotCoadd = peg.Job(name="forcedPhotCoadd")
+        preForcedPhotCoadd.uses(mapperFile, link=peg.Link.INPUT)
+        preForcedPhotCoadd.uses(deepCoadd_ref_schema, link=peg.Link.INPUT)
+        preForcedPhotCoadd.addArguments(outPath, "--output", outPath, " --doraise")
+        deepCoadd_forced_src_schema = getDataFile(mapper, "deepCoadd_forced_src_schema", {}, create=True)
+        dax.addFile(deepCoadd_forced_src_schema)
+        preForcedPhotCoadd.uses(deepCoadd_forced_src_schema, link=peg.Link.OUTPUT)
+        dax.addJob(preForcedPhotCoadd)
 
     # workaround for DM-10634
     filePath = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -138,15 +357,24 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
     skyMap = getDataFile(mapper, "deepCoadd_skyMap", {}, create=True, repoRoot=inputRepo)
     dax.addFile(skyMap)
 
+    flushStage(dax)
+
     # Pipeline: mosaic per filter
-    if doMosaic:
+    if doMosaic and "mosaic" in stages:
+        tractCcds = None
+        if mosaicMargin is not None:
+            tractCcds = findTractCcds(rootRepo, tractDataId, sorted(set(inputs.visits.tolist())),
+                                      range(9) + range(10, 104), margin=mosaicMargin, skyMapRoot=inputRepo,
+                                      processes=processes)
+            # The warps read the wcs and fcr of every CCD of dataDict,
+            # even one the raw header WCS puts outside the margin
+            tractCcds.update(zip(inputs.visits.tolist(), inputs.ccdIds.tolist()))
         for filterName in dataDict:
             visits = set()
             # this ccds needs to consider backlist where no sfm results are available
             ccds = range(9) + range(10, 104)
             for patchDataId in dataDict[filterName]:
-                for ccd in dataDict[filterName][patchDataId]:
-                    visitId, ccdId = map(int, ccd.split('-'))
+                for visitId, ccdId in inputs.ccds(filterName, patchDataId):
                     visits.add(visitId)
                     #ccds.add(ccd)
 
@@ -160,11 +388,12 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
             mosaic.uses(refCatSchemaFile, link=peg.Link.INPUT)
             mosaic.uses(srcSchema, link=peg.Link.INPUT)
             for visitId in visits:
-                for ccdId in ccds:
-                #visitId, ccdId = map(int, ccd.split('-'))
-                    ccdStr = "%d-%d" % (visitId, ccdId)
-                    if ccdStr in blacklist:
-                        continue
+                visitCcds = [ccdId for ccdId in ccds if (visitId, ccdId) not in blacklist and
+                             (tractCcds is None or (visitId, ccdId) in tractCcds)]
+                visitDataIds = [{'visit': visitId, 'ccd': ccdId} for ccdId in visitCcds]
+                for inputType in ["calexp", "src", "srcMatch"]:
+                    resolver.prefetch(inputType, visitDataIds)
+                for ccdId in visitCcds:
                     for inputType in ["calexp", "src", "srcMatch"]:
                         inFile = getDataFile(mapper, inputType, {'visit': visitId, 'ccd': ccdId},
                                              create=True, repoRoot=inputRepo)
@@ -180,18 +409,10 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
 
             # MosaicTask uses meas.algorithsm.LoadReferenceObjectsTask.joinMatchListWithCatalog
             # Here I use skymap patches instead, so not to read catalogs
-            refs = set()
-            for patchDataId in dataDict[filterName]:
-                tractPatchDataId = dict(tract=tractDataId, patch=patchDataId)
-                shards = findShardIdFromPatch(butler, tractPatchDataId)
-                for shard in shards:
-                    refCatFile = getDataFile(mapper, "ref_cat", {"name": refcatName, "pixel_id": shard}, create=True, repoRoot=rootRepo)
-                    if not dax.hasFile(refCatFile):
-                        dax.addFile(refCatFile)
-                        logger.debug("Add ref_cat file %s" % refCatFile)
-                    if refCatFile not in refs:
-                        mosaic.uses(refCatFile, link=peg.Link.INPUT)
-                        refs.add(refCatFile)
+            shards = sorted({shard for patchDataId in dataDict[filterName]
+                             for shard in patchShards[patchDataId]})
+            for shard in shards:
+                mosaic.uses(refCatFiles[shard], link=peg.Link.INPUT)
 
             mosaic.addArguments(
                 outPath, "--output", outPath, " --doraise",
@@ -207,64 +428,45 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
             mosaic.uses(logMosaic, link=peg.Link.OUTPUT)
             dax.addJob(mosaic)
 
+    flushStage(dax)
+
+    if "patch" not in stages:
+        shardCache.close()
+        resolver.logStats(logger)
+        return dax
+    if patches is not None:
+        dataDict = selectPatches(dataDict, patches)
+        inputs = InputIndex.fromDataDict(dataDict)
+        allPatches = inputs.allPatches
 
-    # Pipeline: makeCoaddTempExp per patch per visit per filter
+    # Pipeline: makeCoaddTempExp per patch per visit per filter, or per
+    # visit per filter for all its patches at once
     for filterName in dataDict:
+        coaddTempExpLists = defaultdict(list)
+        if visitMajor:
+            visitPatches = defaultdict(lambda: defaultdict(list))
+            for patchDataId in dataDict[filterName]:
+                for visitId, ccdId in inputs.ccds(filterName, patchDataId):
+                    visitPatches[visitId][patchDataId].append(ccdId)
+            for visitId in sorted(visitPatches):
+                for patchDataId, deepCoadd_directWarp in addMakeCoaddTempExp(
+                        dax, mapper, [mapperFile, registry, skyMap], tractDataId, filterName, visitId,
+                        visitPatches[visitId], doMosaic, inputRepo, clusterer):
+                    coaddTempExpLists[patchDataId].append(deepCoadd_directWarp)
+            flushStage(dax)
+
         for patchDataId in dataDict[filterName]:
             ident = "--id tract=%s patch=%s filter=%s" % (tractDataId, patchDataId, filterName)
-            coaddTempExpList = []
             visitDict = defaultdict(list)
-            for ccd in dataDict[filterName][patchDataId]:
-                visitId, ccdId = map(int, ccd.split('-'))
+            for visitId, ccdId in inputs.ccds(filterName, patchDataId):
                 visitDict[visitId].append(ccdId)
-            for visitId in visitDict:
-                makeCoaddTempExp = peg.Job(name="makeCoaddTempExp")
-                makeCoaddTempExp.uses(mapperFile, link=peg.Link.INPUT)
-                makeCoaddTempExp.uses(registry, link=peg.Link.INPUT)
-                makeCoaddTempExp.uses(skyMap, link=peg.Link.INPUT)
-                for ccdId in visitDict[visitId]:
-                    calexp = getDataFile(mapper, "calexp", {'visit': visitId, 'ccd': ccdId},
-                                         create=True, repoRoot=inputRepo)
-                    if not dax.hasFile(calexp):
-                        dax.addFile(calexp)
-                    makeCoaddTempExp.uses(calexp, link=peg.Link.INPUT)
-
-                if doMosaic:
-                    applyMosaic = " "
-                    for ccdId in visitDict[visitId]:
-                        for inputType in ["wcs", "fcr"]:
-                            inFile = getDataFile(mapper, inputType,
-                                         {'visit': visitId, 'ccd': ccdId, 'tract': tractDataId},
-                                         create=False)
-                            makeCoaddTempExp.uses(inFile, link=peg.Link.INPUT)
-                else:
-                    applyMosaic = " -c doApplyUberCal=False "
-
-                makeCoaddTempExp.addArguments(
-                    outPath, "--output", outPath, " --doraise",
-                    ident, applyMosaic,
-                    "--selectId visit=%s ccd=%s" % (visitId, '^'.join(str(ccdId) for ccdId in visitDict[visitId]))
-                )
-                logger.debug(
-                    "Adding makeCoaddTempExp %s %s %s %s %s %s %s",
-                    outPath, "--output", outPath, " --doraise",
-                    ident, applyMosaic,
-                    "--selectId visit=%s ccd=%s" % (visitId, '^'.join(str(ccdId) for ccdId in visitDict[visitId]))
-                )
-
-                coaddTempExpId = dict(filter=filterName, visit=visitId, tract=tractDataId, patch=patchDataId)
-                logMakeCoaddTempExp = peg.File(
-                    "logMakeCoaddTempExp.%(tract)d-%(patch)s-%(filter)s-%(visit)d" % coaddTempExpId)
-                dax.addFile(logMakeCoaddTempExp)
-                makeCoaddTempExp.setStdout(logMakeCoaddTempExp)
-                makeCoaddTempExp.uses(logMakeCoaddTempExp, link=peg.Link.OUTPUT)
-
-                deepCoadd_directWarp = getDataFile(mapper, "deepCoadd_directWarp", coaddTempExpId, create=True)
-                dax.addFile(deepCoadd_directWarp)
-                makeCoaddTempExp.uses(deepCoadd_directWarp, link=peg.Link.OUTPUT)
-                coaddTempExpList.append(deepCoadd_directWarp)
-
-                dax.addJob(makeCoaddTempExp)
+            if not visitMajor:
+                for visitId in visitDict:
+                    for _, deepCoadd_directWarp in addMakeCoaddTempExp(
+                            dax, mapper, [mapperFile, registry, skyMap], tractDataId, filterName, visitId,
+                            {patchDataId: visitDict[visitId]}, doMosaic, inputRepo, clusterer):
+                        coaddTempExpLists[patchDataId].append(deepCoadd_directWarp)
+            coaddTempExpList = coaddTempExpLists[patchDataId]
 
             # Pipeline: assembleCoadd per patch per filter
             assembleCoadd = peg.Job(name="assembleCoadd")
@@ -314,6 +516,8 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
             coadd = getDataFile(mapper, "deepCoadd", coaddId, create=True)
             dax.addFile(coadd)
             assembleCoadd.uses(coadd, link=peg.Link.OUTPUT)
+            if fuseChains:
+                fuse(assembleCoadd, chainLabel("coadd", coaddId))
             dax.addJob(assembleCoadd)
 
             # Pipeline: detectCoaddSources each coadd (per patch per filter)
@@ -335,9 +539,11 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
                 dax.addFile(outFile)
                 detectCoaddSources.uses(outFile, link=peg.Link.OUTPUT)
 
+            if fuseChains:
+                fuse(detectCoaddSources, chainLabel("coadd", coaddId))
             dax.addJob(detectCoaddSources)
 
-    allPatches = list({patch for patch in dataDict[filterName] for filterName in dataDict})
+        flushStage(dax)
 
     # Pipeline: mergeCoaddDetections per patch
     for patchDataId in allPatches:
@@ -371,8 +577,12 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
             dax.addFile(outFile)
             mergeCoaddDetections.uses(outFile, link=peg.Link.OUTPUT)
 
+        if clusterer is not None:
+            clusterer.annotate(mergeCoaddDetections, len(dataDict))
         dax.addJob(mergeCoaddDetections)
 
+    flushStage(dax)
+
     # Pipeline: measureCoaddSources per filter per patch
     for filterName in dataDict:
         for patchDataId in dataDict[filterName]:
@@ -389,13 +599,8 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
 
             # The pipeline uses the source catalog to decide what ref shards to need
             # Here I use skymap patches instead, so not to read source catalog
-            shards = findShardIdFromPatch(butler, tractPatchDataId)
-            for shard in shards:
-                refCatFile = getDataFile(mapper, "ref_cat", {"name": refcatName, "pixel_id": shard}, create=True, repoRoot=rootRepo)
-                if not dax.hasFile(refCatFile):
-                    dax.addFile(refCatFile)
-                    logger.debug("Add ref_cat file %s" % refCatFile)
-                measureCoaddSources.uses(refCatFile, link=peg.Link.INPUT)
+            for shard in patchShards[patchDataId]:
+                measureCoaddSources.uses(refCatFiles[shard], link=peg.Link.INPUT)
 
             for inputType in ["deepCoadd_mergeDet", "deepCoadd_mergeDet_schema", "deepCoadd_peak_schema"]:
                 inFile = getDataFile(mapper, inputType, tractPatchDataId, create=False)
@@ -407,8 +612,7 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
 
             # src is used in the PropagateVisitFlagsTask subtask
             measureCoaddSources.uses(srcSchema, link=peg.Link.INPUT)
-            for ccd in dataDict[filterName][patchDataId]:
-                visitId, ccdId = map(int, ccd.split('-'))
+            for visitId, ccdId in inputs.ccds(filterName, patchDataId):
                 src = getDataFile(mapper, "src", {'visit': visitId, 'ccd': ccdId},
                                   create=False)
                 measureCoaddSources.uses(src, link=peg.Link.INPUT)
@@ -431,6 +635,8 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
 
             dax.addJob(measureCoaddSources)
 
+    flushStage(dax)
+
     # Pipeline: mergeCoaddMeasurements per patch
     for patchDataId in allPatches:
         tractPatchDataId = dict(tract=tractDataId, patch=patchDataId)
@@ -459,8 +665,12 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
         dax.addFile(outFile)
         mergeCoaddMeasurements.uses(outFile, link=peg.Link.OUTPUT)
 
+        if clusterer is not None:
+            clusterer.annotate(mergeCoaddMeasurements, len(dataDict))
         dax.addJob(mergeCoaddMeasurements)
 
+    flushStage(dax)
+
     # Pipeline: forcedPhotCoadd per patch per filter
     for filterName in dataDict:
         for patchDataId in dataDict[filterName]:
@@ -496,34 +706,186 @@ def generateCoaddDax(name="dax", tractDataId=0, dataDict=None, blacklist=None, d
 
             dax.addJob(forcedPhotCoadd)
 
+    if completed is not None:
+        logger.info("Reused the outputs of %d jobs", completed.reusedJobs)
+    shardCache.close()
+    resolver.logStats(logger)
     return dax
 
 
+def _generatePartition(task):
+    name, tractDataId, dataDict, blacklist, stages, options = task
+    return generateCoaddDax(name, tractDataId, dataDict, blacklist=blacklist, compact=True, stages=stages,
+                            **options)
+
+
+def generateCoaddDaxCached(name, tractDataId, dataDict, blacklist, cacheDir, processes=1, **options):
+    """Generate the coadd workflow of a tract from cached partitions
+
+    The workflow is split as in generateDaxHierarchical.py into a tract
+    partition, with the pre-runs and the mosaic, and one partition per
+    patch.  Each is kept in a graphCache.GraphCache under cacheDir,
+    keyed by its inputs, the options and the generator source, so that
+    after a change to the input data or the blacklist only the
+    partitions it touches are generated again, with processes worker
+    processes.  The partitions are merged into one jobGraph.JobGraph.
+
+    Parameters
+    ----------
+    name: `str`
+        Name of the ADAG
+    tractDataId: `int`
+        Tract ID
+    dataDict: `dict`
+        dataDict[filterName][patch] is a list of 'visit-ccd'
+    blacklist: `inputIndex.Blacklist`
+        CCDs to ignore
+    cacheDir: `str`
+        Directory of the caches; each tract has its own
+    processes: `int`, optional
+        Number of processes generating partitions
+    options:
+        Passed to generateCoaddDax; resumeFrom and outputFile are not
+        supported
+
+    Returns
+    -------
+    graph: `jobGraph.JobGraph`
+        The workflow
+    """
+    for option in ("resumeFrom", "outputFile"):
+        if options.get(option) is not None:
+            raise ValueError("generateCoaddDaxCached does not support %s" % option)
+    repo = options.get("inputRepo", inputRepo)
+    salt = sourceHash("generateDaxCoadd")
+    # The shard lists of the patches depend on the ref_cat config
+    salt += configHash([os.path.join(rootRepo, "ref_cats", refcatName, "config.py")],
+                       extra=fileStamps([os.path.join(rootRepo, "registry.sqlite3"),
+                                         os.path.join(repo, "deepCoadd", "skyMap.pickle")]))
+    cache = GraphCache(os.path.join(cacheDir, "coadd-%d" % tractDataId), salt=salt)
+
+    # The blacklist is only read by the mosaic; the patch stages take
+    # the CCDs of dataDict as they are
+    partitions = [(cache.key("tract", tractDataId, dataDict, sorted(blacklist), options),
+                   ("%s-tract" % name, tractDataId, dataDict, blacklist, ("prerun", "mosaic"), options))]
+    allPatches = sorted({patch for filterName in dataDict for patch in dataDict[filterName]})
+    for patch in allPatches:
+        patchDict = selectPatches(dataDict, [patch])
+        partitions.append((cache.key("patch", tractDataId, patch, patchDict, options),
+                           ("%s-%s" % (name, patch), tractDataId, patchDict, blacklist, ("patch",), options)))
+
+    graphs = [cache.get(key) for key, task in partitions]
+    tasks = [task for graph, (key, task) in zip(graphs, partitions) if graph is None]
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            built = pool.map(_generatePartition, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        built = [_generatePartition(task) for task in tasks]
+
+    built = iter(built)
+    graph = JobGraph(name)
+    for i, (key, task) in enumerate(partitions):
+        if graphs[i] is None:
+            graphs[i] = next(built)
+            cache.put(key, graphs[i])
+        graph.merge(graphs[i])
+    cache.prune([key for key, task in partitions])
+    cache.logStats(logger)
+    return graph
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a DAX")
     parser.add_argument("-t", "--tractId", type=int, default=8766,
                         help="the tract ID of the input file")
     parser.add_argument("-i", "--inputData", default="rcHsc/smallFPVC_t8766",
-                        help="a file including input data information")
+                        help="a file including input data information, or its .npz from inputIndex.py")
+    parser.add_argument("--visits", default=None,
+                        help="compute the input data from the raw headers of the visits in this file "
+                        "instead of reading it from --inputData")
     parser.add_argument("-b", "--blacklist", default="rcHsc/rcBlacklist.txt",
                         help="a file including visit-ccd to ignore")
     parser.add_argument("-o", "--outputFile", type=str, default="HscRcTest.dax",
                         help="file name for the output dax xml")
+    parser.add_argument("--noMosaic", action="store_true", default=False,
+                        help="skip the mosaic stage")
+    parser.add_argument("--mosaicMargin", type=float, default=None, metavar="PIXELS",
+                        help="give the mosaic only the CCDs within this many tract pixels of the tract, "
+                        "from the raw headers, instead of all CCDs of its visits")
+    parser.add_argument("--inputRepo", default=inputRepo,
+                        help="repo with the processCcd outputs and the sky map")
+    parser.add_argument("--requireCalexps", action="store_true", default=False,
+                        help="leave out the CCDs without a calexp in the input repo")
+    parser.add_argument("--noTemplates", action="store_true", default=False,
+                        help="resolve every path through CameraMapper.map_*")
+    parser.add_argument("--verifyTemplates", type=int, default=3,
+                        help="number of template paths per dataset type to check against map_*")
+    parser.add_argument("--shardCache", default="shardCache.sqlite3",
+                        help="SQLite file caching ref_cat shards; shared with generateDaxSfm.py")
+    parser.add_argument("--shardSelection", choices=SHARD_SELECTIONS, default="circle",
+                        help="select ref_cat shards by a bounding circle or the patch outline")
+    parser.add_argument("--clusterRuntime", type=int, default=None, metavar="SECONDS",
+                        help="mark makeCoaddTempExp and the merge jobs for horizontal clustering into "
+                        "jobs of about this runtime; plan with --cluster horizontal")
+    parser.add_argument("--runtimeStats", default=None,
+                        help="file of 'transformation nInputs seconds' of past jobs to estimate runtimes")
+    parser.add_argument("--fuse", action="store_true", default=False,
+                        help="run assembleCoadd and detectCoaddSources of each patch and filter as one job; "
+                        "plan with --cluster label")
+    parser.add_argument("--visitMajor", action="store_true", default=False,
+                        help="one makeCoaddTempExp job per visit and filter for all its patches; saves job "
+                        "startup and scheduling, each calexp is still read once per patch")
+    parser.add_argument("--resumeFrom", action="append", default=None, metavar="PATH",
+                        help="output repo or Pegasus submit directory of an earlier run; jobs whose "
+                        "outputs are there are left out and the outputs used as inputs; repeatable")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="write the DAX stage by stage instead of building it in memory; "
+                        "gzip-compressed if the output file ends with .gz")
+    parser.add_argument("--compact", action="store_true", default=False,
+                        help="hold the workflow as a compact job graph until it is written")
+    parser.add_argument("--graphCache", default=None, metavar="DIR",
+                        help="reuse the patch and tract parts of the workflow cached in DIR by earlier runs "
+                        "and generate only the changed ones")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of processes reading headers with --visits or --mosaicMargin and "
+                        "generating the parts of the workflow with --graphCache")
     args = parser.parse_args()
-
-    with open(args.blacklist, "r") as f:
-        blacklist = [line.rstrip() for line in f]
-
-    from collections import defaultdict
-    dataDict = defaultdict(dict)
-    # dataDict[filterName][patch] is a list of 'visit-ccd'
-    with open(args.inputData, "r") as f:
-        for line in f:
-            filterName, patchId, visitCcd = line.rstrip().split('|')
-            if visitCcd not in blacklist:
-                dataDict[filterName][patchId] = visitCcd.split(',')
+    if args.mosaicMargin is not None and args.mosaicMargin < 0:
+        parser.error("--mosaicMargin must not be negative")
+
+    blacklist = readBlacklist(args.blacklist)
+    if args.visits is not None:
+        with open(args.visits) as f:
+            visits = [line.strip() for line in f if line.strip()]
+        inputs = computeOverlaps(rootRepo, args.tractId, visits, range(9) + range(10, 104),
+                                 skyMapRoot=args.inputRepo, processes=args.processes)
+        dataDict = inputs.dataDict(blacklist)
+    else:
+        dataDict = readInputData(args.inputData, blacklist)
+    if args.requireCalexps:
+        dataDict, blacklist = dropUnprocessedCcds(dataDict, blacklist, args.inputRepo)
 
     logger.debug("dataDict: %s", dataDict)
-    dax = generateCoaddDax("HscCoaddDax", args.tractId, dataDict, blacklist=blacklist, doMosaic=True)
-    with open(args.outputFile, "w") as f:
-        dax.writeXML(f)
+    clusterer = None
+    if args.clusterRuntime is not None:
+        runtimes = loadRuntimeStats(args.runtimeStats) if args.runtimeStats else None
+        clusterer = RuntimeClusterer(args.clusterRuntime, runtimes)
+    options = dict(doMosaic=not args.noMosaic, useTemplates=not args.noTemplates,
+                   verifyTemplates=args.verifyTemplates, shardCachePath=args.shardCache,
+                   shardSelection=args.shardSelection, inputRepo=args.inputRepo, clusterer=clusterer,
+                   fuseChains=args.fuse, visitMajor=args.visitMajor, mosaicMargin=args.mosaicMargin)
+    if args.graphCache is not None:
+        for option in ("resumeFrom", "stream", "compact"):
+            if getattr(args, option):
+                parser.error("--%s cannot be used with --graphCache" % option)
+        dax = generateCoaddDaxCached("HscCoaddDax", args.tractId, dataDict, blacklist, args.graphCache,
+                                     processes=args.processes, **options)
+    else:
+        dax = generateCoaddDax("HscCoaddDax", args.tractId, dataDict, blacklist=blacklist,
+                               outputFile=args.outputFile if args.stream else None, compact=args.compact,
+                               resumeFrom=args.resumeFrom, processes=args.processes, **options)
+    writeDax(dax, args.outputFile)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Generate an SFM workflow that generates its coadd sub-workflow when done
+
+The DAX has the processCcd jobs of generateDaxSfm.py, then a job on the
+submit host running generateDaxCoadd.py --requireCalexps on the SFM
+output repo, as generateDax2.py in exampleHierarchical, and a peg.DAX
+job planning and running the coadd DAX it writes.  Only the SFM part is
+generated before submission, and the coadd jobs are planned against
+the calexps actually produced instead of all CCDs not blacklisted: a
+processCcd job failing after its retries is marked done by the
+allowFailure.sh POST script, so the generation job still runs and
+leaves its CCD out.
+"""
+import argparse
+import os
+
+import Pegasus.DAX3 as peg
+import lsst.log
+from generateDaxSfm import generateSfmDax
+from generateDaxHierarchical import addSubDax
+from planWorkflows import baseDir
+
+logger = lsst.log.Log.getLogger("workflow")
+logger.setLevel(lsst.log.INFO)
+
+# DAGMan POST script of the processCcd jobs ignoring their last failure
+ALLOW_FAILURE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "allowFailure.sh")
+
+
+def allowFailure(job):
+    """Make a job count as done for DAGMan once it failed all its retries"""
+    job.addProfile(peg.Profile("dagman", "POST", "allowFailure"))
+    job.addProfile(peg.Profile("dagman", "POST.PATH.allowFailure", ALLOW_FAILURE))
+    job.addProfile(peg.Profile("dagman", "POST.ARGUMENTS", "$RETURN $RETRY $MAX_RETRIES"))
+
+
+def addDeferredCoadd(dax, tractDataId, inputData, blacklistFile, coaddDaxFile, sfmRepo,
+                     site="lsstvc", tcFile="tc.txt", doMosaic=True, shardCachePath="shardCache.sqlite3"):
+    """Add the jobs generating and running the coadd workflow after all others
+
+    Parameters
+    ----------
+    dax: `dependencyIndex.IndexedADAG`
+        The SFM workflow
+    tractDataId: `int`
+        Tract ID
+    inputData, blacklistFile: `str`
+        Input data and blacklist files of generateDaxCoadd.py
+    coaddDaxFile: `str`
+        Where the generation job writes the coadd DAX
+    sfmRepo: `str`
+        Repo of the SFM outputs, as seen from the submit host
+    site, tcFile: `str`, optional
+        Execution site and transformation catalog of the coadd workflow
+    doMosaic: `bool`, optional
+        Run mosaic in the coadd workflow
+    shardCachePath: `str`, optional
+        SQLite file caching ref_cat shards, shared with the generation job
+
+    Returns
+    -------
+    generateJob, coaddJob: `peg.Job`, `peg.DAX`
+        The added jobs
+    """
+    sfmJobs = list(dax.jobs.values())
+
+    # The generator runs in place, next to the modules it imports
+    generator = peg.Executable(name="generateDaxCoadd.py", arch="x86_64", installed=True)
+    generator.addPFN(peg.PFN("file://" + os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                      "generateDaxCoadd.py"), "local"))
+    dax.addExecutable(generator)
+
+    generateJob = peg.Job(name="generateDaxCoadd.py")
+    generateJob.addProfile(peg.Profile("hints", "execution.site", "local"))
+    generateJob.addArguments("-t", str(tractDataId), "-i", os.path.abspath(inputData),
+                             "-b", os.path.abspath(blacklistFile), "-o", os.path.abspath(coaddDaxFile),
+                             "--inputRepo", sfmRepo, "--requireCalexps",
+                             "--shardCache", os.path.abspath(shardCachePath))
+    if not doMosaic:
+        generateJob.addArguments("--noMosaic")
+    dax.addJob(generateJob)
+    # The calexps are found on disk by the job, not staged to it; the
+    # CCDs whose processCcd failed have none and are dropped
+    for job in sfmJobs:
+        allowFailure(job)
+        dax.depends(parent=job, child=generateJob)
+
+    coaddJob = addSubDax(dax, coaddDaxFile, site=site, tcFile=tcFile)
+    dax.depends(parent=generateJob, child=coaddJob)
+    return generateJob, coaddJob
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate an SFM DAX generating its coadd DAX at run time")
+    parser.add_argument("-v", "--visits", default="rcHsc/visitsRcTest.txt",
+                        help="a file of the visits to process")
+    parser.add_argument("-t", "--tractId", type=int, default=8766,
+                        help="the tract ID of the coadd input file")
+    parser.add_argument("-i", "--inputData", default="rcHsc/rcFPVC_8766",
+                        help="a file including the coadd input data information")
+    parser.add_argument("-b", "--blacklist", default="rcHsc/rcBlacklist.txt",
+                        help="a file including visit-ccd to ignore")
+    parser.add_argument("-o", "--outputFile", type=str, default="HscRcDeferred.dax",
+                        help="file name for the output dax xml")
+    parser.add_argument("--coaddDax", default="HscRcDeferredCoadd.dax",
+                        help="file name for the coadd dax xml written at run time")
+    parser.add_argument("--sfmRepo", default=os.path.join(baseDir, "output", "repo"),
+                        help="repo of the processCcd outputs, as staged out by plan_dax.sh")
+    parser.add_argument("--site", default="lsstvc", help="execution site of the coadd workflow")
+    parser.add_argument("--tc", dest="tcFile", default="tc.txt",
+                        help="transformation catalog file of the coadd workflow")
+    parser.add_argument("--noMosaic", action="store_true", default=False,
+                        help="skip the mosaic stage")
+    parser.add_argument("--shardCache", default="shardCache.sqlite3",
+                        help="SQLite file caching ref_cat shards")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of processes describing processCcd jobs")
+    args = parser.parse_args()
+    with open(args.visits) as f:
+        visits = [line.rstrip() for line in f]
+
+    ccdList = range(9) + range(10, 104)
+    dax = generateSfmDax("HscDeferredDax", visits, ccdList, shardCachePath=args.shardCache,
+                         processes=args.processes)
+    addDeferredCoadd(dax, args.tractId, args.inputData, args.blacklist, args.coaddDax, args.sfmRepo,
+                     site=args.site, tcFile=args.tcFile, doMosaic=not args.noMosaic,
+                     shardCachePath=args.shardCache)
+    with open(args.outputFile, "w") as f:
+        dax.writeXML(f)
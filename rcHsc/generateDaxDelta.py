@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""Generate the workflow processing the visits added since an earlier run
+
+Given the visit list of the earlier run and the current one, the DAX
+has the processCcd jobs of the new visits only and the coadd jobs of
+the patches they overlap, on top of the output repo of the earlier
+runs.  As in a run with --resumeFrom, the jobs whose outputs are in
+that repo, e.g. the schema pre-runs, makeSkyMap and the warps of the
+old visits, are left out and their outputs used as inputs; the coadds
+of the touched patches and everything downstream are made again.
+
+If the earlier run had the mosaic, the warps of the old visits were
+made with its calibration, so the mosaic of the tract is run again and
+all the warps of the touched patches with it.
+"""
+import argparse
+
+import lsst.log
+from lsst.daf.persistence import Butler
+from generateDaxCoadd import COADD_STAGES, generateCoaddDax, readBlacklist, readInputData
+from generateDaxSfm import generateSfmDax
+from inputIndex import InputIndex
+from jobGraph import JobGraph
+
+logger = lsst.log.Log.getLogger("workflow")
+logger.setLevel(lsst.log.INFO)
+
+
+def readVisits(path):
+    """Return the visits of a visit list file, one per line"""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def findNewVisits(previousVisits, visits):
+    """Return the visits not in previousVisits, in their order in visits"""
+    previousVisits = set(previousVisits)
+    return [visit for visit in visits if visit not in previousVisits]
+
+
+def findTouchedPatches(dataDict, visits):
+    """Return the patches with a CCD of visits in any filter of dataDict"""
+    inputs = InputIndex.fromDataDict(dataDict)
+    return sorted({patch for visit in visits for patch in inputs.patchesOfVisit(visit)})
+
+
+def hasMosaic(repo, tractDataId, dataDict, visits, maxChecks=20):
+    """Return whether repo has the mosaic outputs of CCDs of visits
+
+    Up to maxChecks CCDs of visits in dataDict are looked for.
+    """
+    butler = Butler(repo)
+    inputs = InputIndex.fromDataDict(dataDict)
+    visits = set(int(visit) for visit in visits)
+    checked = 0
+    for visit, ccd in zip(inputs.visits.tolist(), inputs.ccdIds.tolist()):
+        if visit not in visits:
+            continue
+        if butler.datasetExists("wcs", visit=visit, ccd=ccd, tract=tractDataId):
+            return True
+        checked += 1
+        if checked >= maxChecks:
+            break
+    return False
+
+
+def generateDeltaDax(name, previousVisits, visits, ccdList, tractDataId, dataDict, blacklist, repo,
+                     doMosaic=None, processes=1, useTemplates=True, shardCachePath="shardCache.sqlite3",
+                     shardSelection="circle"):
+    """Generate the SFM and coadd jobs needed for the new visits
+
+    Parameters
+    ----------
+    name: `str`
+        Name of the ADAG
+    previousVisits, visits: `list` of `str`
+        The visits of the earlier run and of this one
+    ccdList: `list` of `int`
+        CCDs to process in each new visit
+    tractDataId: `int`
+        Tract ID
+    dataDict: `dict`
+        dataDict[filterName][patch] is a list of 'visit-ccd' of the
+        whole tract, with the new visits
+    blacklist: `inputIndex.Blacklist`
+        CCDs to ignore
+    repo: `str`
+        The output repo of the earlier runs, with the calexps of the old
+        visits, the sky map and the warps
+    doMosaic: `bool`, optional
+        Run the mosaic of the whole tract again; then all warps of the
+        touched patches depend on it and are made again too.  By default
+        it is run if repo has mosaic outputs of the old visits; it cannot
+        be turned off then, as the new warps would be calibrated
+        differently from the old ones
+    processes: `int`, optional
+        Number of processes describing processCcd jobs
+    useTemplates, shardCachePath, shardSelection: optional
+        As in generateSfmDax and generateCoaddDax
+
+    Returns
+    -------
+    graph: `jobGraph.JobGraph`
+        The workflow; the warps of the new visits depend on their
+        processCcd jobs
+
+    Raises
+    ------
+    RuntimeError
+        If doMosaic is False and the earlier run had the mosaic
+    """
+    newVisits = findNewVisits(previousVisits, visits)
+    patches = findTouchedPatches(dataDict, newVisits)
+    logger.info("%d new visits of %d touch %d patches of tract %d", len(newVisits), len(visits),
+                len(patches), tractDataId)
+    if doMosaic is not True and patches:
+        earlierMosaic = hasMosaic(repo, tractDataId, dataDict, previousVisits)
+        if doMosaic is None:
+            doMosaic = earlierMosaic
+        elif earlierMosaic:
+            raise RuntimeError("The warps in %s were made with the mosaic; the new ones cannot be made "
+                               "without it" % repo)
+
+    graph = JobGraph(name)
+    if newVisits:
+        graph.merge(generateSfmDax("%s-sfm" % name, newVisits, ccdList, useTemplates=useTemplates,
+                                   shardCachePath=shardCachePath, processes=processes,
+                                   shardSelection=shardSelection, compact=True, resumeFrom=[repo]))
+    if patches:
+        # The mosaic fits the whole tract, the patch stage only the touched patches
+        stages = COADD_STAGES if doMosaic else ("prerun", "patch")
+        graph.merge(generateCoaddDax("%s-coadd" % name, tractDataId, dataDict, blacklist=blacklist,
+                                     doMosaic=doMosaic, useTemplates=useTemplates,
+                                     shardCachePath=shardCachePath, shardSelection=shardSelection,
+                                     compact=True, stages=stages, inputRepo=repo, resumeFrom=[repo],
+                                     patches=patches))
+    logger.info("%s: %s", name, graph.stats())
+    return graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a DAX for the visits added since an earlier run")
+    parser.add_argument("-p", "--previousVisits", required=True,
+                        help="the visit list of the earlier run")
+    parser.add_argument("-v", "--visits", default="rcHsc/visitsRcWide.txt",
+                        help="the current visit list")
+    parser.add_argument("-t", "--tractId", type=int, default=8766,
+                        help="the tract ID of the input file")
+    parser.add_argument("-i", "--inputData", default="rcHsc/rcFPVC_8766",
+                        help="a file including input data information, with the new visits")
+    parser.add_argument("-b", "--blacklist", default="rcHsc/rcBlacklist.txt",
+                        help="a file including visit-ccd to ignore")
+    parser.add_argument("-r", "--repo", required=True,
+                        help="output repo of the earlier runs")
+    parser.add_argument("-o", "--outputFile", type=str, default="HscRcDelta.dax",
+                        help="file name for the output dax xml")
+    parser.add_argument("--mosaic", dest="doMosaic", action="store_true", default=None,
+                        help="run the mosaic of the tract again and remake all warps of the touched patches; "
+                        "the default if the repo has mosaic outputs")
+    parser.add_argument("--noMosaic", dest="doMosaic", action="store_false",
+                        help="do not run the mosaic; refused if the repo has mosaic outputs")
+    parser.add_argument("--noTemplates", action="store_true", default=False,
+                        help="resolve every path through CameraMapper.map_*")
+    parser.add_argument("--shardCache", default="shardCache.sqlite3",
+                        help="SQLite file caching ref_cat shards")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of processes describing processCcd jobs")
+    args = parser.parse_args()
+
+    blacklist = readBlacklist(args.blacklist)
+    dataDict = readInputData(args.inputData, blacklist)
+    ccdList = range(9) + range(10, 104)
+    graph = generateDeltaDax("HscDeltaDax", readVisits(args.previousVisits), readVisits(args.visits), ccdList,
+                             args.tractId, dataDict, blacklist, args.repo, doMosaic=args.doMosaic,
+                             processes=args.processes, useTemplates=not args.noTemplates,
+                             shardCachePath=args.shardCache)
+    with open(args.outputFile, "w") as f:
+        graph.writeXML(f)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Split the coadd workflow of a tract into per-patch sub-workflows
+
+A tract sub-DAX has the schema pre-runs and the mosaic; each patch
+sub-DAX has the per-patch pipeline of a group of patches.  A top-level
+DAX runs them as peg.DAX jobs, the patch ones after the tract one, as
+in exampleHierarchical/generateDax1.py.  Every sub-workflow is planned
+by itself when DAGMan reaches it, so planning time and DAGMan memory go
+with the patch group rather than the tract.
+"""
+import argparse
+import multiprocessing
+import os
+
+import Pegasus.DAX3 as peg
+import lsst.log
+from daxWriter import makeADAG
+from generateDaxCoadd import generateCoaddDax, readBlacklist, readInputData, selectPatches
+from planWorkflows import baseDir, planArguments, planDaxes
+
+logger = lsst.log.Log.getLogger("workflow")
+logger.setLevel(lsst.log.INFO)
+
+
+def groupPatches(dataDict, patchesPerDax=1):
+    """Return the patches of dataDict in sorted groups of patchesPerDax"""
+    allPatches = sorted({patch for filterName in dataDict for patch in dataDict[filterName]})
+    return [allPatches[i:i + patchesPerDax] for i in range(0, len(allPatches), patchesPerDax)]
+
+
+def _writeSubDax(task):
+    daxFile, name, tractDataId, dataDict, blacklist, stages, options = task
+    graph = generateCoaddDax(name, tractDataId, dataDict, blacklist=blacklist, compact=True,
+                             stages=stages, **options)
+    with open(daxFile, "w") as f:
+        graph.writeXML(f)
+    logger.info("%s: %s", daxFile, graph.stats())
+    return daxFile
+
+
+def addSubDax(dax, daxFile, site="lsstvc", tcFile="tc.txt", configDir=baseDir):
+    """Add a job planning and running the DAX in daxFile"""
+    basename = os.path.splitext(os.path.basename(daxFile))[0]
+    subDaxFile = peg.File(os.path.basename(daxFile))
+    subDaxFile.addPFN(peg.PFN("file://" + os.path.abspath(daxFile), "local"))
+    dax.addFile(subDaxFile)
+
+    job = peg.DAX(os.path.basename(daxFile))
+    job.addArguments(*(planArguments(site=site, tcFile=tcFile, configDir=configDir) +
+                       ["--output-site", "local", "--basename", basename]))
+    job.uses(subDaxFile, link=peg.Link.INPUT)
+    dax.addDAX(job)
+    return job
+
+
+def generateHierarchicalDax(name, tractDataId, dataDict, blacklist, outputDir=".", patchesPerDax=1,
+                            processes=1, site="lsstvc", tcFile="tc.txt", **options):
+    """Write the sub-DAXes of a tract and return the top-level DAX
+
+    Parameters
+    ----------
+    name: `str`
+        Name of the top-level ADAG; the sub-DAX files are named after it
+    tractDataId: `int`
+        Tract ID
+    dataDict: `dict`
+        dataDict[filterName][patch] is a list of 'visit-ccd'
+    blacklist: `list`
+        'visit-ccd' to ignore
+    outputDir: `str`, optional
+        Where to write the sub-DAXes
+    patchesPerDax: `int`, optional
+        Number of patches in each patch sub-DAX
+    processes: `int`, optional
+        Number of processes generating sub-DAXes
+    site, tcFile: `str`, optional
+        Execution site and transformation catalog of the sub-workflows
+    options:
+        Passed to generateCoaddDax
+
+    Returns
+    -------
+    dax: `dependencyIndex.IndexedADAG`
+        The top-level DAX
+    daxFiles: `list` of `str`
+        The sub-DAX files, the tract one first
+    """
+    tractName = "%s-%d-tract" % (name, tractDataId)
+    tasks = [(os.path.join(outputDir, tractName + ".dax"), tractName, tractDataId, dataDict, blacklist,
+              ("prerun", "mosaic"), options)]
+    for i, patches in enumerate(groupPatches(dataDict, patchesPerDax)):
+        patchName = "%s-%d-%03d" % (name, tractDataId, i)
+        tasks.append((os.path.join(outputDir, patchName + ".dax"), patchName, tractDataId,
+                      selectPatches(dataDict, patches), blacklist, ("patch",), options))
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            daxFiles = pool.map(_writeSubDax, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        daxFiles = [_writeSubDax(task) for task in tasks]
+
+    dax = makeADAG(name)
+    tractJob = addSubDax(dax, daxFiles[0], site=site, tcFile=tcFile)
+    for daxFile in daxFiles[1:]:
+        patchJob = addSubDax(dax, daxFile, site=site, tcFile=tcFile)
+        dax.depends(parent=tractJob, child=patchJob)
+    return dax, daxFiles
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a hierarchical coadd DAX of per-patch sub-DAXes")
+    parser.add_argument("-t", "--tractId", type=int, default=8766,
+                        help="the tract ID of the input file")
+    parser.add_argument("-i", "--inputData", default="rcHsc/smallFPVC_t8766",
+                        help="a file including input data information")
+    parser.add_argument("-b", "--blacklist", default="rcHsc/rcBlacklist.txt",
+                        help="a file including visit-ccd to ignore")
+    parser.add_argument("-o", "--outputFile", type=str, default="HscRcCoadd.dax",
+                        help="file name for the top-level dax xml")
+    parser.add_argument("--subDaxDir", default=".",
+                        help="directory of the sub-DAX files")
+    parser.add_argument("--patchesPerDax", type=int, default=1,
+                        help="number of patches in each sub-DAX")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of processes generating sub-DAXes and planning them with --plan")
+    parser.add_argument("--site", default="lsstvc", help="execution site of the sub-workflows")
+    parser.add_argument("--tc", dest="tcFile", default="tc.txt",
+                        help="transformation catalog file of the sub-workflows")
+    parser.add_argument("--plan", action="store_true", default=False,
+                        help="also plan every sub-DAX in parallel, without submitting, to check them")
+    parser.add_argument("--noMosaic", action="store_true", default=False,
+                        help="skip the mosaic stage")
+    parser.add_argument("--noTemplates", action="store_true", default=False,
+                        help="resolve every path through CameraMapper.map_*")
+    parser.add_argument("--shardCache", default="shardCache.sqlite3",
+                        help="SQLite file caching ref_cat shards")
+    args = parser.parse_args()
+
+    blacklist = readBlacklist(args.blacklist)
+    dataDict = readInputData(args.inputData, blacklist)
+    dax, daxFiles = generateHierarchicalDax("HscCoaddDax", args.tractId, dataDict, blacklist,
+                                            outputDir=args.subDaxDir, patchesPerDax=args.patchesPerDax,
+                                            processes=args.processes, site=args.site, tcFile=args.tcFile,
+                                            doMosaic=not args.noMosaic, useTemplates=not args.noTemplates,
+                                            shardCachePath=args.shardCache)
+    with open(args.outputFile, "w") as f:
+        dax.writeXML(f)
+    logger.info("Wrote %s with %d sub-DAXes", args.outputFile, len(daxFiles))
+
+    if args.plan:
+        planDaxes(daxFiles, submitDir=os.path.join(baseDir, "submit", "check"), processes=args.processes,
+                  site=args.site, tcFile=args.tcFile)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+from collections import OrderedDict
+
+import lsst.log
+from generateDaxCoadd import generateCoaddDax, readBlacklist, readInputData
+from inputIndex import Blacklist
+from jobGraph import JobGraph
+
+logger = lsst.log.Log.getLogger("workflow")
+logger.setLevel(lsst.log.INFO)
+
+
+def _generateTract(task):
+    tract, inputData, blacklist, options = task
+    dataDict = readInputData(inputData, blacklist)
+    graph = generateCoaddDax("HscCoaddDax_%d" % tract, tract, dataDict, blacklist=blacklist,
+                             compact=True, **options)
+    logger.info("Tract %d: %s", tract, graph.stats())
+    return tract, graph
+
+
+def generateTractGraphs(tractInputs, blacklist=(), processes=1, **options):
+    """Generate the coadd workflows of several tracts
+
+    Parameters
+    ----------
+    tractInputs: `list` of `tuple`
+        (tract, inputData file) pairs
+    blacklist: `list`, optional
+        'visit-ccd' to ignore
+    processes: `int`, optional
+        Number of worker processes, each generating one tract at a time
+    options:
+        Passed to generateCoaddDax
+
+    Returns
+    -------
+    graphs: `OrderedDict`
+        The jobGraph.JobGraph of each tract, in the order of tractInputs
+    """
+    tasks = [(tract, inputData, Blacklist(blacklist), options) for tract, inputData in tractInputs]
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_generateTract, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_generateTract(task) for task in tasks]
+    return OrderedDict(results)
+
+
+def mergeTractGraphs(name, graphs):
+    """Merge the tract workflows into one
+
+    Input files shared by tracts, such as calexps of CCDs overlapping
+    several tracts and ref_cat shards, are declared once, and the schema
+    pre-runs are shared.
+    """
+    merged = JobGraph(name)
+    for tract, graph in graphs.items():
+        merged.merge(graph)
+    logger.info("Merged %d tracts: %s", len(graphs), merged.stats())
+    return merged
+
+
+def writeManifest(graphs, path):
+    """Write the input files of all tracts as a replica catalog file
+
+    Each (lfn, pfn, site) is written once however many tracts use it.
+    """
+    entries = set()
+    for graph in graphs.values():
+        entries.update(graph.replicaEntries())
+    with open(path, "w") as f:
+        for lfn, url, site in sorted(entries):
+            f.write('%s %s site="%s"\n' % (lfn, url, site))
+    logger.info("Wrote %d replica entries to %s", len(entries), path)
+
+
+def parseTractInput(value):
+    """Parse a TRACT:FILE command-line value"""
+    tract, inputData = value.split(":", 1)
+    return int(tract), inputData
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the coadd DAX of several tracts")
+    parser.add_argument("-t", "--tract", dest="tractInputs", type=parseTractInput, action="append",
+                        required=True, metavar="TRACT:FILE",
+                        help="a tract ID and its input data file; repeat for each tract")
+    parser.add_argument("-b", "--blacklist", default="rcHsc/rcBlacklist.txt",
+                        help="a file including visit-ccd to ignore")
+    parser.add_argument("-o", "--outputFile", type=str, default="HscRcCoadd.dax",
+                        help="file name for the merged dax xml")
+    parser.add_argument("--perTract", default=None, metavar="PREFIX",
+                        help="write PREFIX<tract>.dax per tract and the --manifest instead of a merged DAX")
+    parser.add_argument("--manifest", default="rc.txt",
+                        help="replica catalog file of the inputs of all tracts, with --perTract; "
+                        "point pegasus.catalog.replica.file to it")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of processes generating tracts")
+    parser.add_argument("--noMosaic", action="store_true", default=False,
+                        help="skip the mosaic stage")
+    parser.add_argument("--noTemplates", action="store_true", default=False,
+                        help="resolve every path through CameraMapper.map_*")
+    parser.add_argument("--shardCache", default="shardCache.sqlite3",
+                        help="SQLite file caching ref_cat shards; shared by all tracts")
+    args = parser.parse_args()
+
+    blacklist = readBlacklist(args.blacklist)
+    graphs = generateTractGraphs(args.tractInputs, blacklist=blacklist, processes=args.processes,
+                                 doMosaic=not args.noMosaic, useTemplates=not args.noTemplates,
+                                 shardCachePath=args.shardCache)
+    if args.perTract is not None:
+        writeManifest(graphs, args.manifest)
+        for tract, graph in graphs.items():
+            with open("%s%d.dax" % (args.perTract, tract), "w") as f:
+                graph.writeXML(f, declareInputs=False)
+    else:
+        dax = mergeTractGraphs("HscCoaddDax", graphs)
+        with open(args.outputFile, "w") as f:
+            dax.writeXML(f)
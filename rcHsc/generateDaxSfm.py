@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 import argparse
+import itertools
+import multiprocessing
 import os
+from collections import OrderedDict
 import Pegasus.DAX3 as peg
 
 import lsst.log
@@ -8,8 +11,15 @@ import lsst.utils
 from lsst.utils import getPackageDir
 from lsst.daf.persistence import Butler
 from lsst.obs.hsc.hscMapper import HscMapper
-from findShardId import findShardIdFromExpId
-from getDataFile import getDataFile
+from daxWriter import flushStage, makeADAG, writeDax
+from findShardId import SHARD_SELECTIONS, findShardIdsFromExpIds
+from getDataFile import getDataFile, getResolver
+from graphCache import GraphCache, fileStamps, sourceHash
+from pathTemplates import PathTemplateResolver
+from registryIndex import RawRegistryIndex
+from calibIndex import loadCalibAssignment
+from resume import CompletedOutputs
+from shardCache import configHash, openShardCache
 
 logger = lsst.log.Log.getLogger("workflow")
 logger.setLevel(lsst.log.INFO)
@@ -27,18 +37,204 @@ calibRepo = "/datasets/hsc/repo/CALIB/"
 # This is a config of LoadIndexedReferenceObjectsTask ref_dataset_name
 refcatName = "ps1_pv3_3pi_20170110"
 
+# Hack to set fringe filters
+# Cannot directly read from obs_subaru/config/hsc/isr.py because
+# config uses abbrev names config.fringe.filters = ['y', 'N921']
+fringeFilters = ["HSC-Y", "NB0921"]
 
-def generateSfmDax(name="dax", visits=None, ccdList=None):
-    """Generate a Pegasus DAX abstract workflow"""
-    try:
-        from AutoADAG import AutoADAG
-    except ImportError:
-        dax = peg.ADAG(name)
+# request_memory in MB of each processCcd process, as in tc.txt
+processCcdMemory = 4000
+
+
+def makeResolver(mapper, useTemplates=True, verifyTemplates=3, registryIndex=None, calibAssignment=None):
+    """Return the shared DataFileResolver of the mapper, with templates if asked"""
+    if useTemplates:
+        pathResolver = PathTemplateResolver(mapper, verifySample=verifyTemplates,
+                                            registryIndex=registryIndex, calibAssignment=calibAssignment)
+        return getResolver(mapper, outPath, pathResolver=pathResolver)
+    return getResolver(mapper, outPath)
+
+
+def fileDescription(fileEntry):
+    """Return the (lfn, pfns) of a Pegasus File entry; it can be pickled"""
+    return fileEntry.name, tuple((pfn.url, pfn.site) for pfn in fileEntry.pfns)
+
+
+def describeProcessCcdJobs(mapper, registryIndex, visit, visitDataIds, shardDict):
+    """Describe the processCcd jobs of one visit
+
+    Only the dataset paths are looked up here, so that visits can be
+    described in parallel and the jobs added to the DAX afterwards.
+
+    Returns
+    -------
+    jobDescriptions: `list` of `tuple`
+        (dataId, raw, calibs, refCats, outputs) for each CCD, where raw
+        and the elements of calibs and refCats are (lfn, pfns) from
+        `fileDescription` and outputs are LFNs
+    """
+    resolver = getResolver(mapper, outPath)
+    filterName = registryIndex.getFilter(visit)
+    for datasetType in ["raw", "bias", "dark", "flat", "calexp", "src", "srcMatch"]:
+        resolver.prefetch(datasetType, visitDataIds)
+    calibTypes = ["bias", "dark", "flat", "bfKernel"]
+    if filterName in fringeFilters:
+        calibTypes.append("fringe")
+
+    jobDescriptions = []
+    for dataId in visitDataIds:
+        raw = fileDescription(getDataFile(mapper, "raw", dataId, create=True, repoRoot=inputRepo))
+        calibs = [fileDescription(getDataFile(mapper, inputType, dataId, create=True, repoRoot=calibRepo))
+                  for inputType in calibTypes]
+        refCats = [fileDescription(getDataFile(mapper, "ref_cat", {"name": refcatName, "pixel_id": shard},
+                                               create=True, repoRoot=inputRepo))
+                   for shard in shardDict[(dataId['visit'], dataId['ccd'])]]
+        outputs = [getDataFile(mapper, outputType, dataId, create=False)
+                   for outputType in ["calexp", "src", "srcMatch"]]
+        jobDescriptions.append((dataId, raw, calibs, refCats, outputs))
+    return jobDescriptions
+
+
+def _makeFile(lfn, pfns=()):
+    fileEntry = peg.File(lfn)
+    for url, site in pfns:
+        fileEntry.addPFN(peg.PFN(url, site=site))
+    return fileEntry
+
+
+def addProcessCcdJob(dax, descriptions, commonInputs, cores=1):
+    """Add the processCcd job of CCDs of one visit from describeProcessCcdJobs
+
+    Calib and ref_cat files shared by several jobs are declared once.
+
+    Parameters
+    ----------
+    dax: peg.ADAG
+        The workflow
+    descriptions: `list` of `tuple`
+        Elements of the describeProcessCcdJobs list of one visit; a job
+        of several CCDs processes them with -j cores and declares the
+        union of their inputs and outputs
+    commonInputs: `list`
+        Files or LFNs every processCcd job reads
+    cores: `int`, optional
+        Number of processes of a job of several CCDs, and the cores and
+        memory it requests
+    """
+    dataIds = [description[0] for description in descriptions]
+    logger.debug("processCcd dataIds: %s", dataIds)
+
+    processCcd = peg.Job(name="processCcd")
+    visit = dataIds[0]['visit']
+    ccds = "^".join(str(dataId['ccd']) for dataId in dataIds)
+    if len(dataIds) > 1:
+        processCcd.addArguments(outPath, "--calib", outPath, "--output", outPath,
+                                " --doraise --id visit=%s ccd=%s -j %d" % (visit, ccds, cores))
+        processCcd.addProfile(peg.Profile("condor", "request_cpus", str(cores)))
+        processCcd.addProfile(peg.Profile("condor", "request_memory", str(cores*processCcdMemory)))
+    else:
+        processCcd.addArguments(outPath, "--calib", outPath, "--output", outPath,
+                                " --doraise --id visit=%s ccd=%s" % (visit, ccds))
+    for inFile in commonInputs:
+        processCcd.uses(inFile, link=peg.Link.INPUT)
+
+    # ref_cat shards are often shared by CCDs of a job
+    usedRefCats = set()
+    for dataId, raw, calibs, refCats, outputs in descriptions:
+        inFile = _makeFile(*raw)
+        dax.addFile(inFile)
+        processCcd.uses(inFile, link=peg.Link.INPUT)
+        for lfn, pfns in calibs:
+            inFile = _makeFile(lfn, pfns)
+            if not dax.hasFile(inFile):
+                dax.addFile(inFile)
+            processCcd.uses(inFile, link=peg.Link.INPUT)
+
+        for lfn in outputs:
+            outFile = _makeFile(lfn)
+            dax.addFile(outFile)
+            processCcd.uses(outFile, link=peg.Link.OUTPUT)
+
+        for lfn, pfns in refCats:
+            if lfn in usedRefCats:
+                continue
+            usedRefCats.add(lfn)
+            refCatFile = _makeFile(lfn, pfns)
+            if not dax.hasFile(refCatFile):
+                dax.addFile(refCatFile)
+                logger.info("Add ref_cat file %s" % refCatFile)
+            processCcd.uses(refCatFile, link=peg.Link.INPUT)
+
+    if len(dataIds) > 1:
+        logProcessCcd = peg.File("logProcessCcd.v%s.c%d-%d" % (visit, dataIds[0]['ccd'], dataIds[-1]['ccd']))
     else:
-        dax = AutoADAG(name)
+        logProcessCcd = peg.File("logProcessCcd.v%s.c%d" % (visit, dataIds[0]['ccd']))
+    dax.addFile(logProcessCcd)
+    processCcd.setStdout(logProcessCcd)
+    processCcd.uses(logProcessCcd, link=peg.Link.OUTPUT)
+
+    dax.addJob(processCcd)
+
+
+# Per-process state of the describeProcessCcdJobs workers
+_sfmWorker = {}
+
+
+def _initSfmWorker(useTemplates, verifyTemplates, registryIndex, calibAssignment):
+    _sfmWorker["mapper"] = HscMapper(root=inputRepo, calibRoot=calibRepo)
+    _sfmWorker["registryIndex"] = registryIndex
+    makeResolver(_sfmWorker["mapper"], useTemplates, verifyTemplates, registryIndex, calibAssignment)
+
+
+def _describeVisitWorker(task):
+    return describeProcessCcdJobs(_sfmWorker["mapper"], _sfmWorker["registryIndex"], *task)
+
+
+def groupCcds(descriptions, ccdsPerJob=1):
+    """Split the job descriptions of a visit into groups of ccdsPerJob CCDs"""
+    return [descriptions[i:i + ccdsPerJob] for i in range(0, len(descriptions), ccdsPerJob)]
+
+
+def generateSfmDax(name="dax", visits=None, ccdList=None, useTemplates=True, verifyTemplates=3,
+                   calibTable=None, shardCachePath="shardCache.sqlite3", processes=1,
+                   shardSelection="circle", outputFile=None, compact=False, ccdsPerJob=1,
+                   coresPerJob=None, resumeFrom=None, graphCache=None):
+    """Generate a Pegasus DAX abstract workflow
+
+    With useTemplates, dataset paths are filled from the mapper policy
+    templates instead of CameraMapper.map_*; the first verifyTemplates
+    paths of each dataset type are checked against map_*.  Calibs are
+    assigned to all visits at once and the assignment is saved to and
+    reused from calibTable if given.  Ref_cat shards of each exposure
+    are kept in the persistent cache at shardCachePath; the missing ones
+    are found from the raw headers with a pool of processes, selecting
+    trixels as set by shardSelection.  The same processes look up the
+    dataset paths of the processCcd jobs, one visit at a time.  With outputFile, the DAX is
+    streamed there one visit at a time instead of kept in memory; with
+    compact, it is held as a jobGraph.JobGraph.  Each processCcd job
+    processes up to ccdsPerJob CCDs of a visit with coresPerJob
+    processes, by default one per CCD.  The jobs whose outputs are
+    found in the output repos or Pegasus submit directories resumeFrom
+    are left out, see resume.CompletedOutputs.  With graphCache, a
+    directory, the job descriptions of each visit are kept in a
+    graphCache.GraphCache and only the new or changed visits are
+    described again.
+    """
+    if coresPerJob is None:
+        coresPerJob = ccdsPerJob
+    completed = CompletedOutputs(resumeFrom, outPath) if resumeFrom else None
+    dax = makeADAG(name, outputFile=outputFile, compact=compact, completed=completed)
 
     # Construct these mappers only for creating dax, not for actual runs.
     mapper = HscMapper(root=inputRepo, calibRoot=calibRepo)
+    # Read the raw registry once instead of querying it per CCD
+    registryIndex = RawRegistryIndex(os.path.join(inputRepo, "registry.sqlite3"))
+    calibAssignment = None
+    if useTemplates:
+        calibAssignment = loadCalibAssignment(os.path.join(calibRepo, "calibRegistry.sqlite3"),
+                                              registryIndex, os.path.join(inputRepo, "registry.sqlite3"),
+                                              cachePath=calibTable, visits=visits, mapper=mapper)
+    resolver = makeResolver(mapper, useTemplates, verifyTemplates, registryIndex, calibAssignment)
 
     # Get the following butler or config files directly from ci_hsc package
     filePathMapper = os.path.join(inputRepo, "_mapper")
@@ -62,6 +258,10 @@ def generateSfmDax(name="dax", visits=None, ccdList=None):
     # Add necessities for ref_cats
     refCatConfigFile = getDataFile(mapper, "ref_cat_config", {"name": refcatName}, create=True, repoRoot=inputRepo)
     dax.addFile(refCatConfigFile)
+    refCatConfigPath = os.path.join(inputRepo, resolver.getButlerPath("ref_cat_config", {"name": refcatName}))
+    shardCache = openShardCache(shardCachePath, refCatConfigPath, extra=[shardSelection])
+    # Construct a butler only for finding ref cat shards
+    butler = Butler(root=inputRepo, calibRoot=calibRepo)
 
     refCatSchema = "ref_cats/ps1_pv3_3pi_20170110/master_schema.fits"
     filePath = os.path.join(inputRepo, refCatSchema)
@@ -70,11 +270,6 @@ def generateSfmDax(name="dax", visits=None, ccdList=None):
     refCatSchemaFile.addPFN(peg.PFN(filePath, site="lsstvc"))
     dax.addFile(refCatSchemaFile)
 
-    # Hack to set fringe filters
-    # Cannot directly read from obs_subaru/config/hsc/isr.py because
-    # config uses abbrev names config.fringe.filters = ['y', 'N921']
-    fringeFilters = ["HSC-Y", "NB0921"]
-
     # Add prerun
     preProcessCcd = peg.Job(name="processCcd")
     preProcessCcd.uses(mapperFile, link=peg.Link.INPUT)
@@ -87,62 +282,66 @@ def generateSfmDax(name="dax", visits=None, ccdList=None):
     dax.addJob(preProcessCcd)
 
     # Pipeline: processCcd
+    allDataIds = OrderedDict()
     for visit in visits:
-        for ccd in ccdList:
-            dataId = {'visit': int(visit), 'ccd': ccd}
-            logger.debug("processCcd dataId: %s", dataId)
-
-            processCcd = peg.Job(name="processCcd")
-            processCcd.addArguments(outPath, "--calib", outPath, "--output", outPath,
-                                    " --doraise --id visit={visit} ccd={ccd}".format(**dataId))
-            processCcd.uses(registry, link=peg.Link.INPUT)
-            processCcd.uses(calibRegistry, link=peg.Link.INPUT)
-            processCcd.uses(mapperFile, link=peg.Link.INPUT)
-            for inputType in ["icSrc_schema", "src_schema"]:
-                inFile = getDataFile(mapper, inputType, {}, create=False)
-                processCcd.uses(inFile, link=peg.Link.INPUT)
-
-            processCcd.uses(refCatConfigFile, link=peg.Link.INPUT)
-            processCcd.uses(refCatSchemaFile, link=peg.Link.INPUT)
-
-            inFile = getDataFile(mapper, "raw", dataId, create=True, repoRoot=inputRepo)
-            dax.addFile(inFile)
-            processCcd.uses(inFile, link=peg.Link.INPUT)
-            for inputType in ["bias", "dark", "flat", "bfKernel"]:
-                inFile = getDataFile(mapper, inputType, dataId,
-                                     create=True, repoRoot=calibRepo)
-                if not dax.hasFile(inFile):
-                    dax.addFile(inFile)
-                processCcd.uses(inFile, link=peg.Link.INPUT)
-
-            filterName = mapper.queryMetadata(datasetType="raw", format=("filter",), dataId={'visit':visit})[0][0]
-            if filterName in fringeFilters:
-                inFile = getDataFile(mapper, "fringe", dataId,
-                                     create=True, repoRoot=calibRepo)
-                if not dax.hasFile(inFile):
-                    dax.addFile(inFile)
-                processCcd.uses(inFile, link=peg.Link.INPUT)
-
-            for outputType in ["calexp", "src", "srcMatch"]:
-                outFile = getDataFile(mapper, outputType, dataId, create=True)
-                dax.addFile(outFile)
-                processCcd.uses(outFile, link=peg.Link.OUTPUT)
-
-            butler = Butler(root=inputRepo, calibRoot=calibRepo)
-            shards = findShardIdFromExpId(butler, dataId)
-            for shard in shards:
-                refCatFile = getDataFile(mapper, "ref_cat", {"name": refcatName, "pixel_id": shard}, create=True, repoRoot=inputRepo)
-                if not dax.hasFile(refCatFile):
-                    dax.addFile(refCatFile)
-                    logger.info("Add ref_cat file %s" % refCatFile)
-                processCcd.uses(refCatFile, link=peg.Link.INPUT)
-
-            logProcessCcd = peg.File("logProcessCcd.v{visit}.c{ccd}".format(**dataId))
-            dax.addFile(logProcessCcd)
-            processCcd.setStdout(logProcessCcd)
-            processCcd.uses(logProcessCcd, link=peg.Link.OUTPUT)
-
-            dax.addJob(processCcd)
+        visitCcds = set(registryIndex.getCcds(visit))
+        if not visitCcds:
+            logger.warn("Visit %s is not in the registry; skipping it", visit)
+            continue
+        missingCcds = [ccd for ccd in ccdList if ccd not in visitCcds]
+        if missingCcds:
+            logger.info("Visit %s has no raw data for ccds %s", visit, missingCcds)
+        allDataIds[visit] = [{'visit': int(visit), 'ccd': ccd} for ccd in ccdList if ccd in visitCcds]
+
+    # Only the raw headers are read, spread over the worker processes
+    expIds = list(itertools.chain.from_iterable(allDataIds.values()))
+    shardDict = findShardIdsFromExpIds(inputRepo, expIds, calibRoot=calibRepo,
+                                       ref_dataset_name=refcatName, cache=shardCache,
+                                       processes=processes, butler=butler, selection=shardSelection)
+
+    # Describe the processCcd jobs visit by visit, in worker processes if
+    # asked, and add them in visit order so the DAX is the same either way
+    commonInputs = [registry, calibRegistry, mapperFile, refCatConfigFile, refCatSchemaFile]
+    commonInputs += [getDataFile(mapper, inputType, {}, create=False)
+                     for inputType in ["icSrc_schema", "src_schema"]]
+    tasks = [(visit, visitDataIds, {(dataId['visit'], dataId['ccd']): shardDict[(dataId['visit'], dataId['ccd'])]
+                                    for dataId in visitDataIds})
+             for visit, visitDataIds in allDataIds.items()]
+    # With graphCache, the descriptions of a visit are reused as long as
+    # its CCDs, shards, registries and the generator are unchanged
+    cache = None
+    keys = [None]*len(tasks)
+    cached = [None]*len(tasks)
+    if graphCache is not None:
+        salt = sourceHash("generateDaxSfm")
+        salt += configHash(extra=fileStamps([filePathRegistry, filePathCalibRegistry]))
+        cache = GraphCache(os.path.join(graphCache, "sfm"), salt=salt)
+        keys = [cache.key(task, useTemplates, verifyTemplates) for task in tasks]
+        cached = [cache.get(key) for key in keys]
+    missing = [task for task, jobDescriptions in zip(tasks, cached) if jobDescriptions is None]
+
+    pool = None
+    if processes > 1 and len(missing) > 1:
+        pool = multiprocessing.Pool(processes, initializer=_initSfmWorker,
+                                    initargs=(useTemplates, verifyTemplates, registryIndex, calibAssignment))
+        described = pool.imap(_describeVisitWorker, missing)
+    else:
+        described = (describeProcessCcdJobs(mapper, registryIndex, *task) for task in missing)
+    try:
+        for key, jobDescriptions in zip(keys, cached):
+            if jobDescriptions is None:
+                jobDescriptions = next(described)
+                if cache is not None:
+                    cache.put(key, jobDescriptions)
+            for group in groupCcds(jobDescriptions, ccdsPerJob):
+                addProcessCcdJob(dax, group, commonInputs, cores=min(coresPerJob, len(group)))
+            flushStage(dax)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if cache is not None:
+        cache.logStats(logger)
 
     # Pipeline: makeSkyMap
     makeSkyMap = peg.Job(name="makeSkyMap")
@@ -159,6 +358,10 @@ def generateSfmDax(name="dax", visits=None, ccdList=None):
 
     dax.addJob(makeSkyMap)
 
+    if completed is not None:
+        logger.info("Reused the outputs of %d jobs", completed.reusedJobs)
+    shardCache.close()
+    resolver.logStats(logger)
     return dax
 
 
@@ -168,11 +371,43 @@ if __name__ == "__main__":
                         help="a file including input data information")
     parser.add_argument("-o", "--outputFile", type=str, default="HscRcTest.dax",
                         help="file name for the output dax xml")
+    parser.add_argument("--noTemplates", action="store_true", default=False,
+                        help="resolve every path through CameraMapper.map_*")
+    parser.add_argument("--verifyTemplates", type=int, default=3,
+                        help="number of template paths per dataset type to check against map_*")
+    parser.add_argument("--calibTable", default=None,
+                        help="file to save and reuse the visit/ccd to calib assignment (.npz)")
+    parser.add_argument("--shardCache", default="shardCache.sqlite3",
+                        help="SQLite file caching ref_cat shards; shared with generateDaxCoadd.py")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of processes reading raw headers and describing processCcd jobs")
+    parser.add_argument("--shardSelection", choices=SHARD_SELECTIONS, default="circle",
+                        help="select ref_cat shards by a bounding circle or the exposure outline")
+    parser.add_argument("--ccdsPerJob", type=int, default=1,
+                        help="number of CCDs of a visit each processCcd job processes")
+    parser.add_argument("--coresPerJob", type=int, default=None,
+                        help="processCcd -j and cores requested by a job of several CCDs; "
+                        "default one per CCD")
+    parser.add_argument("--resumeFrom", action="append", default=None, metavar="PATH",
+                        help="output repo or Pegasus submit directory of an earlier run; jobs whose "
+                        "outputs are there are left out and the outputs used as inputs; repeatable")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="write the DAX stage by stage instead of building it in memory; "
+                        "gzip-compressed if the output file ends with .gz")
+    parser.add_argument("--compact", action="store_true", default=False,
+                        help="hold the workflow as a compact job graph until it is written")
+    parser.add_argument("--graphCache", default=None, metavar="DIR",
+                        help="reuse the processCcd job descriptions of the visits cached in DIR by earlier runs")
     args = parser.parse_args()
     with open(args.inputData) as f:
         visits = [line.rstrip() for line in f]
 
     ccdList = range(9) + range(10, 104)
-    dax = generateSfmDax("HscSfmDax", visits, ccdList)
-    with open(args.outputFile, "w") as f:
-        dax.writeXML(f)
+    dax = generateSfmDax("HscSfmDax", visits, ccdList,
+                         useTemplates=not args.noTemplates, verifyTemplates=args.verifyTemplates,
+                         calibTable=args.calibTable, shardCachePath=args.shardCache,
+                         processes=args.processes, shardSelection=args.shardSelection,
+                         outputFile=args.outputFile if args.stream else None, compact=args.compact,
+                         ccdsPerJob=args.ccdsPerJob, coresPerJob=args.coresPerJob,
+                         resumeFrom=args.resumeFrom, graphCache=args.graphCache)
+    writeDax(dax, args.outputFile)
@@ -1,17 +1,156 @@
 #!/usr/bin/env python
 
 import os
+from collections import OrderedDict
 import Pegasus.DAX3 as peg
 import lsst.log
 
 logger = lsst.log.Log.getLogger("getDataFile")
 logger.setLevel(lsst.log.WARN)
 
+
+def freezeDataId(dataId):
+    """Return a hashable, order-independent key for a Butler data ID"""
+    return tuple(sorted(dataId.items()))
+
+
+class DataFileResolver(object):
+    """Resolve Butler datasets to Pegasus File entries with memoization
+
+    The same calexp/src/... path is looked up again and again by the
+    generators, e.g. once per patch a CCD overlaps and once per task
+    reading it.  Each lookup through CameraMapper.map_* is expensive,
+    so the Butler paths are kept in a bounded LRU cache keyed by
+    datasetType and the frozen dataId, and the Pegasus File entries
+    are interned so that every job refers to the same object.
+
+    Parameters
+    ----------
+    mapper: lsst.obs.base.CameraMapper
+        A specific CameraMapper instance for getting the name and locating
+        the file in a Butler repo.
+    outPath: `str`
+        A folder name used as a hack to use the CmdLineTask framework
+    sites: `list` of `str`
+        Pegasus sites to add a PFN for when repoRoot is given
+    maxSize: `int`
+        Maximum number of Butler paths kept in the cache
+    pathResolver: `pathTemplates.PathTemplateResolver`, optional
+        Resolve the dataset types it knows from the policy templates
+        instead of calling map_*
+    """
+
+    def __init__(self, mapper, outPath="repo", sites=("lsstvc",), maxSize=200000, pathResolver=None):
+        self.mapper = mapper
+        self.pathResolver = pathResolver
+        self.outPath = outPath
+        self.sites = tuple(sites)
+        self.maxSize = maxSize
+        self._paths = OrderedDict()
+        self._files = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, datasetType, dataId):
+        """Map a dataset through the mapper; this is the uncached path"""
+        if self.pathResolver is not None and self.pathResolver.canResolve(datasetType):
+            return self.pathResolver.getButlerPath(datasetType, dataId)
+        mapFunc = getattr(self.mapper, "map_" + datasetType)
+        return mapFunc(dataId).getLocations()[0]
+
+    def prefetch(self, datasetType, dataIds):
+        """Resolve many dataIds of one dataset type in bulk into the cache"""
+        keys = [(datasetType, freezeDataId(dataId)) for dataId in dataIds]
+        todo = [(key, dataId) for key, dataId in zip(keys, dataIds) if key not in self._paths]
+        if not todo:
+            return
+        if self.pathResolver is not None and self.pathResolver.canResolve(datasetType):
+            paths = self.pathResolver.getButlerPaths(datasetType, [dataId for key, dataId in todo])
+        else:
+            paths = [self._lookup(datasetType, dataId) for key, dataId in todo]
+        self.misses += len(todo)
+        for (key, dataId), butlerPath in zip(todo, paths):
+            if len(self._paths) >= self.maxSize:
+                self._paths.popitem(last=False)
+            self._paths[key] = butlerPath
+
+    def getButlerPath(self, datasetType, dataId):
+        """Return the repo-relative path of a dataset, using the cache"""
+        key = (datasetType, freezeDataId(dataId))
+        try:
+            butlerPath = self._paths.pop(key)
+        except KeyError:
+            self.misses += 1
+            butlerPath = self._lookup(datasetType, dataId)
+            if len(self._paths) >= self.maxSize:
+                self._paths.popitem(last=False)
+        else:
+            self.hits += 1
+        self._paths[key] = butlerPath
+        return butlerPath
+
+    def getDataFile(self, datasetType, dataId, create=False, repoRoot=None):
+        """Get the Pegasus File entry given Butler datasetType and dataId.
+
+        See `getDataFile` for the parameters.
+        """
+        butlerPath = self.getButlerPath(datasetType, dataId)
+        lfn = os.path.join(self.outPath, butlerPath)
+        if not create:
+            return lfn
+
+        key = (lfn, repoRoot)
+        fileEntry = self._files.pop(key, None)
+        if fileEntry is None:
+            fileEntry = peg.File(lfn)
+            if repoRoot is not None:
+                filePath = os.path.join(repoRoot, butlerPath)
+                for site in self.sites:
+                    fileEntry.addPFN(peg.PFN(filePath, site=site))
+                logger.info("%s %s: %s -> %s", datasetType, dataId, filePath, lfn)
+            if len(self._files) >= self.maxSize:
+                self._files.popitem(last=False)
+        self._files[key] = fileEntry
+        return fileEntry
+
+    def stats(self):
+        """Return a dict of the cache counters"""
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, size=len(self._paths),
+                    hitRate=float(self.hits) / total if total else 0.0)
+
+    def logStats(self, log=logger):
+        """Report the cache counters, e.g. at the end of DAX generation"""
+        stats = self.stats()
+        log.info("getDataFile cache: %d hits, %d misses (%.1f%% hit rate), %d paths cached",
+                 stats["hits"], stats["misses"], 100*stats["hitRate"], stats["size"])
+
+
+# One resolver per (mapper, outPath, sites); the resolver holds a reference to
+# its mapper so the id() key cannot be reused while the entry is alive.
+_resolvers = {}
+
+
+def getResolver(mapper, outPath="repo", sites=("lsstvc",), pathResolver=None):
+    """Return the shared DataFileResolver for a mapper
+
+    If pathResolver is given it is installed on the shared resolver.
+    """
+    key = (id(mapper), outPath, tuple(sites))
+    resolver = _resolvers.get(key)
+    if resolver is None:
+        resolver = _resolvers[key] = DataFileResolver(mapper, outPath=outPath, sites=sites)
+    if pathResolver is not None:
+        resolver.pathResolver = pathResolver
+    return resolver
+
+
 def getDataFile(mapper, datasetType, dataId, outPath="repo", create=False, repoRoot=None):
     """Get the Pegasus File entry given Butler datasetType and dataId.
     Retrieve the file name/path through a CameraMapper instance
         and prepend outPath to it
     Optionally create new Pegasus File entries
+    Lookups are memoized by the shared DataFileResolver of the mapper.
     Parameters
     ----------
     mapper: lsst.obs.base.CameraMapper
@@ -32,16 +171,5 @@ def getDataFile(mapper, datasetType, dataId, outPath="repo", create=False, repoR
     fileEntry:
         A Pegasus File entry or a LFN corresponding to an entry
     """
-    mapFunc = getattr(mapper, "map_" + datasetType)
-    butlerPath = mapFunc(dataId).getLocations()[0]
-    fileEntry = lfn = os.path.join(outPath, butlerPath)
-
-    if create:
-        fileEntry = peg.File(lfn)
-        if repoRoot is not None:
-            filePath = os.path.join(repoRoot, butlerPath)
-            #fileEntry.addPFN(peg.PFN(filePath, site="local"))
-            fileEntry.addPFN(peg.PFN(filePath, site="lsstvc"))
-            logger.info("%s %s: %s -> %s", datasetType, dataId, filePath, lfn)
-
-    return fileEntry
+    resolver = getResolver(mapper, outPath)
+    return resolver.getDataFile(datasetType, dataId, create=create, repoRoot=repoRoot)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import ast
+import hashlib
+import os
+import pickle
+import tempfile
+
+import lsst.log
+from shardCache import configHash
+
+logger = lsst.log.Log.getLogger("graphCache")
+logger.setLevel(lsst.log.INFO)
+
+
+def _canonical(value):
+    """Return a repr of value independent of dict and set ordering"""
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join("%s: %s" % (_canonical(k), _canonical(v))
+                                  for k, v in sorted(value.items()))
+    if isinstance(value, (set, frozenset)):
+        return "set(%s)" % ", ".join(sorted(_canonical(v) for v in value))
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join(_canonical(v) for v in value)
+    if hasattr(value, "__dict__"):
+        return "%s(%s)" % (type(value).__name__, _canonical(vars(value)))
+    return repr(value)
+
+
+def localImports(*moduleNames):
+    """Return the modules of this directory that moduleNames import
+
+    The imports are followed recursively and include moduleNames, so
+    that a generator does not keep a list of the modules it relies on.
+    """
+    moduleDir = os.path.dirname(os.path.realpath(__file__))
+    found = set()
+    pending = list(moduleNames)
+    while pending:
+        moduleName = pending.pop()
+        path = os.path.join(moduleDir, moduleName + ".py")
+        if moduleName in found or not os.path.exists(path):
+            continue
+        found.add(moduleName)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending.extend(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module.split(".")[0])
+    return sorted(found)
+
+
+def sourceHash(*moduleNames):
+    """Return a hash of the source of modules of this directory
+
+    The modules they import from this directory are included, see
+    `localImports`.  A change to the code generating the fragments
+    invalidates them.
+    """
+    moduleDir = os.path.dirname(os.path.realpath(__file__))
+    return configHash([os.path.join(moduleDir, moduleName + ".py")
+                       for moduleName in localImports(*moduleNames)])
+
+
+def fileStamps(paths):
+    """Return (path, mtime, size) of the existing files of paths
+
+    A cheap stand-in for hashing large inputs, e.g. registries, that a
+    generator reads rather than copies.
+    """
+    return [(path, os.path.getmtime(path), os.path.getsize(path)) for path in paths if os.path.exists(path)]
+
+
+class GraphCache(object):
+    """Directory of workflow fragments keyed by a hash of their inputs
+
+    A generator splits its workflow into partitions, e.g. the jobs of a
+    patch or the job descriptions of a visit, and keys each one by the
+    hash of everything it is made from.  A partition whose key is found
+    is loaded instead of built again, so a changed input list or
+    blacklist only rebuilds the partitions it touches.
+
+    Parameters
+    ----------
+    directory: `str`
+        Where the fragments are pickled; created if needed
+    salt: `str`, optional
+        Mixed into every key, e.g. a sourceHash of the generator and a
+        configHash of the repo configuration
+    """
+
+    def __init__(self, directory, salt=""):
+        self.directory = directory
+        self.salt = salt
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        """Return the key of a partition made from parts"""
+        md5 = hashlib.md5(self.salt.encode("utf-8"))
+        md5.update(_canonical(parts).encode("utf-8"))
+        return md5.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        """Return the fragment of key, or None if it is not cached"""
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        with open(path, "rb") as f:
+            value = pickle.load(f)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Save the fragment of key"""
+        # Write to a temporary file first, so an interrupted run never
+        # leaves a truncated fragment
+        fd, tmpPath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpPath, self._path(key))
+
+    def prune(self, keys):
+        """Remove the fragments not in keys, e.g. those of removed patches"""
+        keys = set(keys)
+        removed = 0
+        for fileName in os.listdir(self.directory):
+            if fileName.endswith(".pickle") and fileName[:-len(".pickle")] not in keys:
+                os.remove(os.path.join(self.directory, fileName))
+                removed += 1
+        return removed
+
+    def logStats(self, log=logger):
+        log.info("Graph cache %s: %d partitions reused, %d built", self.directory, self.hits, self.misses)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# Vertices and root triangles of the HTM, numbered as in esutil.htm:
+# S0..S3 have IDs 8..11 and N0..N3 have IDs 12..15
+_ROOT_VERTICES = np.array([
+    [0.0, 0.0, 1.0],
+    [1.0, 0.0, 0.0],
+    [0.0, 1.0, 0.0],
+    [-1.0, 0.0, 0.0],
+    [0.0, -1.0, 0.0],
+    [0.0, 0.0, -1.0],
+])
+_ROOT_TRIANGLES = np.array([
+    [1, 5, 2], [2, 5, 3], [3, 5, 4], [4, 5, 1],
+    [1, 0, 4], [4, 0, 3], [3, 0, 2], [2, 0, 1],
+])
+
+
+def _normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1)[..., np.newaxis]
+
+
+def htmDepth(pixelId):
+    """Return the depth of an HTM ID"""
+    return (int(pixelId).bit_length() - 4) // 2
+
+
+def trixelVertices(pixelIds):
+    """Return the corner unit vectors of HTM trixels
+
+    Parameters
+    ----------
+    pixelIds: `list` of `int`
+        HTM IDs, all of the same depth
+
+    Returns
+    -------
+    vertices: `numpy.ndarray`
+        Shape (nTrixel, 3, 3), the three corners of each trixel
+    """
+    pixelIds = np.asarray(pixelIds, dtype=np.int64)
+    if len(pixelIds) == 0:
+        return np.empty((0, 3, 3))
+    depth = htmDepth(pixelIds[0])
+    vertices = _ROOT_VERTICES[_ROOT_TRIANGLES[(pixelIds >> (2*depth)) - 8]]
+    for level in range(depth - 1, -1, -1):
+        child = (pixelIds >> (2*level)) & 3
+        v0, v1, v2 = vertices[:, 0], vertices[:, 1], vertices[:, 2]
+        w0 = _normalize(v1 + v2)
+        w1 = _normalize(v0 + v2)
+        w2 = _normalize(v0 + v1)
+        choices = np.stack([
+            np.stack([v0, w2, w1], axis=1),
+            np.stack([v1, w0, w2], axis=1),
+            np.stack([v2, w1, w0], axis=1),
+            np.stack([w0, w1, w2], axis=1),
+        ])
+        vertices = choices[child, np.arange(len(pixelIds))]
+    return vertices
+
+
+def _gnomonic(vectors, center):
+    """Project unit vectors on the plane tangent at center
+
+    Great circles become straight lines, so spherical polygons with
+    great-circle edges become planar polygons.
+    """
+    pole = np.array([0.0, 0.0, 1.0]) if abs(center[2]) < 0.9 else np.array([1.0, 0.0, 0.0])
+    east = _normalize(np.cross(pole, center))
+    north = np.cross(center, east)
+    depth = np.dot(vectors, center)
+    return np.stack([np.dot(vectors, east) / depth, np.dot(vectors, north) / depth], axis=-1), depth
+
+
+def _convexHull(points):
+    """Return the convex hull of planar points, counter-clockwise"""
+    points = sorted(set(map(tuple, points)))
+    if len(points) < 3:
+        return np.array(points)
+
+    def cross(o, a, b):
+        return (a[0] - o[0])*(b[1] - o[1]) - (a[1] - o[1])*(b[0] - o[0])
+
+    lower = []
+    for p in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    upper = []
+    for p in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+    return np.array(lower[:-1] + upper[:-1])
+
+
+def _edgeNormals(polygon):
+    edges = np.roll(polygon, -1, axis=-2) - polygon
+    return np.stack([edges[..., 1], -edges[..., 0]], axis=-1)
+
+
+def polygonTrixels(polygon, pixelIds, margin=0.0):
+    """Select the HTM trixels that come within margin of a sky polygon
+
+    The polygon and the trixels are projected gnomonically around the
+    polygon center, where the edges of both are straight, and tested
+    with separating axes.  The margin is scaled by the largest stretch
+    of the projection over the region and applied along the edge
+    normals, so a trixel is never dropped wrongly; at worst a trixel
+    near a polygon corner is kept.
+
+    Parameters
+    ----------
+    polygon: `numpy.ndarray`
+        Unit vectors of points on the polygon boundary, shape (n, 3);
+        the polygon is their convex hull
+    pixelIds: `list` of `int`
+        Candidate HTM IDs, e.g. from a circle covering the polygon
+    margin: `float`, optional
+        Margin around the polygon in radians
+
+    Returns
+    -------
+    selected: `list` of `int`
+        The pixelIds that intersect the polygon grown by margin
+    """
+    pixelIds = list(pixelIds)
+    if not pixelIds:
+        return []
+    center = _normalize(np.asarray(polygon).sum(axis=0))
+    vertices = trixelVertices(pixelIds)
+    polyXY, polyDepth = _gnomonic(np.asarray(polygon), center)
+    trixelXY, trixelDepth = _gnomonic(vertices.reshape(-1, 3), center)
+    trixelXY = trixelXY.reshape(-1, 3, 2)
+    trixelDepth = trixelDepth.reshape(-1, 3)
+    # A trixel reaching the far hemisphere cannot be projected; keep it
+    projectable = (trixelDepth > 1e-3).all(axis=1)
+
+    hull = _convexHull(polyXY)
+    minDepth = min(polyDepth.min(), trixelDepth[projectable].min() if projectable.any() else 1.0)
+    # Angular distances are stretched by at most sec^2 of the angle from center
+    planarMargin = margin / minDepth**2
+
+    keep = ~projectable
+    tri = trixelXY[projectable]
+    # Orient the trixels counter-clockwise so the normals point outward
+    area = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    tri[area < 0] = tri[area < 0][:, ::-1]
+    separated = np.zeros(len(tri), dtype=bool)
+
+    # Axes of the polygon edges
+    for normal, point in zip(_edgeNormals(hull), hull):
+        length = np.hypot(*normal)
+        offset = np.dot(tri - point, normal) / length
+        separated |= offset.min(axis=1) > planarMargin
+    # Axes of the trixel edges
+    normals = _edgeNormals(tri)
+    lengths = np.linalg.norm(normals, axis=-1)
+    for k in range(3):
+        offset = np.einsum("pj,nj->pn", hull, normals[:, k]) - (tri[:, k]*normals[:, k]).sum(axis=1)
+        separated |= offset.min(axis=0) / lengths[:, k] > planarMargin
+
+    keep[projectable] = ~separated
+    return [pixelId for pixelId, k in zip(pixelIds, keep) if k]
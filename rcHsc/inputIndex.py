@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+from collections import namedtuple
+import numpy as np
+import lsst.log
+from calibIndex import registryFingerprint
+
+logger = lsst.log.Log.getLogger("inputIndex")
+logger.setLevel(lsst.log.INFO)
+
+# An exposure is keyed by visit*CCD_STRIDE + ccd; HSC ccds are below 112
+CCD_STRIDE = 1 << 8
+
+
+def exposureKey(visit, ccd):
+    """Return the integer key of a visit and ccd"""
+    return int(visit)*CCD_STRIDE + int(ccd)
+
+
+def parseVisitCcd(visitCcd):
+    """Return (visit, ccd) of a 'visit-ccd' string, or of an object with visit and ccd"""
+    if hasattr(visitCcd, "visit"):
+        return int(visitCcd.visit), int(visitCcd.ccd)
+    visit, ccd = visitCcd.split('-')
+    return int(visit), int(ccd)
+
+
+class Data(namedtuple("Data", ["visit", "ccd"])):
+    """A CCD to process, as the Data of ci_hsc/SConstruct"""
+
+    @property
+    def name(self):
+        """Returns a suitable name for this data"""
+        return "%d-%d" % (self.visit, self.ccd)
+
+    @property
+    def dataId(self):
+        """Returns the dataId for this data"""
+        return dict(visit=self.visit, ccd=self.ccd)
+
+    def id(self, prefix="--id", tract=None):
+        """Returns a suitable --id command-line string"""
+        r = "%s visit=%d ccd=%d" % (prefix, self.visit, self.ccd)
+        if tract is not None:
+            r += " tract=%d" % tract
+        return r
+
+
+def readBlacklist(path):
+    """Return the Blacklist of the 'visit-ccd' lines of a file"""
+    with open(path, "r") as f:
+        return Blacklist(line.strip() for line in f if line.strip())
+
+
+class Blacklist(frozenset):
+    """Hashed set of the exposures to ignore
+
+    Holds the exposure keys of the 'visit-ccd' it is made from; a
+    'visit-ccd' string, a (visit, ccd) tuple or an object with visit
+    and ccd is tested in constant time.  Iterating gives the keys.
+    """
+
+    def __new__(cls, entries=()):
+        return frozenset.__new__(cls, (entry if isinstance(entry, (int, np.integer))
+                                       else exposureKey(*_asVisitCcd(entry)) for entry in entries))
+
+    def __contains__(self, entry):
+        if not isinstance(entry, (int, np.integer)):
+            entry = exposureKey(*_asVisitCcd(entry))
+        return frozenset.__contains__(self, entry)
+
+    def __reduce__(self):
+        return (Blacklist, (list(frozenset.__iter__(self)),))
+
+    def union(self, *others):
+        return Blacklist(list(frozenset.__iter__(self)) + [entry for other in others for entry in other])
+
+    def names(self):
+        """Return the sorted 'visit-ccd' of the blacklist"""
+        return ["%d-%d" % divmod(key, CCD_STRIDE) for key in sorted(self)]
+
+
+def _asVisitCcd(entry):
+    if isinstance(entry, tuple):
+        return entry
+    return parseVisitCcd(entry)
+
+
+def _invert(keys, nKeys):
+    """Return the rows of each key as (order, offsets)
+
+    The rows with key k are order[offsets[k]:offsets[k + 1]], in their
+    order in keys.
+    """
+    offsets = np.zeros(nKeys + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=nKeys), out=offsets[1:])
+    return np.argsort(keys, kind="mergesort"), offsets
+
+
+class InputIndex(object):
+    """Columnar table of the input CCDs of each patch and filter of a tract
+
+    Each row is a CCD overlapping a patch in a filter.  Filter and patch
+    names are stored once and the rows hold their integer IDs, so the
+    table is built, saved and loaded in time linear in its size.  The
+    inverted indexes give the rows of a filter and patch, the patches
+    of a CCD or a visit, and the visits of a patch without scanning.
+
+    Parameters
+    ----------
+    filters, patches: `list` of `str`
+        Filter names and patch names, e.g. '3,4'
+    filterIds, patchIds, visits, ccdIds: `numpy.ndarray`
+        The filter ID, patch ID, visit and ccd of each row
+    fingerprint: `str`, optional
+        State of the file the table was made from
+    """
+
+    def __init__(self, filters, patches, filterIds, patchIds, visits, ccdIds, fingerprint=""):
+        self.filters = [str(name) for name in filters]
+        self.patches = [str(name) for name in patches]
+        self.filterIds = np.asarray(filterIds, dtype=np.int32)
+        self.patchIds = np.asarray(patchIds, dtype=np.int32)
+        self.visits = np.asarray(visits, dtype=np.int64)
+        self.ccdIds = np.asarray(ccdIds, dtype=np.int32)
+        self.fingerprint = fingerprint
+        self._filterIndex = {name: i for i, name in enumerate(self.filters)}
+        self._patchIndex = {name: i for i, name in enumerate(self.patches)}
+
+        nPatches = len(self.patches)
+        self.exposureKeys = self.visits*CCD_STRIDE + self.ccdIds
+        self._byCoadd = _invert(self.filterIds*nPatches + self.patchIds, len(self.filters)*nPatches)
+        self._byPatch = _invert(self.patchIds, nPatches)
+        self._byFilter = _invert(self.filterIds, len(self.filters))
+        exposures, exposureRows = np.unique(self.exposureKeys, return_inverse=True)
+        self._exposureIndex = {key: i for i, key in enumerate(exposures.tolist())}
+        self._byExposure = _invert(exposureRows, len(exposures))
+        visits, visitRows = np.unique(self.visits, return_inverse=True)
+        self._visitIndex = {visit: i for i, visit in enumerate(visits.tolist())}
+        self._byVisit = _invert(visitRows, len(visits))
+
+    def __len__(self):
+        return len(self.visits)
+
+    @staticmethod
+    def _rows(inverted, key):
+        if key is None:
+            return np.zeros(0, dtype=np.int64)
+        order, offsets = inverted
+        return order[offsets[key]:offsets[key + 1]]
+
+    def _patchNames(self, rows):
+        """Return the distinct patches of rows, in row order"""
+        patchIds = self.patchIds[rows]
+        _, first = np.unique(patchIds, return_index=True)
+        return [self.patches[i] for i in patchIds[np.sort(first)].tolist()]
+
+    @property
+    def allPatches(self):
+        """The patches with any input, sorted"""
+        return sorted(self.patches[i] for i in np.unique(self.patchIds).tolist())
+
+    def ccds(self, filterName, patch):
+        """Return the (visit, ccd) of a filter and patch, in input order"""
+        filterId = self._filterIndex.get(filterName)
+        patchId = self._patchIndex.get(patch)
+        if filterId is None or patchId is None:
+            return []
+        rows = self._rows(self._byCoadd, filterId*len(self.patches) + patchId)
+        return list(zip(self.visits[rows].tolist(), self.ccdIds[rows].tolist()))
+
+    def ccdsOfFilter(self, filterName):
+        """Return the distinct (visit, ccd) of a filter, in input order"""
+        rows = self._rows(self._byFilter, self._filterIndex.get(filterName))
+        _, first = np.unique(self.exposureKeys[rows], return_index=True)
+        rows = rows[np.sort(first)]
+        return list(zip(self.visits[rows].tolist(), self.ccdIds[rows].tolist()))
+
+    def patchesOfFilter(self, filterName):
+        """Return the patches of a filter, in input order"""
+        return self._patchNames(self._rows(self._byFilter, self._filterIndex.get(filterName)))
+
+    def patchesOfCcd(self, visit, ccd):
+        """Return the patches a CCD overlaps, in input order"""
+        return self._patchNames(self._rows(self._byExposure,
+                                           self._exposureIndex.get(exposureKey(visit, ccd))))
+
+    def patchesOfVisit(self, visit):
+        """Return the patches any CCD of a visit overlaps, in input order"""
+        return self._patchNames(self._rows(self._byVisit, self._visitIndex.get(int(visit))))
+
+    def visitsOfPatch(self, patch, filterName=None):
+        """Return the sorted visits with a CCD on a patch, in one filter if given"""
+        rows = self._rows(self._byPatch, self._patchIndex.get(patch))
+        if filterName is not None:
+            rows = rows[self.filterIds[rows] == self._filterIndex.get(filterName, -1)]
+        return np.unique(self.visits[rows]).tolist()
+
+    def dataDict(self, blacklist=()):
+        """Return the inputs as dataDict[filterName][patch], a list of 'visit-ccd'
+
+        The CCDs in blacklist are left out, as are the patches left
+        without any.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if blacklist:
+            keep = ~np.in1d(self.exposureKeys, np.array(sorted(Blacklist(blacklist)), dtype=np.int64))
+        dataDict = {}
+        for filterId, filterName in enumerate(self.filters):
+            for patchId, patch in enumerate(self.patches):
+                rows = self._rows(self._byCoadd, filterId*len(self.patches) + patchId)
+                rows = rows[keep[rows]]
+                if len(rows):
+                    dataDict.setdefault(filterName, {})[patch] = [
+                        "%d-%d" % visitCcd for visitCcd in zip(self.visits[rows].tolist(),
+                                                               self.ccdIds[rows].tolist())]
+        return dataDict
+
+    @classmethod
+    def fromDataDict(cls, dataDict, fingerprint=""):
+        """Build the table of dataDict[filterName][patch]
+
+        The values are lists of 'visit-ccd' strings or of objects with
+        visit and ccd, e.g. Data.
+        """
+        filters, patches = [], {}
+        filterIds, patchIds, visits, ccdIds = [], [], [], []
+        for filterName, patchDict in dataDict.items():
+            filterId = len(filters)
+            filters.append(filterName)
+            for patch, entries in patchDict.items():
+                patchId = patches.setdefault(patch, len(patches))
+                for entry in entries:
+                    visit, ccd = parseVisitCcd(entry)
+                    filterIds.append(filterId)
+                    patchIds.append(patchId)
+                    visits.append(visit)
+                    ccdIds.append(ccd)
+        return cls(filters, sorted(patches, key=patches.get), filterIds, patchIds, visits, ccdIds,
+                   fingerprint=fingerprint)
+
+    @classmethod
+    def fromPipeFile(cls, path):
+        """Read a pipe-delimited 'filter|patch|visit-ccd,visit-ccd,...' file"""
+        dataDict = {}
+        with open(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                filterName, patch, visitCcds = line.rstrip().split('|')
+                dataDict.setdefault(filterName, {})[patch] = visitCcds.split(',')
+        return cls.fromDataDict(dataDict, fingerprint=registryFingerprint(path))
+
+    def writePipeFile(self, path):
+        """Write the table as a 'filter|patch|visit-ccd,visit-ccd,...' file"""
+        with open(path, "w") as f:
+            for filterName, patchDict in sorted(self.dataDict().items()):
+                for patch in self.patchesOfFilter(filterName):
+                    f.write("%s|%s|%s\n" % (filterName, patch, ",".join(patchDict[patch])))
+
+    @classmethod
+    def load(cls, path, fingerprint=None):
+        """Load a table saved by `save`; return None if missing or stale"""
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        if fingerprint is not None and str(data["fingerprint"]) != fingerprint:
+            logger.info("Input index %s is stale; rebuilding it", path)
+            return None
+        return cls(data["filters"].tolist(), data["patches"].tolist(), data["filterIds"], data["patchIds"],
+                   data["visits"], data["ccds"], fingerprint=str(data["fingerprint"]))
+
+    def save(self, path):
+        """Save the table so that later runs can load it instead of parsing the input"""
+        with open(path, "wb") as f:
+            np.savez(f, filters=np.array(self.filters), patches=np.array(self.patches),
+                     filterIds=self.filterIds, patchIds=self.patchIds, visits=self.visits, ccds=self.ccdIds,
+                     fingerprint=np.array(self.fingerprint))
+
+
+def loadInputIndex(path, cachePath=None):
+    """Return the InputIndex of a pipe-delimited input file or a saved .npz
+
+    With cachePath, the parsed table is saved there and later calls load
+    it instead as long as the input file is unchanged.
+    """
+    if path.endswith(".npz"):
+        return InputIndex.load(path)
+    if cachePath is not None:
+        index = InputIndex.load(cachePath, fingerprint=registryFingerprint(path))
+        if index is not None:
+            return index
+    index = InputIndex.fromPipeFile(path)
+    logger.info("Indexed %d input CCDs of %d patches from %s", len(index), len(index.patches), path)
+    if cachePath is not None:
+        index.save(cachePath)
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Save the input data of a tract as a .npz input index")
+    parser.add_argument("inputData", help="pipe-delimited input data file, e.g. rcHsc/rcFPVC_8766")
+    parser.add_argument("-o", "--outputFile", default=None,
+                        help="the .npz file to write; default inputData.npz")
+    args = parser.parse_args()
+    loadInputIndex(args.inputData, cachePath=args.outputFile or args.inputData + ".npz")
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+from array import array
+
+import Pegasus.DAX3 as peg
+import lsst.log
+from daxWriter import _write, adagHeader, writeDependencies
+from dependencyIndex import DependencyIndex, jobInputsOutputs
+
+logger = lsst.log.Log.getLogger("jobGraph")
+logger.setLevel(lsst.log.INFO)
+
+# Link types are stored as small integers
+LINKS = [peg.Link.INPUT, peg.Link.OUTPUT, peg.Link.INOUT]
+_LINK_CODES = {link: code for code, link in enumerate(LINKS)}
+_INPUT = _LINK_CODES[peg.Link.INPUT]
+_OUTPUT = _LINK_CODES[peg.Link.OUTPUT]
+# Use attributes besides name and link; a use setting any of them is
+# kept as the original Use object
+_USE_OPTIONS = ("register", "transfer", "optional", "namespace", "version", "executable", "size")
+
+
+class JobRecord(object):
+    """Compact record of one job of a JobGraph
+
+    The used files are the parallel arrays fileIds and links of interned
+    LFN IDs and link codes; uses with other options, profiles and
+    invocations are rare and kept as Pegasus objects in extras.
+    """
+    __slots__ = ("id", "name", "namespace", "version", "node_label", "arguments",
+                 "stdout", "stderr", "stdin", "fileIds", "links", "extras")
+
+    def __init__(self, jobId, name, namespace=None, version=None, node_label=None):
+        self.id = jobId
+        self.name = name
+        self.namespace = namespace
+        self.version = version
+        self.node_label = node_label
+        self.arguments = ()
+        self.stdout = self.stderr = self.stdin = -1
+        self.fileIds = array('i')
+        self.links = array('b')
+        self.extras = None
+
+    # Records are pickled when tract graphs come back from worker processes
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class JobGraph(object):
+    """Workflow graph holding files and jobs as interned integer records
+
+    A drop-in replacement for peg.ADAG in the generators: addFile, hasFile,
+    addJob, hasJob, depends and writeXML take and behave like the Pegasus
+    ones.  Each LFN is interned once to an integer; a job added with
+    addJob is converted to a JobRecord, so the peg.Job with its Use
+    objects can be freed, and every uses-edge costs an array entry.
+    Pegasus objects are created again one at a time when writing XML.
+
+    Parameters
+    ----------
+    name: `str`
+        Name of the ADAG
+    autoDepends: `bool`, optional
+        Add a dependency from the job producing each input file as each
+        job is added, through a dependencyIndex.DependencyIndex of the
+        interned IDs
+    completed: `resume.CompletedOutputs`, optional
+        Outputs of earlier runs, reused as in dependencyIndex.IndexedADAG
+    """
+
+    def __init__(self, name, count=None, index=None, autoDepends=True, completed=None):
+        self.name = name
+        self.completed = completed
+        self.count = count
+        self.index = index
+        self.dependencyIndex = DependencyIndex() if autoDepends else None
+        self._lfnIds = {}
+        self._lfns = []
+        self._pfns = {}
+        self._declared = array('i')
+        self.jobs = []
+        self._jobIndex = {}
+        self._parents = array('i')
+        self._children = array('i')
+        self._edges = set()
+        self._edgeLabels = {}
+        self.sequence = 1
+
+    def intern(self, lfn):
+        """Return the integer ID of an LFN"""
+        fileId = self._lfnIds.get(lfn)
+        if fileId is None:
+            fileId = self._lfnIds[lfn] = len(self._lfns)
+            self._lfns.append(lfn)
+        return fileId
+
+    def _name(self, file):
+        return file.name if isinstance(file, peg.CatalogType) else file
+
+    def addFile(self, file):
+        """Declare a replica catalog entry, like ADAG.addFile"""
+        fileId = self.intern(file.name)
+        if fileId in self._pfns:
+            raise peg.DuplicateError("Duplicate file %s" % file.name)
+        self._pfns[fileId] = tuple((pfn.url, pfn.site) for pfn in file.pfns)
+        self._declared.append(fileId)
+        if self.dependencyIndex is not None and file.pfns:
+            self.dependencyIndex.addStatic(fileId)
+
+    def hasFile(self, file):
+        fileId = self._lfnIds.get(self._name(file))
+        return fileId is not None and fileId in self._pfns
+
+    def _jobId(self, job):
+        return job.id if isinstance(job, (peg.AbstractJob, JobRecord)) else job
+
+    def hasJob(self, job):
+        return self._jobId(job) in self._jobIndex
+
+    def addJob(self, job):
+        """Add a peg.Job, converting it to a JobRecord
+
+        Returns
+        -------
+        record: `JobRecord`
+            Can be passed to depends in place of the job; None if the
+            job is left out as its outputs are reused
+        """
+        if job.id is None:
+            job.id = "ID%07d" % self.sequence
+            self.sequence += 1
+        if job.id in self._jobIndex:
+            raise peg.DuplicateError("Duplicate job %s" % job.id)
+        if self.completed is not None and self._reuseOutputs(job):
+            return None
+
+        record = JobRecord(job.id, job.name, getattr(job, "namespace", None), getattr(job, "version", None),
+                           job.node_label)
+        record.arguments = tuple(job.arguments)
+        for attr in ("stdout", "stderr", "stdin"):
+            value = getattr(job, attr)
+            if value is not None:
+                setattr(record, attr, self.intern(self._name(value)))
+        extras = []
+        for use in job.used:
+            if any(getattr(use, option, None) is not None for option in _USE_OPTIONS) or \
+                    use.link not in _LINK_CODES:
+                extras.append(use)
+                continue
+            record.fileIds.append(self.intern(use.name))
+            record.links.append(_LINK_CODES[use.link])
+        extras.extend(getattr(job, "profiles", ()))
+        extras.extend(getattr(job, "invocations", ()))
+        if extras:
+            record.extras = tuple(extras)
+
+        jobIndex = self._jobIndex[job.id] = len(self.jobs)
+        self.jobs.append(record)
+        if self.dependencyIndex is not None:
+            inputs = [fileId for fileId, link in zip(record.fileIds, record.links) if link != _OUTPUT]
+            outputs = [fileId for fileId, link in zip(record.fileIds, record.links) if link != _INPUT]
+            for parentIndex, childIndex in self.dependencyIndex.addJob(jobIndex, inputs, outputs):
+                self._addEdge(parentIndex, childIndex)
+        return record
+
+    def _reuseOutputs(self, job):
+        """Declare the earlier outputs of job instead of adding it, if all exist"""
+        inputs, outputs = jobInputsOutputs(job)
+        if self.dependencyIndex is not None and \
+                any(self._lfnIds.get(name) in self.dependencyIndex.producers for name in inputs):
+            return False
+        paths = self.completed.reusable("%s_%s" % (job.name, job.id), outputs)
+        if paths is None:
+            return False
+        for lfn, path in paths.items():
+            fileId = self.intern(lfn)
+            if fileId not in self._pfns:
+                self._declared.append(fileId)
+            self._pfns[fileId] = tuple(self.completed.pfns(path))
+            if self.dependencyIndex is not None:
+                self.dependencyIndex.addStatic(fileId)
+        return True
+
+    def depends(self, parent, child, edge_label=None):
+        """Add a dependency, like ADAG.depends"""
+        parentIndex = self._jobIndex[self._jobId(parent)]
+        childIndex = self._jobIndex[self._jobId(child)]
+        if parentIndex == childIndex:
+            raise peg.FormatError("No self edges allowed")
+        self._addEdge(parentIndex, childIndex, edge_label, duplicate=True)
+
+    def addDependency(self, dep):
+        self.depends(dep.parent, dep.child, dep.edge_label)
+
+    def _addEdge(self, parentIndex, childIndex, edge_label=None, duplicate=False):
+        key = (parentIndex << 32) | childIndex
+        if key in self._edges:
+            if duplicate:
+                raise peg.DuplicateError("Duplicate dependency %s -> %s" %
+                                         (self.jobs[parentIndex].id, self.jobs[childIndex].id))
+            return
+        self._edges.add(key)
+        self._parents.append(parentIndex)
+        self._children.append(childIndex)
+        if edge_label is not None:
+            self._edgeLabels[key] = edge_label
+
+    def _makeFile(self, fileId):
+        f = peg.File(self._lfns[fileId])
+        for url, site in self._pfns[fileId]:
+            f.addPFN(peg.PFN(url, site=site))
+        return f
+
+    def _makeJob(self, record):
+        job = peg.Job(name=record.name, id=record.id, namespace=record.namespace, version=record.version,
+                      node_label=record.node_label)
+        # The arguments already hold the separators addArguments put in
+        job.addRawArguments(*record.arguments)
+        if record.stdout >= 0:
+            job.setStdout(peg.File(self._lfns[record.stdout]))
+        if record.stderr >= 0:
+            job.setStderr(peg.File(self._lfns[record.stderr]))
+        if record.stdin >= 0:
+            job.setStdin(peg.File(self._lfns[record.stdin]))
+        for fileId, link in zip(record.fileIds, record.links):
+            job.uses(self._lfns[fileId], link=LINKS[link])
+        for extra in record.extras or ():
+            if isinstance(extra, peg.Use):
+                job.used.add(extra)
+            elif isinstance(extra, peg.Profile):
+                job.addProfile(extra)
+            else:
+                job.addInvoke(extra)
+        return job
+
+    def _dependencyMap(self):
+        children = {}
+        for parentIndex, childIndex in zip(self._parents, self._children):
+            key = (parentIndex << 32) | childIndex
+            children.setdefault(self.jobs[childIndex].id, []).append(
+                (self.jobs[parentIndex].id, self._edgeLabels.get(key)))
+        return children
+
+    def toADAG(self):
+        """Convert to a peg.ADAG"""
+        adag = peg.ADAG(self.name, count=self.count, index=self.index)
+        for fileId in self._declared:
+            adag.addFile(self._makeFile(fileId))
+        for record in self.jobs:
+            adag.addJob(self._makeJob(record))
+        for child, parents in self._dependencyMap().items():
+            for parent, edge_label in parents:
+                adag.depends(parent=parent, child=child, edge_label=edge_label)
+        return adag
+
+    def merge(self, other):
+        """Add the files, jobs and dependencies of another JobGraph
+
+        Files declared in both graphs are declared once, e.g. calexps
+        used by two tracts or shared ref_cat shards.  A job of other
+        whose outputs are all produced by one job of this graph with the
+        same name and arguments, e.g. the schema pre-runs every coadd DAX
+        starts with, is merged with that job.  The other jobs get new IDs,
+        and with autoDepends, dependencies on the jobs of this graph
+        producing their inputs, e.g. when other is a partition of a
+        workflow whose inputs come from an earlier partition.
+        """
+        fileMap = array('i', [self.intern(lfn) for lfn in other._lfns])
+        for fileId in other._declared:
+            newId = fileMap[fileId]
+            if newId not in self._pfns:
+                self._pfns[newId] = other._pfns[fileId]
+                self._declared.append(newId)
+                if self.dependencyIndex is not None and self._pfns[newId]:
+                    self.dependencyIndex.addStatic(newId)
+
+        producers = {}
+        for jobIndex, record in enumerate(self.jobs):
+            for fileId, link in zip(record.fileIds, record.links):
+                if link != _INPUT:
+                    producers[fileId] = jobIndex
+        jobMap = array('i')
+        for record in other.jobs:
+            outputs = [fileMap[fileId] for fileId, link in zip(record.fileIds, record.links) if link != _INPUT]
+            existing = {producers.get(fileId) for fileId in outputs}
+            if outputs and len(existing) == 1 and None not in existing:
+                jobIndex = existing.pop()
+                if self.jobs[jobIndex].name == record.name and self.jobs[jobIndex].arguments == record.arguments:
+                    jobMap.append(jobIndex)
+                    continue
+
+            newRecord = JobRecord("ID%07d" % self.sequence, record.name, record.namespace, record.version,
+                                  record.node_label)
+            self.sequence += 1
+            newRecord.arguments = record.arguments
+            for attr in ("stdout", "stderr", "stdin"):
+                fileId = getattr(record, attr)
+                setattr(newRecord, attr, fileMap[fileId] if fileId >= 0 else -1)
+            newRecord.fileIds = array('i', [fileMap[fileId] for fileId in record.fileIds])
+            newRecord.links = array('b', record.links)
+            newRecord.extras = record.extras
+
+            jobIndex = self._jobIndex[newRecord.id] = len(self.jobs)
+            self.jobs.append(newRecord)
+            jobMap.append(jobIndex)
+            for fileId in outputs:
+                producers[fileId] = jobIndex
+            if self.dependencyIndex is not None:
+                inputs = [fileId for fileId, link in zip(newRecord.fileIds, newRecord.links) if link != _OUTPUT]
+                for parentIndex, childIndex in self.dependencyIndex.addJob(jobIndex, inputs, outputs):
+                    self._addEdge(parentIndex, childIndex)
+
+        for parentIndex, childIndex in zip(other._parents, other._children):
+            if jobMap[parentIndex] != jobMap[childIndex]:
+                edge_label = other._edgeLabels.get((parentIndex << 32) | childIndex)
+                self._addEdge(jobMap[parentIndex], jobMap[childIndex], edge_label)
+
+    def replicaEntries(self):
+        """Yield the (lfn, url, site) of the declared files with PFNs"""
+        for fileId in self._declared:
+            for url, site in self._pfns[fileId]:
+                yield self._lfns[fileId], url, site
+
+    def writeXML(self, out, declareInputs=True):
+        """Write the DAX, creating the Pegasus objects one at a time
+
+        Without declareInputs, the files with PFNs are left out and
+        must be found in a replica catalog, e.g. from replicaEntries.
+        """
+        out.write(adagHeader(peg.ADAG(self.name, count=self.count, index=self.index)))
+        for fileId in self._declared:
+            if declareInputs or not self._pfns[fileId]:
+                _write(self._makeFile(fileId), out)
+        for record in sorted(self.jobs, key=lambda record: record.id):
+            _write(self._makeJob(record), out)
+        writeDependencies(self._dependencyMap(), out)
+        out.write('</adag>\n')
+
+    def stats(self):
+        """Return a dict of the graph sizes"""
+        return dict(lfns=len(self._lfns), files=len(self._declared), jobs=len(self.jobs),
+                    uses=sum(len(record.fileIds) for record in self.jobs), dependencies=len(self._parents))
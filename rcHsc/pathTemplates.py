@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import lsst.log
+
+logger = lsst.log.Log.getLogger("pathTemplates")
+logger.setLevel(lsst.log.INFO)
+
+# Dataset types used by the DAX generators
+DEFAULT_DATASET_TYPES = [
+    "raw", "calexp", "src", "srcMatch", "srcMatchFull", "icSrc_schema", "src_schema",
+    "bias", "dark", "flat", "fringe", "bfKernel",
+    "ref_cat", "ref_cat_config", "brightObjectMask", "wcs", "fcr", "forced_src",
+    "deepCoadd_skyMap", "deepCoadd_directWarp", "deepCoadd", "deepCoadd_calexp",
+    "deepCoadd_calexp_background", "deepCoadd_det", "deepCoadd_mergeDet", "deepCoadd_meas",
+    "deepCoadd_measMatch", "deepCoadd_ref", "deepCoadd_forced_src",
+    "deepCoadd_det_schema", "deepCoadd_mergeDet_schema", "deepCoadd_peak_schema",
+    "deepCoadd_meas_schema", "deepCoadd_ref_schema", "deepCoadd_forced_src_schema",
+    "forced_src_schema",
+]
+
+
+class PathTemplateResolver(object):
+    """Resolve Butler paths by filling the mapper policy templates directly
+
+    CameraMapper.map_* builds a ButlerLocation for every call, queries the
+    registry for the keys missing from the dataId and searches the storage
+    for the file.  Here the template and key list of each dataset type are
+    taken from the mapper policy once, the registry lookups for missing keys
+    are memoized, and the paths are filled in bulk with plain string
+    formatting.
+
+    Parameters
+    ----------
+    mapper: lsst.obs.base.CameraMapper
+        Mapper providing the policy templates and the registries
+    datasetTypes: `list` of `str`, optional
+        Dataset types to resolve from templates; the others are left to map_*
+    verifySample: `int`, optional
+        Check this many paths of each dataset type against map_*, spread
+        evenly over the dataIds of the first calls
+    registryIndex: `registryIndex.RawRegistryIndex`, optional
+        Preloaded raw registry used for missing keys instead of Mapping.need
+    calibAssignment: `calibIndex.CalibAssignment`, optional
+        Precomputed calibs used for the keys of calib datasets
+    """
+
+    def __init__(self, mapper, datasetTypes=DEFAULT_DATASET_TYPES, verifySample=0, registryIndex=None,
+                 calibAssignment=None):
+        self.mapper = mapper
+        self.registryIndex = registryIndex
+        self.calibAssignment = calibAssignment
+        self.datasetTypes = set(datasetTypes)
+        self.verifySample = verifySample
+        self._templates = {}
+        self._verified = {}
+        self._properties = {}
+
+    def _getTemplate(self, datasetType):
+        """Return (template, keys, mapping) for a dataset type, or None"""
+        if datasetType not in self._templates:
+            mapping = self.mapper.mappings.get(datasetType) if datasetType in self.datasetTypes else None
+            if mapping is None:
+                self._templates[datasetType] = None
+            else:
+                self._templates[datasetType] = (mapping.template, list(mapping.keyDict.keys()), mapping)
+        return self._templates[datasetType]
+
+    def canResolve(self, datasetType):
+        return self._getTemplate(datasetType) is not None
+
+    def _fillProperties(self, datasetType, keys, mapping, dataId):
+        """Complete dataId with the template keys it lacks, as Mapping.need does"""
+        missing = [key for key in keys if key not in dataId]
+        if not missing:
+            return dataId
+        if self.calibAssignment is not None and datasetType in self.calibAssignment.assigned:
+            actualId = self.calibAssignment.fillDataId(datasetType, dataId, missing)
+            if actualId is not None:
+                return actualId
+        elif self.registryIndex is not None:
+            actualId = self.registryIndex.fillDataId(dataId, missing)
+            if actualId is not None:
+                return actualId
+        cacheKey = (datasetType, tuple(sorted(dataId.items())))
+        actualId = self._properties.get(cacheKey)
+        if actualId is None:
+            actualId = self._properties[cacheKey] = mapping.need(missing, dataId)
+        return actualId
+
+    def getButlerPath(self, datasetType, dataId):
+        """Return the repo-relative path of one dataset"""
+        return self.getButlerPaths(datasetType, [dataId])[0]
+
+    def getButlerPaths(self, datasetType, dataIds):
+        """Return the repo-relative paths of a list of dataIds of one dataset type"""
+        template, keys, mapping = self._getTemplate(datasetType)
+        transformId = getattr(self.mapper, "_transformId", dict)
+        paths = [template % transformId(self._fillProperties(datasetType, keys, mapping, dataId))
+                 for dataId in dataIds]
+        toVerify = self.verifySample - self._verified.get(datasetType, 0)
+        if toVerify > 0:
+            self.verify(datasetType, dataIds, paths, sampleSize=toVerify)
+            self._verified[datasetType] = self._verified.get(datasetType, 0) + min(toVerify, len(dataIds))
+        return paths
+
+    def verify(self, datasetType, dataIds, paths=None, sampleSize=20):
+        """Compare template-filled paths against map_* on a sample
+
+        The sample is sampleSize dataIds spread evenly over dataIds, so
+        that runs on the same inputs check the same paths.
+
+        Raises
+        ------
+        RuntimeError
+            If any sampled path differs from the mapper's
+        """
+        if paths is None:
+            paths = self.getButlerPaths(datasetType, dataIds)
+        indices = list(range(len(dataIds)))
+        if len(indices) > sampleSize:
+            indices = [i*len(dataIds)//sampleSize for i in range(sampleSize)]
+        mapFunc = getattr(self.mapper, "map_" + datasetType)
+        mismatches = []
+        for i in indices:
+            expected = mapFunc(dataIds[i]).getLocations()[0]
+            if expected != paths[i]:
+                mismatches.append((dataIds[i], paths[i], expected))
+        if mismatches:
+            raise RuntimeError("Template paths of %s differ from map_%s: %s" %
+                               (datasetType, datasetType, mismatches))
+        logger.info("Verified %d template paths of %s against map_%s",
+                    len(indices), datasetType, datasetType)
+        return True
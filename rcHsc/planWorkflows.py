@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Run pegasus-plan on several DAXes at once
+
+The options are those of plan_dax.sh.  Each DAX is planned into its own
+submit directory by its own pegasus-plan process, so planning many
+sub-workflows takes about as long as planning the largest one.
+"""
+import argparse
+import os
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+import lsst.log
+
+logger = lsst.log.Log.getLogger("workflow")
+logger.setLevel(lsst.log.INFO)
+
+# The directory of plan_dax.sh, sites.xml and tc.txt
+baseDir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def planArguments(site="lsstvc", tcFile="tc.txt", configDir=baseDir, cluster=None):
+    """Return the pegasus-plan options of plan_dax.sh besides the directories
+
+    These are also the arguments of the peg.DAX jobs of a hierarchical
+    workflow, which are planned when DAGMan reaches them.  With
+    pegasus.catalog.replica.cache.asrc, the outputs of the parent
+    sub-workflows, passed on as cache files, are found as inputs.
+    cluster is the --cluster option, e.g. "horizontal".
+    """
+    options = ["-Dpegasus.transfer.links=true",
+               "-Dpegasus.catalog.site.file=%s" % os.path.join(configDir, "sites.xml"),
+               "-Dpegasus.catalog.transformation.file=%s" % os.path.join(configDir, tcFile),
+               "-Dpegasus.data.configuration=sharedfs",
+               "-Dpegasus.catalog.replica.cache.asrc=true",
+               "--sites", site]
+    if cluster is not None:
+        options += ["--cluster", cluster]
+    return options
+
+
+def _plan(task):
+    daxFile, submitDir, outputDir, options, submit = task
+    command = ["pegasus-plan"] + options + ["--output-dir", outputDir, "--dir", submitDir,
+                                            "--relative-submit-dir",
+                                            os.path.splitext(os.path.basename(daxFile))[0],
+                                            "--dax", daxFile]
+    if submit:
+        command.append("--submit")
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return daxFile, process.returncode, time.time() - start, output
+
+
+def planDaxes(daxFiles, submitDir="submit", outputDir="output", processes=4, submit=False, **options):
+    """Plan DAXes with concurrent pegasus-plan processes
+
+    Parameters
+    ----------
+    daxFiles: `list` of `str`
+        DAXes to plan
+    submitDir: `str`, optional
+        Base submit directory; each DAX is planned in a subdirectory
+        named after it
+    outputDir: `str`, optional
+        Where the outputs are staged
+    processes: `int`, optional
+        Number of pegasus-plan processes at a time
+    submit: `bool`, optional
+        Submit each planned workflow
+    options:
+        Passed to planArguments
+
+    Returns
+    -------
+    failed: `list` of `str`
+        The DAXes pegasus-plan failed on
+    """
+    tasks = [(daxFile, submitDir, outputDir, planArguments(**options), submit) for daxFile in daxFiles]
+    pool = ThreadPool(processes)
+    failed = []
+    try:
+        for daxFile, returncode, seconds, output in pool.imap(_plan, tasks):
+            if returncode != 0:
+                logger.warn("Planning %s failed:\n%s", daxFile, output)
+                failed.append(daxFile)
+            else:
+                logger.info("Planned %s in %.1fs", daxFile, seconds)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan several DAXes in parallel")
+    parser.add_argument("daxFiles", nargs="+", help="DAX files to plan")
+    parser.add_argument("--site", default="lsstvc", help="execution site")
+    parser.add_argument("--tc", dest="tcFile", default="tc.txt", help="transformation catalog file")
+    parser.add_argument("--submitDir", default=os.path.join(baseDir, "submit"),
+                        help="base directory of the submit directories")
+    parser.add_argument("--outputDir", default=os.path.join(baseDir, "output"),
+                        help="output directory")
+    parser.add_argument("-j", "--processes", type=int, default=4,
+                        help="number of pegasus-plan processes")
+    parser.add_argument("--cluster", default=None, help="pegasus-plan --cluster, e.g. horizontal")
+    parser.add_argument("--submit", action="store_true", default=False,
+                        help="submit the planned workflows")
+    args = parser.parse_args()
+
+    failed = planDaxes(args.daxFiles, submitDir=args.submitDir, outputDir=args.outputDir,
+                       processes=args.processes, submit=args.submit, site=args.site, tcFile=args.tcFile,
+                       cluster=args.cluster)
+    if failed:
+        raise SystemExit("Failed to plan %d of %d DAXes" % (len(failed), len(args.daxFiles)))
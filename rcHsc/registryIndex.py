@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import sqlite3
+import sys
+import numpy as np
+import lsst.log
+
+logger = lsst.log.Log.getLogger("registryIndex")
+logger.setLevel(lsst.log.INFO)
+
+
+class RawRegistryIndex(object):
+    """In-memory columnar index of the raw table of a Butler registry
+
+    The whole raw table is read with a single query instead of one
+    queryMetadata or map_raw lookup per CCD.  Every column is kept as a
+    NumPy array sorted by (visit, ccd); rows are found through a dict
+    keyed by (visit, ccd) and the rows of a visit form a contiguous slice.
+
+    Parameters
+    ----------
+    registryPath: `str`
+        Path of registry.sqlite3
+    columns: `list` of `str`, optional
+        Columns to load, besides visit and ccd; those missing from the
+        table are skipped
+    """
+    COLUMNS = ("filter", "field", "pointing", "dateObs", "taiObs", "expTime")
+
+    def __init__(self, registryPath, columns=COLUMNS):
+        conn = sqlite3.connect(registryPath)
+        if sys.version_info[0] < 3:
+            conn.text_factory = str
+        available = {row[1] for row in conn.execute("PRAGMA table_info(raw)")}
+        self.names = ["visit", "ccd"] + [col for col in columns if col in available]
+        rows = conn.execute("SELECT DISTINCT %s FROM raw" % ", ".join(self.names)).fetchall()
+        conn.close()
+        logger.info("Loaded %d raw registry rows from %s", len(rows), registryPath)
+
+        values = list(zip(*rows)) if rows else [()] * len(self.names)
+        visit = np.array(values[0], dtype=np.int64)
+        ccd = np.array(values[1], dtype=np.int64)
+        order = np.lexsort((ccd, visit))
+        self.columns = {}
+        for name, column in zip(self.names, values):
+            self.columns[name] = np.array(column)[order] if len(column) else np.array([])
+
+        self.visits, start, count = np.unique(self.columns["visit"], return_index=True,
+                                              return_counts=True)
+        self._visitSlice = {v: slice(s, s + c) for v, s, c in
+                            zip(self.visits.tolist(), start.tolist(), count.tolist())}
+        self._rows = {key: i for i, key in
+                      enumerate(zip(self.columns["visit"].tolist(), self.columns["ccd"].tolist()))}
+
+    def __contains__(self, visitCcd):
+        return tuple(visitCcd) in self._rows
+
+    def getCcds(self, visit):
+        """Return the CCDs of a visit that exist in the registry"""
+        visitSlice = self._visitSlice.get(int(visit))
+        if visitSlice is None:
+            return []
+        return self.columns["ccd"][visitSlice].tolist()
+
+    def getVisitValue(self, visit, name):
+        """Return a per-visit value, e.g. filter, of a visit
+
+        Raises
+        ------
+        KeyError
+            If the visit is not in the registry
+        RuntimeError
+            If the value is not the same for all CCDs of the visit
+        """
+        values = np.unique(self.columns[name][self._visitSlice[int(visit)]])
+        if len(values) != 1:
+            raise RuntimeError("%s of visit %s is not unique: %s" % (name, visit, values))
+        return values[0].item()
+
+    def getFilter(self, visit):
+        return self.getVisitValue(visit, "filter")
+
+    def getProperties(self, visit, ccd, names=None):
+        """Return a dict of the registry values of one CCD"""
+        row = self._rows[(int(visit), int(ccd))]
+        if names is None:
+            names = self.names
+        return {name: self.columns[name][row].item() for name in names}
+
+    def fillDataId(self, dataId, names):
+        """Return a copy of dataId completed with the named registry values
+
+        Returns None if the index cannot provide them, i.e. dataId lacks
+        visit or ccd, a name is not a loaded column, or the CCD is unknown.
+        """
+        if "visit" not in dataId or "ccd" not in dataId:
+            return None
+        if any(name not in self.columns for name in names):
+            return None
+        row = self._rows.get((int(dataId["visit"]), int(dataId["ccd"])))
+        if row is None:
+            return None
+        newId = dict(dataId)
+        for name in names:
+            newId[name] = self.columns[name][row].item()
+        return newId
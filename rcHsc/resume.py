@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+import glob
+import os
+
+import lsst.log
+
+logger = lsst.log.Log.getLogger("resume")
+logger.setLevel(lsst.log.INFO)
+
+# FITS files are written in blocks of 2880 bytes; a truncated one is not
+FITS_BLOCK = 2880
+
+# Jobs added by pegasus-plan; they may run in the submit directory
+AUXILIARY_JOBS = ("create_dir_", "stage_in_", "stage_out_", "stage_inter_", "stage_worker_",
+                  "clean_up_", "cleanup_", "register_", "pegasus-plan_")
+
+
+def readSubmitDir(submitDir):
+    """Return the working directory and the succeeded jobs of a Pegasus run
+
+    Parameters
+    ----------
+    submitDir: `str`
+        Submit directory of a planned workflow, with braindump.txt
+
+    Returns
+    -------
+    workDir: `str`
+        The directory on the shared filesystem the jobs ran in, the
+        remote_initialdir of the succeeded compute jobs
+    doneJobs: `set` of `str`
+        Names of the jobs, e.g. processCcd_ID0000042, marked DONE in a
+        rescue DAG or whose post script succeeded in jobstate.log
+
+    Raises
+    ------
+    RuntimeError
+        If no succeeded compute job has a remote_initialdir, or if they
+        do not all have the same
+    """
+    doneJobs = set()
+    for rescue in sorted(glob.glob(os.path.join(submitDir, "*.dag.rescue*"))):
+        with open(rescue) as f:
+            for line in f:
+                if line.startswith("DONE "):
+                    doneJobs.add(line.split()[1])
+    jobstate = os.path.join(submitDir, "jobstate.log")
+    if os.path.exists(jobstate):
+        with open(jobstate) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] == "POST_SCRIPT_SUCCESS":
+                    doneJobs.add(fields[1])
+
+    # Submit files may be in hashed subdirectories, e.g. 00/00
+    workDirs = set()
+    for dirPath, _, fileNames in os.walk(submitDir):
+        for fileName in fileNames:
+            jobName, ext = os.path.splitext(fileName)
+            if ext != ".sub" or jobName not in doneJobs or jobName.startswith(AUXILIARY_JOBS):
+                continue
+            with open(os.path.join(dirPath, fileName)) as f:
+                for line in f:
+                    key, _, value = line.partition("=")
+                    if key.strip() == "remote_initialdir":
+                        workDirs.add(value.strip())
+                        break
+    if not workDirs:
+        raise RuntimeError("No working directory of a succeeded compute job found in %s" % submitDir)
+    if len(workDirs) > 1:
+        raise RuntimeError("Compute jobs of %s ran in several directories: %s" %
+                           (submitDir, sorted(workDirs)))
+    workDir = workDirs.pop()
+    logger.info("%s: %d jobs done in %s", submitDir, len(doneJobs), workDir)
+    return workDir, doneJobs
+
+
+def isValidOutput(path):
+    """Return whether an output file looks complete"""
+    if not os.path.isfile(path):
+        return False
+    size = os.path.getsize(path)
+    if size == 0:
+        return False
+    if path.endswith(".fits"):
+        return size % FITS_BLOCK == 0
+    return True
+
+
+class CompletedOutputs(object):
+    """Outputs of earlier runs that a resumed workflow takes as inputs
+
+    A job all of whose Butler outputs are found is left out of the
+    workflow and its outputs are declared with PFNs instead, so that the
+    jobs reading them use them as they are.  The adding ADAG leaves in a
+    job any of whose inputs is produced by a job of the workflow, so
+    everything downstream of missing work runs again.
+
+    Parameters
+    ----------
+    paths: `list` of `str`
+        Butler output repos, whose files are trusted if they look
+        complete, or Pegasus submit directories, whose files are trusted
+        only if the job writing them succeeded; with the job IDs of that
+        run, the DAX must be generated the same way
+    outPath: `str`, optional
+        The repo LFN prefix of the generator
+    sites: `list` of `str`, optional
+        Pegasus sites to add a PFN for
+    """
+
+    def __init__(self, paths, outPath="repo", sites=("local", "lsstvc")):
+        self.outPath = outPath
+        self.sites = tuple(sites)
+        self.repos = []
+        for path in paths:
+            if os.path.exists(os.path.join(path, "braindump.txt")):
+                workDir, doneJobs = readSubmitDir(path)
+                self.repos.append((os.path.join(workDir, outPath), doneJobs))
+            else:
+                self.repos.append((path, None))
+        self.reusedJobs = 0
+
+    def find(self, lfn, jobName):
+        """Return the path of a complete earlier output, or None"""
+        butlerPath = os.path.relpath(lfn, self.outPath)
+        for root, doneJobs in self.repos:
+            if doneJobs is not None and jobName not in doneJobs:
+                continue
+            path = os.path.join(root, butlerPath)
+            if isValidOutput(path):
+                return path
+        return None
+
+    def reusable(self, jobName, outputs):
+        """Return the earlier outputs of a job if all are found
+
+        Parameters
+        ----------
+        jobName: `str`
+            The name of the job in a Pegasus run, transformation_ID
+        outputs: `list` of `str`
+            LFNs the job writes; the ones outside the repo, e.g. its
+            log, are not looked for
+
+        Returns
+        -------
+        paths: `dict` or None
+            The path of each output in the repo, or None if any is
+            missing or the job writes nothing in the repo
+        """
+        paths = {}
+        for lfn in outputs:
+            if not lfn.startswith(self.outPath + os.sep):
+                continue
+            path = self.find(lfn, jobName)
+            if path is None:
+                return None
+            paths[lfn] = path
+        if paths:
+            self.reusedJobs += 1
+        return paths or None
+
+    def pfns(self, path):
+        """Return the (url, site) of an earlier output at path"""
+        return [(path, site) for site in self.sites]
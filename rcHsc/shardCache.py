@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import sqlite3
+import time
+import lsst.log
+
+logger = lsst.log.Log.getLogger("shardCache")
+logger.setLevel(lsst.log.INFO)
+
+# Seconds SQLite waits for a lock held by another process, and the
+# number of times a statement still failing on a lock is retried; the
+# processes of one generator share the file, on GPFS locks can be slow
+LOCK_TIMEOUT = 60.0
+LOCK_RETRIES = 5
+
+
+def configHash(paths=(), extra=()):
+    """Return a hash of the content of config files and extra values
+
+    Parameters
+    ----------
+    paths: `list` of `str`
+        Files whose content identifies the configuration, e.g. the
+        ref_cat config and the pickled skymap
+    extra: `list`
+        Other values that affect the result, e.g. selection parameters
+    """
+    md5 = hashlib.md5()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                md5.update(chunk)
+    for value in extra:
+        md5.update(repr(value).encode("utf-8"))
+    return md5.hexdigest()
+
+
+class ShardCache(object):
+    """Persistent cache of the ref_cat shards needed by patches and exposures
+
+    Shards are keyed by (ref_dataset_name, tract, patch) for patches and
+    by (ref_dataset_name, visit, ccd) for exposures, together with a hash
+    of the configuration they were computed with, so a changed skymap or
+    ref_cat config never returns stale entries.  The same SQLite file can
+    be shared by generateDaxSfm.py and generateDaxCoadd.py.
+
+    Parameters
+    ----------
+    path: `str`
+        SQLite file of the cache; created if it does not exist
+    refcatHash: `str`
+        Hash of the ref_cat configuration; applies to all entries
+    skymapHash: `str`
+        Hash of the skymap; applies to patch entries
+    flushEvery: `int`
+        Write new entries to the file after this many, so that an
+        interrupted run keeps what it computed
+    timeout: `float`
+        Seconds to wait for the lock of another process writing the file
+    """
+
+    def __init__(self, path, refcatHash="", skymapHash="", flushEvery=1000, timeout=LOCK_TIMEOUT):
+        self.path = path
+        self.expHash = refcatHash
+        self.patchHash = refcatHash + skymapHash
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        self._write([("CREATE TABLE IF NOT EXISTS patch_shards "
+                      "(ref_dataset_name TEXT, config_hash TEXT, tract INTEGER, patch TEXT, "
+                      "shards TEXT, PRIMARY KEY (ref_dataset_name, config_hash, tract, patch))", ()),
+                     ("CREATE TABLE IF NOT EXISTS exposure_shards "
+                      "(ref_dataset_name TEXT, config_hash TEXT, visit INTEGER, ccd INTEGER, "
+                      "shards TEXT, PRIMARY KEY (ref_dataset_name, config_hash, visit, ccd))", ())])
+        self._patches = {}
+        self._exposures = {}
+        for name, tract, patch, shards in self._conn.execute(
+                "SELECT ref_dataset_name, tract, patch, shards FROM patch_shards WHERE config_hash = ?",
+                (self.patchHash,)):
+            self._patches[(str(name), tract, str(patch))] = self._decode(shards)
+        for name, visit, ccd, shards in self._conn.execute(
+                "SELECT ref_dataset_name, visit, ccd, shards FROM exposure_shards WHERE config_hash = ?",
+                (self.expHash,)):
+            self._exposures[(str(name), visit, ccd)] = self._decode(shards)
+        self._pending = []
+        self.flushEvery = flushEvery
+        self.hits = 0
+        self.misses = 0
+        logger.info("Shard cache %s: %d patches and %d exposures cached",
+                    path, len(self._patches), len(self._exposures))
+
+    @staticmethod
+    def _decode(shards):
+        return [int(shard) for shard in shards.split(",")] if shards else []
+
+    @staticmethod
+    def _encode(shards):
+        return ",".join(str(shard) for shard in shards)
+
+    def _write(self, statements):
+        """Execute (statement, values) pairs in one transaction
+
+        A transaction failing because another process holds the lock
+        past the timeout is rolled back and retried.
+        """
+        for attempt in range(LOCK_RETRIES + 1):
+            try:
+                for statement, values in statements:
+                    self._conn.execute(statement, values)
+                self._conn.commit()
+                return
+            except sqlite3.OperationalError as e:
+                self._conn.rollback()
+                if "locked" not in str(e) or attempt == LOCK_RETRIES:
+                    raise
+                logger.warn("Shard cache %s is locked; retrying", self.path)
+                time.sleep(1 + attempt)
+
+    def _get(self, table, key):
+        shards = table.get(key)
+        if shards is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return shards
+
+    def _put(self, statement, values):
+        self._pending.append((statement, values))
+        if len(self._pending) >= self.flushEvery:
+            self.flush()
+
+    def getPatch(self, ref_dataset_name, tract, patch):
+        """Return the cached shards of a patch, or None"""
+        return self._get(self._patches, (ref_dataset_name, int(tract), str(patch)))
+
+    def putPatch(self, ref_dataset_name, tract, patch, shards):
+        self._patches[(ref_dataset_name, int(tract), str(patch))] = list(shards)
+        self._put("INSERT OR REPLACE INTO patch_shards VALUES (?, ?, ?, ?, ?)",
+                  (ref_dataset_name, self.patchHash, int(tract), str(patch), self._encode(shards)))
+
+    def getExposure(self, ref_dataset_name, visit, ccd):
+        """Return the cached shards of an exposure, or None"""
+        return self._get(self._exposures, (ref_dataset_name, int(visit), int(ccd)))
+
+    def putExposure(self, ref_dataset_name, visit, ccd, shards):
+        self._exposures[(ref_dataset_name, int(visit), int(ccd))] = list(shards)
+        self._put("INSERT OR REPLACE INTO exposure_shards VALUES (?, ?, ?, ?, ?)",
+                  (ref_dataset_name, self.expHash, int(visit), int(ccd), self._encode(shards)))
+
+    def flush(self):
+        """Write the new entries to the SQLite file"""
+        if not self._pending:
+            return
+        self._write(self._pending)
+        logger.info("Shard cache %s: %d hits, %d misses, %d entries written",
+                    self.path, self.hits, self.misses, len(self._pending))
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def openShardCache(path, refCatConfigPath, skyMapPath=None, extra=()):
+    """Open a ShardCache with hashes computed from the config files
+
+    Parameters
+    ----------
+    path: `str`
+        SQLite file of the cache
+    refCatConfigPath: `str`
+        The ref_cat config file of the ref_dataset_name in the repo
+    skyMapPath: `str`, optional
+        The pickled deepCoadd_skyMap; needed for patch entries
+    extra: `list`, optional
+        Other values that change the shard selection
+    """
+    refcatHash = configHash([refCatConfigPath], extra)
+    skymapHash = configHash([skyMapPath]) if skyMapPath is not None and os.path.exists(skyMapPath) else ""
+    return ShardCache(path, refcatHash=refcatHash, skymapHash=skymapHash)
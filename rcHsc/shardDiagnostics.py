@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Compare the ref_cat shards staged by the shard selection modes
+
+For the coadd input data of a tract, e.g. rcFPVC_8766, report per stage
+the number of ref_cat files and bytes each selection mode stages: one
+mosaic job per filter, one measureCoaddSources job per filter and patch,
+and optionally one processCcd job per visit-ccd.
+"""
+import argparse
+import os
+from collections import OrderedDict
+
+from lsst.daf.persistence import Butler
+from lsst.obs.hsc.hscMapper import HscMapper
+from findShardId import SHARD_SELECTIONS, findShardIdsFromTract, findShardIdsFromExpIds
+from getDataFile import getResolver
+from generateDaxCoadd import inputRepo, rootRepo, refcatName, readBlacklist, readInputData
+
+def stageStats(jobShards, shardBytes):
+    """Summarize the shards staged by a list of jobs
+
+    Parameters
+    ----------
+    jobShards: `list` of `list`
+        The shards of each job
+    shardBytes: `dict`
+        The file size of each shard
+
+    Returns
+    -------
+    stats: `dict`
+        Number of jobs, files and bytes staged over all jobs, and
+        number and bytes of distinct shards
+    """
+    distinct = {shard for shards in jobShards for shard in shards}
+    return dict(jobs=len(jobShards),
+                files=sum(len(shards) for shards in jobShards),
+                bytes=sum(shardBytes[shard] for shards in jobShards for shard in shards),
+                shards=len(distinct),
+                shardBytes=sum(shardBytes[shard] for shard in distinct))
+
+
+def compareSelections(tract, dataDict, doExposures=False, processes=1, selections=SHARD_SELECTIONS):
+    """Compute the staging statistics of every selection mode
+
+    Returns
+    -------
+    report: `dict`
+        report[stage][selection] is a dict from `stageStats`
+    """
+    butler = Butler(inputRepo)
+    mapper = HscMapper(root=rootRepo)
+    resolver = getResolver(mapper)
+    allPatches = sorted({patch for filterName in dataDict for patch in dataDict[filterName]})
+
+    jobShards = OrderedDict((stage, {}) for stage in ["mosaic", "measureCoaddSources"])
+    for selection in selections:
+        patchShards, tractShards = findShardIdsFromTract(butler, tract, allPatches,
+                                                         ref_dataset_name=refcatName, selection=selection)
+        jobShards["mosaic"][selection] = [
+            sorted({shard for patch in dataDict[filterName] for shard in patchShards[patch]})
+            for filterName in dataDict]
+        jobShards["measureCoaddSources"][selection] = [
+            patchShards[patch] for filterName in dataDict for patch in dataDict[filterName]]
+
+    if doExposures:
+        expIds = sorted({tuple(map(int, visitCcd.split('-')))
+                         for filterName in dataDict for visitCcds in dataDict[filterName].values()
+                         for visitCcd in visitCcds if visitCcd})
+        expIds = [dict(visit=visit, ccd=ccd) for visit, ccd in expIds]
+        for selection in selections:
+            shardDict = findShardIdsFromExpIds(rootRepo, expIds, ref_dataset_name=refcatName,
+                                               processes=processes, selection=selection)
+            jobShards.setdefault("processCcd", {})[selection] = list(shardDict.values())
+
+    shardBytes = {}
+    for stage in jobShards.values():
+        for shardLists in stage.values():
+            for shards in shardLists:
+                for shard in shards:
+                    if shard not in shardBytes:
+                        butlerPath = resolver.getButlerPath("ref_cat", {"name": refcatName, "pixel_id": shard})
+                        filePath = os.path.join(rootRepo, butlerPath)
+                        shardBytes[shard] = os.path.getsize(filePath) if os.path.exists(filePath) else 0
+
+    return OrderedDict((stage, {selection: stageStats(shardLists, shardBytes)
+                                for selection, shardLists in stageShards.items()})
+                       for stage, stageShards in jobShards.items())
+
+
+def printReport(report, selections=SHARD_SELECTIONS):
+    header = "%-20s %-8s %6s %9s %14s %8s %14s" % ("stage", "mode", "jobs", "files", "bytes",
+                                                   "shards", "shardBytes")
+    print(header)
+    print("-"*len(header))
+    for stage in report:
+        for selection in selections:
+            stats = report[stage][selection]
+            print("%-20s %-8s %6d %9d %14d %8d %14d" % (stage, selection, stats["jobs"], stats["files"],
+                                                        stats["bytes"], stats["shards"],
+                                                        stats["shardBytes"]))
+        base = report[stage][selections[0]]
+        for selection in selections[1:]:
+            stats = report[stage][selection]
+            print("%-20s %-8s files %.1f%%, bytes %.1f%% of %s" % (
+                stage, selection, 100.0*stats["files"]/max(base["files"], 1),
+                100.0*stats["bytes"]/max(base["bytes"], 1), selections[0]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ref_cat shard selection modes")
+    parser.add_argument("-t", "--tractId", type=int, default=8766,
+                        help="the tract ID of the input file")
+    parser.add_argument("-i", "--inputData", default="rcHsc/rcFPVC_8766",
+                        help="a file including input data information")
+    parser.add_argument("-b", "--blacklist", default="rcHsc/rcBlacklist.txt",
+                        help="a file including visit-ccd to ignore")
+    parser.add_argument("--exposures", action="store_true", default=False,
+                        help="also compare processCcd shards; reads the raw headers")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of processes reading raw headers")
+    args = parser.parse_args()
+
+    dataDict = readInputData(args.inputData, readBlacklist(args.blacklist))
+
+    report = compareSelections(args.tractId, dataDict, doExposures=args.exposures,
+                               processes=args.processes)
+    printReport(report)
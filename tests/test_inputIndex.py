@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "rcHsc"))
+from inputIndex import InputIndex
+
+
+DATA_DICT = {
+    "HSC-I": {"3,4": ["100-5", "100-6", "102-5"], "4,4": ["100-6"]},
+    "HSC-R": {"3,4": ["200-5"]},
+}
+
+
+class InputIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.inputs = InputIndex.fromDataDict(DATA_DICT)
+
+    def testCcds(self):
+        """The CCDs of a filter and patch are returned in input order"""
+        self.assertEqual(self.inputs.ccds("HSC-I", "3,4"), [(100, 5), (100, 6), (102, 5)])
+        self.assertEqual(self.inputs.ccds("HSC-R", "3,4"), [(200, 5)])
+        self.assertEqual(self.inputs.ccds("HSC-R", "4,4"), [])
+        self.assertEqual(self.inputs.ccds("HSC-G", "3,4"), [])
+        self.assertEqual(self.inputs.ccdsOfFilter("HSC-I"), [(100, 5), (100, 6), (102, 5)])
+
+    def testPatches(self):
+        self.assertEqual(self.inputs.allPatches, ["3,4", "4,4"])
+        self.assertEqual(sorted(self.inputs.patchesOfCcd(100, 6)), ["3,4", "4,4"])
+        self.assertEqual(self.inputs.patchesOfVisit(200), ["3,4"])
+        self.assertEqual(self.inputs.visitsOfPatch("3,4"), [100, 102, 200])
+        self.assertEqual(self.inputs.visitsOfPatch("3,4", filterName="HSC-R"), [200])
+
+    def testDataDict(self):
+        self.assertEqual(self.inputs.dataDict(), DATA_DICT)
+        self.assertEqual(self.inputs.dataDict(blacklist=["100-6"]),
+                         {"HSC-I": {"3,4": ["100-5", "102-5"]}, "HSC-R": {"3,4": ["200-5"]}})
+
+    def testSaveLoad(self):
+        """A saved index is loaded with the same CCDs"""
+        tmpDir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpDir, "inputs.npz")
+            self.inputs.save(path)
+            loaded = InputIndex.load(path)
+            self.assertEqual(loaded.ccds("HSC-I", "3,4"), self.inputs.ccds("HSC-I", "3,4"))
+            self.assertEqual(loaded.dataDict(), DATA_DICT)
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+if __name__ == "__main__":
+    unittest.main()
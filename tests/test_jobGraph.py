@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import Pegasus.DAX3 as peg
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "rcHsc"))
+from dependencyIndex import IndexedADAG
+from jobGraph import JobGraph
+
+
+def buildWorkflow(dax):
+    """Add a processCcd job and the makeCoaddTempExp job reading its calexp"""
+    raw = peg.File("repo/raw/0-1.fits")
+    raw.addPFN(peg.PFN("/datasets/raw/0-1.fits", site="local"))
+    dax.addFile(raw)
+    calexp = peg.File("repo/calexp/0-1.fits")
+    dax.addFile(calexp)
+    warp = peg.File("repo/deepCoadd/warp-0.fits")
+    dax.addFile(warp)
+    log = peg.File("logProcessCcd.0-1")
+    dax.addFile(log)
+
+    processCcd = peg.Job(name="processCcd")
+    processCcd.addArguments("repo", "--output", "repo", " --doraise --id visit=0 ccd=1")
+    processCcd.addProfile(peg.Profile("condor", "request_memory", "4000"))
+    processCcd.uses(raw, link=peg.Link.INPUT)
+    processCcd.uses(calexp, link=peg.Link.OUTPUT)
+    processCcd.setStdout(log)
+    processCcd.uses(log, link=peg.Link.OUTPUT)
+    dax.addJob(processCcd)
+
+    makeCoaddTempExp = peg.Job(name="makeCoaddTempExp")
+    makeCoaddTempExp.addArguments("repo", "--output", "repo", " --doraise",
+                                  "--id tract=0 patch=1,1 filter=HSC-I", " -c doApplyUberCal=False ",
+                                  "--selectId visit=0 ccd=1")
+    makeCoaddTempExp.uses(calexp, link=peg.Link.INPUT)
+    makeCoaddTempExp.uses(warp, link=peg.Link.OUTPUT)
+    dax.addJob(makeCoaddTempExp)
+    return dax
+
+
+def daxContent(dax):
+    """Return the sorted lines of the DAX of dax without its comments"""
+    out = StringIO()
+    dax.writeXML(out)
+    return sorted(line for line in out.getvalue().splitlines() if not line.startswith("<!--"))
+
+
+class JobGraphTestCase(unittest.TestCase):
+
+    def testSameAsADAG(self):
+        """A JobGraph writes the same DAX as an IndexedADAG"""
+        self.assertEqual(daxContent(buildWorkflow(JobGraph("test"))),
+                         daxContent(buildWorkflow(IndexedADAG("test"))))
+
+    def testArguments(self):
+        """The arguments are written with the separators addArguments made"""
+        content = "\n".join(daxContent(buildWorkflow(JobGraph("test"))))
+        self.assertIn("repo --output repo  --doraise --id visit=0 ccd=1", content)
+        self.assertNotIn("repo  --output", content)
+
+    def testDependencies(self):
+        """The warp depends on the processCcd job making its calexp"""
+        graph = buildWorkflow(JobGraph("test"))
+        self.assertEqual(graph.toADAG().dependencies,
+                         buildWorkflow(IndexedADAG("test")).dependencies)
+
+
+if __name__ == "__main__":
+    unittest.main()